@@ -1,12 +1,26 @@
-import db
+import os
+# read from a mongodump instead of Mongo if GIBBS_DUMP_DIR is set
+if os.environ.get('GIBBS_DUMP_DIR'):
+    import dumpDb as db
+else:
+    import db
 import imageGen
+import matrixStore
+import trialArrays
+import argparse
 import json
 import operator
-import os
 import time
+from collections import OrderedDict
+from itertools import imap
+from multiprocessing import Pool
 from PIL import Image
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
 from math import floor, exp
 from numpy import *
+from scipy.optimize import fmin_l_bfgs_b
+from scipy.special import gammaln, stdtr
 from scipy.stats import t, truncnorm
 
 mu0 = 255.0 / 2.0 # prior mean
@@ -23,13 +37,17 @@ samples = 5
 Function: get_image_matrix
 
 Gets the image representing a matrix from the image's image_id.  Memoizes the
-responses to not waste time
+responses to not waste time. Images in the matrix store are read from there
+instead of being fetched from GridFS and decoded, and are kept as views of the
+store rather than copied. Images from GridFS are rounded with
+matrixStore.quantize, so both give the same values
 
 Parameters:
 image_id - id of the image to get a matrix representation of
 
 Returns:
-Numpy.ndarray of the image
+Numpy.ndarray of the image, of uint8. Convert it before any arithmetic that
+could overflow
 """
 image_matrices = {}
 def get_image_matrix(image_id):
@@ -41,8 +59,12 @@ def get_image_matrix(image_id):
         return image_matrices[image_id]
     # calculate the matrix for it, store it, and return it
     else:
-        image_file = db.get_image_file(image_id)
-        image_matrices[image_id] = array(imageGen.loadImage(image_file))
+        stored = matrixStore.get_matrix(image_id)
+        if stored is not None:
+            image_matrices[image_id] = stored
+        else:
+            image_file = db.get_image_file(image_id)
+            image_matrices[image_id] = matrixStore.quantize(imageGen.loadImage(image_file))
         return image_matrices[image_id]
 
 """
@@ -152,6 +174,453 @@ def discrete_trunc_t_logpdf(x, df, domain, loc=0, scale=1):
 
     return log_prob
 
+"""
+Function: domain_indices
+
+Finds the position of each of the values of x in domain, the vectorized
+equivalent of calling domain.index(val) for every value
+
+Parameters:
+x - array of values that must all appear in domain
+domain - array of the allowed values in the domain
+
+Returns:
+Integer array, the same shape as x, of indices into domain
+"""
+def domain_indices(x, domain):
+    # the usual domain is range(n), in which case the values are their own indices
+    if array_equal(domain, arange(len(domain))):
+        indices = x.astype(int)
+        if x.size > 0 and (indices.min() < 0 or indices.max() >= len(domain)):
+            raise ValueError("x contains values that are not in the domain")
+    else:
+        sorter = argsort(domain)
+        positions = searchsorted(domain[sorter], x).clip(0, len(domain) - 1)
+        indices = sorter[positions]
+
+    if not array_equal(domain[indices], x):
+        raise ValueError("x contains values that are not in the domain")
+
+    return indices
+
+"""
+Function: fast_discrete_trunc_t_logpdf
+
+Vectorized version of discrete_trunc_t_logpdf. Takes the same arguments and
+returns the same values, but evaluates the t density over the whole domain in
+one broadcast operation and looks up the values of x with integer indexing.
+
+The constant terms of the t log density (those depending only on df and
+scale) are the same for every value in the domain, so they cancel in the
+normalization and are never computed.
+
+Parameters:
+x - array-like values to be compared
+df - array-like the degrees of freedom
+domain - list of the allowed values in the domain of the discrete distribution
+loc - array-like the center point of the t distribution
+scale - array-like the scale of the t distribution
+
+Returns:
+The log_prob for the x values
+"""
+def fast_discrete_trunc_t_logpdf(x, df, domain, loc=0, scale=1):
+    x, df, loc, scale = broadcast_arrays(asarray(x, dtype=float),
+                                         asarray(df, dtype=float),
+                                         asarray(loc, dtype=float),
+                                         asarray(scale, dtype=float))
+    domain = asarray(domain, dtype=float)
+    n = len(domain)
+
+    indices = domain_indices(x, domain)
+
+    # unnormalized log density of every domain value at every position of x
+    # (done in place, as this array is len(domain) times the size of x)
+    all_log_prob = domain.reshape((n,) + (1,) * x.ndim) - loc
+    all_log_prob /= scale
+    all_log_prob *= all_log_prob
+    all_log_prob /= df
+    log1p(all_log_prob, out=all_log_prob)
+    all_log_prob *= -0.5 * (df + 1)
+
+    # normalize over the domain, shifting by the max to keep exp in range
+    max_log_prob = all_log_prob.max(axis=0)
+    shifted = exp(all_log_prob - max_log_prob)
+    total_log_prob = max_log_prob + log(shifted.sum(axis=0))
+
+    # pick out the value for each x
+    flat_log_prob = all_log_prob.reshape((n, x.size))
+    log_prob = flat_log_prob[indices.ravel(), arange(x.size)].reshape(x.shape)
+
+    return log_prob - total_log_prob
+
+"""
+Normalizer Table
+
+All of our images are 8-bit grayscale, so the normalizing constant of the
+discrete truncated t over range(256) depends only on (df, loc, scale). Rather
+than summing 256 densities for every pixel on every call, the log normalizer
+is tabulated once per df on a grid of loc and log(scale), and looked up with
+cubic interpolation. Tables are kept in an LRU cache.
+
+NORMALIZER_TOLERANCE is the spacing of the loc grid, in pixel values. The
+log(scale) grid is spaced NORMALIZER_TOLERANCE / 16. Pixels whose loc or scale
+fall outside the table are computed exactly.
+"""
+NORMALIZER_DOMAIN_SIZE = 256
+NORMALIZER_TOLERANCE = 0.5
+NORMALIZER_MIN_SCALE = 2.0
+NORMALIZER_MAX_SCALE = 2048.0
+NORMALIZER_CACHE_SIZE = 64
+USE_NORMALIZER_TABLE = True
+
+normalizer_tables = OrderedDict()
+
+"""
+Function: t_log_kernel
+
+The unnormalized log density of a t distribution: the part of t.logpdf that
+depends on x.
+
+Parameters:
+x - array-like values to evaluate
+df - array-like the degrees of freedom
+loc - array-like the center point of the t distribution
+scale - array-like the scale of the t distribution
+"""
+def t_log_kernel(x, df, loc, scale):
+    z = (x - loc) / scale
+    return -0.5 * (df + 1) * log1p(z * z / df)
+
+"""
+Function: build_normalizer_table
+
+Tabulates the log normalizer of the discrete truncated t over
+range(NORMALIZER_DOMAIN_SIZE) for a single df. The grid extends one step past
+each edge so that the interpolation has neighbours everywhere inside.
+
+Parameters:
+df - the degrees of freedom
+tolerance - spacing of the loc grid
+
+Returns:
+A dict holding the table and the grid it was computed on
+"""
+def build_normalizer_table(df, tolerance):
+    top = NORMALIZER_DOMAIN_SIZE - 1.0
+    domain = arange(NORMALIZER_DOMAIN_SIZE, dtype=float).reshape((-1, 1))
+    locs = arange(-tolerance, top + 1.5 * tolerance, tolerance)
+    log_scale_step = tolerance / 16.0
+    log_scales = arange(log(NORMALIZER_MIN_SCALE) - log_scale_step,
+                        log(NORMALIZER_MAX_SCALE) + 1.5 * log_scale_step,
+                        log_scale_step)
+
+    # the normalizer is symmetric about the middle of the domain, so only
+    # compute it once for each distance from the middle
+    reduced_locs, inverse = unique(minimum(locs, top - locs), return_inverse=True)
+    table = empty((len(locs), len(log_scales)))
+    for j in range(len(log_scales)):
+        kernel = t_log_kernel(domain, df, reduced_locs, exp(log_scales[j]))
+        max_kernel = kernel.max(axis=0)
+        table[:, j] = (max_kernel + log(exp(kernel - max_kernel).sum(axis=0)))[inverse]
+
+    return {'table': table,
+            'loc_start': locs[0],
+            'loc_step': tolerance,
+            'log_scale_start': log_scales[0],
+            'log_scale_step': log_scale_step}
+
+"""
+Function: get_normalizer_table
+
+Memoized build_normalizer_table. Keeps at most NORMALIZER_CACHE_SIZE tables,
+evicting the least recently used.
+"""
+def get_normalizer_table(df, tolerance=None):
+    if tolerance == None:
+        tolerance = NORMALIZER_TOLERANCE
+    key = (float(df), float(tolerance))
+
+    if key in normalizer_tables:
+        # mark as most recently used
+        table = normalizer_tables.pop(key)
+    else:
+        table = build_normalizer_table(df, tolerance)
+        while len(normalizer_tables) >= NORMALIZER_CACHE_SIZE:
+            normalizer_tables.popitem(last=False)
+    normalizer_tables[key] = table
+    return table
+
+"""
+Function: cubic_weights
+
+Catmull-Rom interpolation weights for the four grid points around each
+fractional position f in [0, 1)
+"""
+def cubic_weights(f):
+    f2 = f * f
+    f3 = f2 * f
+    return [(-f3 + 2 * f2 - f) / 2,
+            (3 * f3 - 5 * f2 + 2) / 2,
+            (-3 * f3 + 4 * f2 + f) / 2,
+            (f3 - f2) / 2]
+
+"""
+Function: lookup_log_normalizer
+
+Interpolates the log normalizer for each loc and scale out of a normalizer
+table.
+
+Parameters:
+info - a table returned by get_normalizer_table
+loc - array of the center points of the t distribution
+scale - array of the scales of the t distribution, the same shape as loc
+
+Returns:
+The interpolated log normalizers and a boolean array marking which of them
+were inside the table
+"""
+def lookup_log_normalizer(info, loc, scale):
+    table = info['table']
+    rows, cols = table.shape
+
+    # fractional position of each value in the table
+    i = (loc - info['loc_start']) / info['loc_step']
+    j = (log(scale) - info['log_scale_start']) / info['log_scale_step']
+    inside = (i >= 1) & (i <= rows - 2) & (j >= 1) & (j <= cols - 2)
+
+    i0 = floor(i).clip(1, rows - 3).astype(int)
+    j0 = floor(j).clip(1, cols - 3).astype(int)
+    i_weights = cubic_weights((i - i0).clip(0, 1))
+    j_weights = cubic_weights((j - j0).clip(0, 1))
+
+    log_normalizer = zeros(loc.shape)
+    for a in range(4):
+        for b in range(4):
+            log_normalizer += i_weights[a] * j_weights[b] * table[i0 + a - 1, j0 + b - 1]
+
+    return log_normalizer, inside
+
+"""
+Function: table_discrete_trunc_t_logpdf
+
+Same as fast_discrete_trunc_t_logpdf over the domain range(256), but takes the
+normalizer from the normalizer table.
+
+Parameters:
+x - array-like values to be compared, integers in range(256)
+df - the degrees of freedom. Must be a scalar
+loc - array-like the center point of the t distribution
+scale - array-like the scale of the t distribution
+tolerance - spacing of the table's loc grid. Defaults to NORMALIZER_TOLERANCE
+
+Returns:
+The log_prob for the x values
+"""
+def table_discrete_trunc_t_logpdf(x, df, loc=0, scale=1, tolerance=None):
+    x, loc, scale = broadcast_arrays(asarray(x, dtype=float),
+                                     asarray(loc, dtype=float),
+                                     asarray(scale, dtype=float))
+    if x.size > 0 and (x.min() < 0 or x.max() >= NORMALIZER_DOMAIN_SIZE or
+                       any(x != floor(x))):
+        raise ValueError("x contains values that are not in the domain")
+
+    info = get_normalizer_table(df, tolerance)
+    log_normalizer, inside = lookup_log_normalizer(info, loc, scale)
+    log_prob = t_log_kernel(x, df, loc, scale) - log_normalizer
+
+    # anything off the table is computed exactly
+    if not inside.all():
+        outside = ~inside
+        log_prob[outside] = fast_discrete_trunc_t_logpdf(x[outside], df,
+                                                         range(NORMALIZER_DOMAIN_SIZE),
+                                                         loc=loc[outside],
+                                                         scale=scale[outside])
+
+    return log_prob
+
+CLOSED_FORM_MIN_SCALE = 6.0
+CLOSED_FORM_BLOCK = 4096
+
+"""
+Function: t_kernel_derivatives
+
+The t kernel exp(t_log_kernel) and its first and third derivatives in x, at
+the standardized points z = (x - loc) / scale.
+"""
+def t_kernel_derivatives(z, df, scale):
+    p = (df + 1) / 2.0
+    u = 1 + z * z / df
+    u1 = 2 * z / df
+    u2 = 2 / df
+    g = u ** -p
+    g1 = -p * g / u * u1
+    g3 = (-p * (p + 1) * (p + 2) * g / u ** 3 * u1 ** 3 +
+          3 * p * (p + 1) * g / u ** 2 * u1 * u2)
+    return g, g1 / scale, g3 / scale ** 3
+
+"""
+Function: closed_form_log_normalizer
+
+The log normalizer of the discrete truncated t over range(256), with no table.
+The sum over the domain is the integral of the kernel (from the t cdf) plus
+Euler-Maclaurin corrections at the two ends, which is within 2e-6 of the exact
+sum once the scale is at least CLOSED_FORM_MIN_SCALE. Smaller scales are
+summed exactly. Unlike the normalizer table this costs the same for every df,
+so it suits callers that never see the same df twice.
+
+Parameters:
+df - array-like the degrees of freedom
+loc - array-like the center point of the t distribution
+scale - array-like the scale of the t distribution
+
+Returns:
+The log normalizers, broadcast to the shape of the parameters
+"""
+def closed_form_log_normalizer(df, loc, scale):
+    df, loc, scale = broadcast_arrays(asarray(df, dtype=float),
+                                      asarray(loc, dtype=float),
+                                      asarray(scale, dtype=float))
+    log_normalizer = empty(loc.shape)
+    top = NORMALIZER_DOMAIN_SIZE - 1.0
+
+    wide = scale >= CLOSED_FORM_MIN_SCALE
+    if wide.any():
+        d = df[wide]
+        s = scale[wide]
+        a = (0 - loc[wide]) / s
+        b = (top - loc[wide]) / s
+        # the cdf loses precision far into the upper tail, so intervals above
+        # the center are reflected below it
+        flip = a > 0
+        lo = where(flip, -b, a)
+        hi = where(flip, -a, b)
+        log_full = log(s) + 0.5 * log(d) + gammaln(0.5) + gammaln(d / 2) - gammaln((d + 1) / 2)
+        integral = exp(log_full) * (stdtr(d, hi) - stdtr(d, lo))
+
+        fa, fa1, fa3 = t_kernel_derivatives(a, d, s)
+        fb, fb1, fb3 = t_kernel_derivatives(b, d, s)
+        log_normalizer[wide] = log(integral + (fa + fb) / 2 + (fb1 - fa1) / 12 - (fb3 - fa3) / 720)
+
+    narrow = flatnonzero(~wide)
+    if len(narrow) > 0:
+        domain = arange(NORMALIZER_DOMAIN_SIZE, dtype=float).reshape((-1, 1))
+        flat = log_normalizer.reshape(-1)
+        for start in range(0, len(narrow), CLOSED_FORM_BLOCK):
+            block = narrow[start:start + CLOSED_FORM_BLOCK]
+            kernel = t_log_kernel(domain, df.reshape(-1)[block], loc.reshape(-1)[block],
+                                  scale.reshape(-1)[block])
+            max_kernel = kernel.max(axis=0)
+            flat[block] = max_kernel + log(exp(kernel - max_kernel).sum(axis=0))
+        log_normalizer = flat.reshape(loc.shape)
+
+    return log_normalizer
+
+"""
+Function: closed_form_discrete_trunc_t_logpdf
+
+Same as fast_discrete_trunc_t_logpdf over the domain range(256), but takes the
+normalizer from closed_form_log_normalizer. Every parameter may be an array.
+x is not checked against the domain.
+"""
+def closed_form_discrete_trunc_t_logpdf(x, df, loc=0, scale=1):
+    return t_log_kernel(x, df, loc, scale) - closed_form_log_normalizer(df, loc, scale)
+
+"""
+Class: GroupStatistics
+
+Keeps running sufficient statistics (count, sum and sum of squares of the
+image matrices) for every group of a partition, so that group means and
+variances can be read off without restacking the member images. Moving one
+image between groups costs O(pixels) instead of O(n * pixels).
+
+Parameters:
+partition - optional partition to initialize the statistics from. Is a dict
+where each key is an image ID, and each value is the group number that image
+is in
+"""
+class GroupStatistics(object):
+    def __init__(self, partition=None):
+        self.assignments = {}
+        self.counts = {}
+        self.sums = {}
+        self.sums_sq = {}
+        if partition:
+            for image_id, group in partition.iteritems():
+                self.add(image_id, group)
+
+    """
+    Method: add
+    Adds an image that is not yet in the statistics to a group
+    """
+    def add(self, image_id, group):
+        image_id = str(image_id)
+        image_matrix = get_image_matrix(image_id)
+        if self.counts.get(group, 0) == 0:
+            self.counts[group] = 0
+            self.sums[group] = zeros(image_matrix.shape)
+            self.sums_sq[group] = zeros(image_matrix.shape)
+        self.counts[group] += 1
+        self.sums[group] += image_matrix
+        self.sums_sq[group] += square(image_matrix, dtype=float)
+        self.assignments[image_id] = group
+
+    """
+    Method: remove
+    Removes an image from whatever group it is in
+    """
+    def remove(self, image_id):
+        image_id = str(image_id)
+        group = self.assignments.pop(image_id)
+        self.counts[group] -= 1
+        if self.counts[group] == 0:
+            # start the group over so rounding errors don't build up
+            del self.counts[group]
+            del self.sums[group]
+            del self.sums_sq[group]
+        else:
+            image_matrix = get_image_matrix(image_id)
+            self.sums[group] -= image_matrix
+            self.sums_sq[group] -= square(image_matrix, dtype=float)
+
+    """
+    Method: move
+    Moves an image to a group, whether or not it was already in one
+    """
+    def move(self, image_id, group):
+        image_id = str(image_id)
+        if image_id in self.assignments:
+            if self.assignments[image_id] == group:
+                return
+            self.remove(image_id)
+        self.add(image_id, group)
+
+    """
+    Method: sync
+    Updates the statistics to match partition. Only images whose group
+    differs are touched, so this is cheap when the two already agree.
+    """
+    def sync(self, partition):
+        partition_ids = set(str(image_id) for image_id in partition)
+        for image_id in self.assignments.keys():
+            if image_id not in partition_ids:
+                self.remove(image_id)
+        for image_id, group in partition.iteritems():
+            self.move(image_id, group)
+
+    """
+    Method: summary
+    Returns the number of images in group, and the mean and variance matrices
+    of those images. The mean and variance are 0 for an empty group.
+    """
+    def summary(self, group):
+        n = self.counts.get(group, 0)
+        if n == 0:
+            return 0, 0, 0
+        group_mean = self.sums[group] / n
+        group_var = (self.sums_sq[group] / n - group_mean ** 2).clip(0, None)
+        return n, group_mean, group_var
+
 """
 Function: log_likelihood
 
@@ -162,33 +631,41 @@ Parameters:
 current_partition - the current partitioning of the other images
 group_num - the group that the current image would be assigned to
 move - the move dict holding the information about the current move
+group_stats - optional GroupStatistics matching current_partition. If not given, the statistics for group_num are computed from scratch
 """
-def log_likelihood(current_partition, group_num, image_id, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0):
-    # the images grouped so far
-    images = images_in_group(current_partition, group_num)
+def log_likelihood(current_partition, group_num, image_id, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, group_stats=None):
+    # statistics for the images grouped so far
+    if group_stats == None:
+        images = images_in_group(current_partition, group_num)
+        group_stats = GroupStatistics(dict((image, group_num) for image in images))
 
-    # matrix for image
-    image_matrix = get_image_matrix(image_id)
+    return batch_log_likelihood(group_stats, [group_num], image_id, prior_mean, mean_conf, prior_var, var_conf)[0]
 
-    # number of images
-    n = len(images)
+"""
+Function: batch_log_likelihood
 
-    if n > 0:
-        # get the shape for the group
-        image_shape = image_matrix.shape
-        shape = (n, image_shape[0], image_shape[0])
+Calculates log_likelihood for several groups at once. The posterior predictive
+parameters for all of the groups are computed as one stacked (groups x pixels)
+array, and the image is evaluated against all of them together.
 
-        # get the matricies for all the images in the group
-        group = empty(shape)
-        for i in range(n):
-            group[i] = get_image_matrix(images[i])
+Parameters:
+group_stats - GroupStatistics for the current partition
+groups - list of the groups that the current image could be assigned to
+image_id - the id of the image being placed
 
-        # get mean, variance matrix
-        group_mean = mean(group, axis=0)
-        group_var = var(group, axis=0)
-    else:
-        group_mean = 0
-        group_var = 0
+Returns:
+Array of the log likelihood of the image under each group, in the order of groups
+"""
+def batch_log_likelihood(group_stats, groups, image_id, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0):
+    # matrix for image
+    image_matrix = get_image_matrix(image_id)
+
+    # stack the statistics of each group
+    summaries = [group_stats.summary(group) for group in groups]
+    n = array([summary[0] for summary in summaries], dtype=float)
+    n = n.reshape((len(groups),) + (1,) * image_matrix.ndim)
+    group_mean = array([summary[1] + zeros(image_matrix.shape) for summary in summaries])
+    group_var = array([summary[2] + zeros(image_matrix.shape) for summary in summaries])
 
     # calculate the parameters of the student_t distribution
     l = mean_conf + n
@@ -198,11 +675,45 @@ def log_likelihood(current_partition, group_num, image_id, prior_mean=mu0, mean_
               mean_conf * n * (prior_mean - group_mean) ** 2 / l) / a
     scale = sqrt(sig_sq * (1 + 1 / l))
 
-    # calculate the log probability over each dimension
-    # from timing this takes about 0.09 sec
-    log_p = discrete_trunc_t_logpdf(image_matrix, a, range(256), loc=mu, scale=scale)
+    # calculate the log probability over each dimension. Groups with the same
+    # number of images share a df, and so a normalizer table
+    log_p = empty(mu.shape)
+    for df in unique(a):
+        same_df = a.ravel() == df
+        if USE_NORMALIZER_TABLE:
+            log_p[same_df] = table_discrete_trunc_t_logpdf(image_matrix, df, loc=mu[same_df],
+                                                           scale=scale[same_df])
+        else:
+            log_p[same_df] = fast_discrete_trunc_t_logpdf(image_matrix, df, range(256),
+                                                          loc=mu[same_df], scale=scale[same_df])
+
+    return log_p.reshape((len(groups), -1)).sum(axis=1)
 
-    return sum(log_p)
+"""
+Function: candidate_groups
+The groups an image could be moved into: every group in the partition, plus
+one empty group. That is new_group if it is new, or otherwise the lowest
+unused group below 8.
+
+Parameters:
+current_partition - the current partition of the images into groups
+new_group - the group the image was actually moved to, or None
+
+Returns:
+A list of group numbers
+"""
+def candidate_groups(current_partition, new_group):
+    groups = groups_in_partition(current_partition)
+    if new_group != None and new_group not in groups:
+        # if the move moves the image into a new group, add that group to groups.
+        groups.append(new_group)
+    else:
+        # otherwise, add the minimum val less than 8 to groups
+        for i in range(8):
+            if i not in groups:
+                groups.append(i)
+                break
+    return groups
 
 """
 Function: move_probability
@@ -215,29 +726,28 @@ move - dict of the move being made. Same form as in db
 
 current_partition - representation of the current partition fo the images.  Is a dict where each key is an image ID, and each value is the group number that image is in
 move - the move object being used in calculation
+group_stats - optional GroupStatistics for the partition, reused across calls. It is synced to current_partition before use
 
 Returns:
 The probability of the move
 """
-def move_probability(current_partition, move, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, dispersion=DISPERSION_PARAMETER):
+def move_probability(current_partition, move, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, dispersion=DISPERSION_PARAMETER, group_stats=None):
+    if group_stats == None:
+        group_stats = GroupStatistics(current_partition)
+    else:
+        group_stats.sync(current_partition)
+
     image_id = move['image_id']
     newGroup = move['new_group']
     moveProbabilities = {}
-    groups = groups_in_partition(current_partition)
-    if newGroup != None and newGroup not in groups:
-        # if the move moves the image into a new group, add that group to groups.
-        groups.append(newGroup)
-    else:
-        # otherwise, add the minimum val less than 8 to groups
-        for i in range(8):
-            if i not in groups:
-                groups.append(i)
-                break
+    groups = candidate_groups(current_partition, newGroup)
+
+    # calculate the likelihood of the image under every group in one pass
+    likelihoods = batch_log_likelihood(group_stats, groups, image_id, prior_mean, mean_conf, prior_var, var_conf)
 
     # for each of the groups in groups, calculate the probability of that one being selected
-    for group in groups:
+    for group, likelihood in zip(groups, likelihoods):
         # the probability of a given move is the likelihood times the prior given the move that happened and all prior data
-        likelihood = log_likelihood(current_partition, group, image_id, prior_mean, mean_conf, prior_var, var_conf)
         prior = log_prior(current_partition, group, dispersion)
         moveProbabilities[group] = likelihood + prior
 
@@ -250,21 +760,148 @@ def move_probability(current_partition, move, prior_mean=mu0, mean_conf=l0, prio
     print "Move probs are: ", moveProbabilities
     return moveProbabilities
 
+LIKELIHOOD_CACHE_SIZE = 64
+
 """
-Function: compare_trial
-Compares the moves in a trial to the moves that a particle filter would have made
+Class: MoveLikelihoodState
+
+Everything about a single move that does not depend on the model parameters:
+the moved image, the groups it could go to, their stacked sufficient
+statistics and the group sizes the prior needs. These are computed once, so a
+sampler that tries many parameter values for the same move only pays for the
+t densities, and evaluates a whole batch of K parameter settings in one
+vectorized call. The likelihoods of the last LIKELIHOOD_CACHE_SIZE settings
+are kept, so changing only the dispersion never recomputes them.
 
 Parameters:
-trial_id - the ObjectId of the trial to analyze
-move_probability - a function for calculating the probability of a given move.  Takes arguments of current_partition and move, where current_partition is a dict of image_id to group number, and move is a dict for a move
+current_partition - the current partition of the images into groups
+move - the move object being used in this calculation
+group_stats - optional GroupStatistics for the partition. It is synced to current_partition before use
+"""
+class MoveLikelihoodState(object):
+    def __init__(self, current_partition, move, group_stats=None):
+        if group_stats == None:
+            group_stats = GroupStatistics(current_partition)
+        else:
+            group_stats.sync(current_partition)
+
+        self.groups = candidate_groups(current_partition, move.get('new_group'))
+        image_matrix = get_image_matrix(move['image_id'])
+        self.image = image_matrix.reshape(-1).astype(float)
+
+        summaries = [group_stats.summary(group) for group in self.groups]
+        self.n = array([summary[0] for summary in summaries], dtype=float).reshape((-1, 1))
+        self.group_mean = array([(summary[1] + zeros(image_matrix.shape)).reshape(-1)
+                                 for summary in summaries])
+        self.group_var = array([(summary[2] + zeros(image_matrix.shape)).reshape(-1)
+                                for summary in summaries])
+        self.num_images = len(current_partition)
+        self.likelihood_cache = OrderedDict()
+        # the column of the group the human chose
+        self.choice = None
+        if move.get('new_group') != None:
+            self.choice = self.group_index(move['new_group'])
+
+    """
+    Method: group_index
+    The column of group in the arrays returned by the other methods
+    """
+    def group_index(self, group):
+        return self.groups.index(group)
+
+    """
+    Method: log_likelihoods
+    The log likelihood of the image under every group, for K parameter
+    settings. Each parameter is a scalar or an array of K values.
+
+    Returns:
+    A (K x groups) array
+    """
+    def log_likelihoods(self, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0):
+        settings = broadcast_arrays(atleast_1d(asarray(prior_mean, dtype=float)),
+                                    atleast_1d(asarray(mean_conf, dtype=float)),
+                                    atleast_1d(asarray(prior_var, dtype=float)),
+                                    atleast_1d(asarray(var_conf, dtype=float)))
+        keys = zip(*[values.tolist() for values in settings])
+        missing = sorted(set(key for key in keys if key not in self.likelihood_cache))
+
+        if missing:
+            # evaluate the new settings together, as (K x groups x pixels)
+            prior_mean, mean_conf, prior_var, var_conf = [array(values).reshape((-1, 1, 1))
+                                                          for values in zip(*missing)]
+            n = self.n
+            l = mean_conf + n
+            a = var_conf + n
+            mu = (mean_conf * prior_mean + n * self.group_mean) / l
+            sig_sq = (var_conf * prior_var + (n - 1) * self.group_var +
+                      mean_conf * n * (prior_mean - self.group_mean) ** 2 / l) / a
+            scale = sqrt(sig_sq * (1 + 1 / l))
+            log_p = closed_form_discrete_trunc_t_logpdf(self.image, a, mu, scale).sum(axis=2)
+
+            for key, row in zip(missing, log_p):
+                self.likelihood_cache[key] = row
+
+        rows = array([self.likelihood_cache[key] for key in keys])
+        # mark the settings just used as most recently used, then evict
+        for key in set(keys):
+            self.likelihood_cache[key] = self.likelihood_cache.pop(key)
+        while len(self.likelihood_cache) > LIKELIHOOD_CACHE_SIZE:
+            self.likelihood_cache.popitem(last=False)
+        return rows
+
+    """
+    Method: log_priors
+    log_prior for every group, for K values of the dispersion
+
+    Returns:
+    A (K x groups) array
+    """
+    def log_priors(self, dispersion=DISPERSION_PARAMETER):
+        dispersion = atleast_1d(asarray(dispersion, dtype=float)).reshape((-1, 1))
+        sizes = self.n.reshape((1, -1))
+        numerator = where(sizes == 0, dispersion, sizes + 1)
+        return log(numerator / (self.num_images - 1.0 + dispersion))
+
+    """
+    Method: log_move_probs
+    The normalized log probability of moving the image into every group, for
+    K parameter settings. Matches move_probability, up to the accuracy of
+    closed_form_log_normalizer.
+
+    Returns:
+    A (K x groups) array
+    """
+    def log_move_probs(self, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, dispersion=DISPERSION_PARAMETER):
+        log_probs = (self.log_likelihoods(prior_mean, mean_conf, prior_var, var_conf) +
+                     self.log_priors(dispersion))
+        return log_probs - logaddexp.reduce(log_probs, axis=1).reshape((-1, 1))
+
+    """
+    Method: log_target
+    The log probability of the group the human chose, for K parameter
+    settings. This is what the parameter samplers and optimizers maximize.
+
+    Returns:
+    An array of K values
+    """
+    def log_target(self, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, dispersion=DISPERSION_PARAMETER):
+        return self.log_move_probs(prior_mean, mean_conf, prior_var, var_conf, dispersion)[:, self.choice]
 
-Returns:
-Move objects (as described in readme) augmented with move_probs, a dictionary of group-probability pairs, and partition, a dictionary of image_id-group pairs.
 """
-def compare_trial(trial_id, move_probability):
-    # get the trial
-    trial = db.get_trial(trial_id)
+Function: replay_trial
+Steps through the moves of a trial, keeping track of the partition the human
+had built before each one.
 
+Parameters:
+trial - the trial document
+
+Returns:
+A generator over (move number, move, current_partition, group_stats) for each
+move, where current_partition and group_stats are as they were before the move
+was made. They are updated once the next item is asked for, so copy
+current_partition to keep it.
+"""
+def replay_trial(trial):
     # list of the images initially currently grouped
     initial_images = [x for x in trial['init_state'] if x['group'] != -1]
 
@@ -275,167 +912,449 @@ def compare_trial(trial_id, move_probability):
         image_id = str(image['_id'])
         current_partition[image_id] = image['group']
 
-    moveNum = -1
+    # running group statistics, updated alongside current_partition
+    group_stats = GroupStatistics(current_partition)
+
+    for moveNum, move in enumerate(trial['moves']):
+        yield moveNum, move, current_partition, group_stats
+
+        # update the current partition
+        current_partition[move['image_id']] = move['new_group']
+        group_stats.move(move['image_id'], move['new_group'])
+
+"""
+Function: compare_trial
+Compares the moves in a trial to the moves that a particle filter would have made
+
+Parameters:
+trial_id - the ObjectId of the trial to analyze
+move_probability - a function for calculating the probability of a given move.  Takes arguments of current_partition and move, where current_partition is a dict of image_id to group number, and move is a dict for a move, and a group_stats keyword argument holding the GroupStatistics for current_partition
+
+Returns:
+Move objects (as described in readme) augmented with move_probs, a dictionary of group-probability pairs, and partition, a dictionary of image_id-group pairs.
+"""
+def compare_trial(trial_id, move_probability):
+    # get the trial
+    trial = db.get_trial(trial_id)
+
     totalMoveNum = len(trial['moves']);
     # iterate over each move in the trial
-    for move in trial['moves']:
-        moveNum += 1
+    for moveNum, move, current_partition, group_stats in replay_trial(trial):
         print "\tRunning move", moveNum, "of", totalMoveNum
 
         # calculate the normalized log probability of each potential move according to the particle filter
         if moveNum > 0:
-            probs = move_probability(current_partition, move)
+            probs = move_probability(current_partition, move, group_stats=group_stats)
 
             # augment the move object
             move['move_results'] = probs
-            move['partition'] = copy(current_partition)
+            move['partition'] = dict(current_partition)
             move['likelihood'] = probs[move['new_group']];
         else:
             move['move_results'] = {0:0.0}
-            move['partition'] = copy(current_partition)
+            move['partition'] = dict(current_partition)
             move['likelihood'] = 0.0;
 
         print "\tFound likelihood:", move['likelihood'];
-        # update the current partition
-        current_partition[move['image_id']] = move['new_group']
 
     return trial
 
 """
-Function: run_all_trials
-Gathers all trial ids from the database and runs them all through compare_trial, saving the results out into a file.
+Function: fit_trial_params
+Fits the model parameters to each move of a trial, as compare_trial does for
+move probabilities.
+
+Parameters:
+trial_id - the ObjectId of the trial to fit
+fit - a function taking current_partition, move and a group_stats keyword
+argument, like find_params_for_move or find_params_with_chains
+
+Returns:
+The trial, with each move augmented with params, whatever fit returned for it,
+and partition. The first move is not fit, since there is nothing to compare it
+to, and has params None.
+"""
+def fit_trial_params(trial_id, fit):
+    trial = db.get_trial(trial_id)
+
+    totalMoveNum = len(trial['moves'])
+    for moveNum, move, current_partition, group_stats in replay_trial(trial):
+        print "\tFitting move", moveNum, "of", totalMoveNum
+        move['partition'] = dict(current_partition)
+        if moveNum > 0:
+            move['params'] = fit(current_partition, move, group_stats=group_stats)
+        else:
+            move['params'] = None
+
+    return trial
+
+"""
+Function: analyze_trial
+Runs a single trial through compare_trial with move_probability and cleans it
+so that it is serializable. This is the unit of work handed to each worker
+process by run_trials. Each worker keeps its own image_matrices and
+normalizer_tables, so the caches warm up over the trials a worker is given.
+
+Parameters:
+trial_id - the ObjectId of the trial to analyze
+
+Returns:
+A tuple of the augmented trial, the id of the process that ran it, and the
+time it took in seconds
 """
+def analyze_trial(trial_id):
+    print "Runnning trial", trial_id
+    startTime = time.time()
+    trial = clean_trial(compare_trial(trial_id, move_probability))
 
-def run_all_trials():
-    # runs all the trials and writes out all data into a json string saved to results.json
-    trials = db.get_all_trials()
-    trialsData = {}
+    return trial, os.getpid(), time.time() - startTime
+
+"""
+Function: run_trials
+Runs all of the given trials through analyze_trial, either in this process or
+spread over a pool of worker processes. Augmented trials are yielded in the
+same order as trials as soon as they are ready, so the output is the same
+however many workers are used, and nothing is held on to after it is yielded.
+
+Parameters:
+trials - iterable of trial documents to analyze. Only their _id and moves are
+used, so they can be streamed with TRIAL_LISTING_FIELDS
+workers - the number of processes to run trials on. 1 runs them in this process
 
+Returns:
+A generator over the augmented trials
+"""
+def run_trials(trials, workers=1):
     # bits and pieces to let us print out something interesting
-    trialNum = 0
-    totalTrialNum = len(trials)
     times = []
     smallTrials = {};
+    workerStats = {}
 
-    # the main loop that analyzes each trial also check time to run and whether the trial is shorter than expected
+    # the workers fetch each trial themselves, so only the ids are kept
+    trial_ids = []
     for trial in trials:
         if len(trial['moves']) < 40:
             smallTrials[trial["_id"]] = len(trial['moves']);
-        startTime = time.time()
-        print "Runnning trial", trialNum, "of", totalTrialNum
-
-        trial = compare_trial(trial["_id"], move_probability)
+        trial_ids.append(trial['_id'])
+    totalTrialNum = len(trial_ids)
 
-        # clean the trial so that it is serializable
-        trial['_id'] = str(trial['_id'])
-        trial['image_set'] = str(trial['image_set'].id)
-        trial.pop('init_state')
-
-        endTime = time.time()
-        totalTime = endTime - startTime
-        print "Completed trial", trialNum, "in", totalTime, "seconds"
-        print ""
-        times.append(totalTime)
-        trialNum += 1
+    startTime = time.time()
+    if workers > 1:
+        pool = Pool(workers)
+        analyzed = pool.imap(analyze_trial, trial_ids)
+    else:
+        pool = None
+        analyzed = imap(analyze_trial, trial_ids)
+
+    # the main loop that hands back each trial as it completes
+    try:
+        trialNum = 0
+        for trial, pid, totalTime in analyzed:
+            print "Completed trial", trialNum, "of", totalTrialNum, "in", totalTime, "seconds"
+            print ""
+            times.append(totalTime)
+            count, busy = workerStats.get(pid, (0, 0.0))
+            workerStats[pid] = (count + 1, busy + totalTime)
+            trialNum += 1
+            yield trial
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+    wallTime = time.time() - startTime
 
     # print out some information about the calculation
     print "Done!"
-    print "Average time per trial: ", sum(times)/totalTrialNum, "seconds"
+    if totalTrialNum > 0:
+        print "Average time per trial: ", sum(times)/totalTrialNum, "seconds"
+    print "Total time:", wallTime, "seconds with", workers, "worker(s)"
+    for pid, (count, busy) in sorted(workerStats.iteritems()):
+        print "\tWorker", pid, "ran", count, "trials in", busy, "seconds (", count / max(busy, 1e-6), "trials/sec )"
     print "The following trials were smaller than expected: "
     for key, value in smallTrials.iteritems():
         print "\tTrial", key, "with", value, "moves"
 
-    # find a results file that does not yet exist
-    base = "./results"
-    name = base
-    number = 0
-    while os.path.exists(name + ".json"):
-        name = base + str(number)
-        number += 1
-    print "Saving results in", name, ".json"
-    f = open(name + ".json", 'w')
-    json.dump(trials, f)
-    f.close()
+"""
+Function: clean_trial
+Cleans an augmented trial so that it is serializable: replaces the ObjectId and
+DBRef with strings and drops the initial state.
+"""
+def clean_trial(trial):
+    trial['_id'] = str(trial['_id'])
+    trial['image_set'] = str(trial['image_set'].id)
+    trial.pop('init_state', None)
+    return trial
 
-def run_all_turk_trials():
-    # runs all the trials and writes out all data into a json string saved to results.json
-    trials = db.get_all_turk_trials()
-    trialsData = {}
+"""
+Function: json_default
+Serializes the values json can't handle by itself: ObjectIds and DBRefs become
+id strings, numpy arrays become lists, and numpy scalars become numbers.
+"""
+def json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, DBRef):
+        return str(obj.id)
+    if isinstance(obj, ndarray):
+        return obj.tolist()
+    if isinstance(obj, generic):
+        return obj.item()
+    raise TypeError(repr(obj) + " is not JSON serializable")
 
-    # bits and pieces to let us print out something interesting
-    trialNum = 0
-    totalTrialNum = len(trials)
-    times = []
-    smallTrials = {};
+"""
+Function: model_config
+The parameter configuration that results are computed with. Saved with every
+trial written to a results file, so a resumed run only skips trials that were
+computed the same way.
 
-    # the main loop that analyzes each trial also check time to run and whether the trial is shorter than expected
-    for trial in trials:
-        if len(trial['moves']) < 40:
-            smallTrials[trial["_id"]] = len(trial['moves']);
-        startTime = time.time()
-        print "Runnning trial", trialNum, "of", totalTrialNum
+Parameters:
+mode - the name of the function used to analyze each move
+chains - the number of chains, for find_params_with_chains
+pooled_by - how trials are grouped, for fit_pooled_params
+method - the fitting method, for fit_pooled_params
+"""
+def model_config(mode='move_probability', chains=None, pooled_by=None, method=None):
+    config = {'mode': mode,
+              'prior_mean': mu0,
+              'mean_conf': l0,
+              'prior_var': sig_sq0,
+              'var_conf': a0,
+              'dispersion': DISPERSION_PARAMETER}
+    if mode == 'find_params_for_move':
+        config['walk_in'] = walk_in
+        config['samples'] = samples
+        config['proposals'] = PARAM_PROPOSALS
+    if mode == 'fit_pooled_params':
+        config['pooled_by'] = pooled_by
+        config['method'] = method
+        if method == 'chains':
+            chains = CHAINS
+        else:
+            config['map_step'] = MAP_STEP
+            config['map_max_evals'] = MAP_MAX_EVALS
+    if mode == 'find_params_with_chains' or method == 'chains':
+        config['chains'] = chains
+        config['chain_block'] = CHAIN_BLOCK
+        config['max_sweeps'] = CHAIN_MAX_SWEEPS
+        config['rhat_threshold'] = RHAT_THRESHOLD
+        config['min_ess'] = MIN_ESS
+        config['proposals'] = PARAM_PROPOSALS
+    return config
 
-        trial = compare_trial(trial["_id"], move_probability)
+"""
+Function: config_key
+A string that is the same for two equal configurations, including after a
+round trip through json.
+"""
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
 
-        # clean the trial so that it is serializable
-        trial['_id'] = str(trial['_id'])
-        trial['image_set'] = str(trial['image_set'].id)
-        trial.pop('init_state')
+"""
+Function: completed_trials
+Finds the trials already in a results file. If the last line was only partly
+written, because the run that wrote it was killed, it is cut off so that the
+trial is run again.
 
-        # print out something interesting
-        endTime = time.time()
-        totalTime = endTime - startTime
-        print "Completed trial", trialNum, "in", totalTime, "seconds"
-        print ""
-        times.append(totalTime)
-        trialNum += 1
+Parameters:
+path - the results file. Does not need to exist
+config - only trials computed with this configuration are counted
 
-    # print out some information about the calculation
-    print "Done!"
-    print "Average time per trial: ", sum(times)/totalTrialNum, "seconds"
-    print "The following trials were smaller than expected: "
-    for key, value in smallTrials.iteritems():
-        print "\tTrial", key, "with", value, "moves"
+Returns:
+A set of the string ids of the completed trials
+"""
+def completed_trials(path, config):
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    key = config_key(config)
+    f = open(path, 'r+')
+    end = 0
+    for line in f:
+        if not line.endswith("\n"):
+            break
+        end += len(line)
+        trial = json.loads(line)
+        if config_key(trial.get('config')) == key:
+            completed.add(trial['_id'])
+    f.truncate(end)
+    f.close()
+
+    return completed
+
+"""
+Function: open_results
+Opens a results file for writing.
+
+Parameters:
+path - a results file to add to. If not given, the first results<N>.jsonl file
+that does not yet exist is created
+"""
+def open_results(path=None):
+    if path != None:
+        print "Adding results to", path
+        return open(path, 'a')
 
     # find a results file that does not yet exist
     base = "./results"
     name = base
     number = 0
-    while os.path.exists(name + ".json"):
+    while os.path.exists(name + ".jsonl"):
         name = base + str(number)
         number += 1
-    print "Saving results in", name, ".json"
-    f = open(name + ".json", 'w')
-    json.dump(trials, f)
+    print "Saving results in", name + ".jsonl"
+    return open(name + ".jsonl", 'w')
+
+"""
+Function: write_result
+Writes one trial to a results file as a single line of json, and flushes it to
+disk so that a crash loses at most the trial being worked on.
+
+Parameters:
+f - the open results file
+trial - the augmented trial to write
+"""
+def write_result(f, trial):
+    f.write(json.dumps(trial, default=json_default) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+"""
+Function: save_trials
+Runs trials through run_trials and writes each one to a results file as it
+completes, along with the configuration it was computed with. When adding to
+an existing results file, trials that it already holds for the same
+configuration are skipped, so an interrupted run can be restarted where it
+left off.
+
+Parameters:
+trials - iterable of trial documents to analyze
+workers - the number of processes to run trials on
+results_path - a results file to resume. If not given, a new one is created
+"""
+def save_trials(trials, workers=1, results_path=None):
+    config = model_config()
+    if results_path != None:
+        completed = completed_trials(results_path, config)
+        trials = (trial for trial in trials if str(trial['_id']) not in completed)
+        print "Skipping", len(completed), "trials already in", results_path
+
+    f = open_results(results_path)
+    for trial in run_trials(trials, workers):
+        trial['config'] = config
+        write_result(f, trial)
     f.close()
 
+"""
+Function: merge_results
+Merges several results files into one. Each trial is kept once for each
+configuration it was computed with, taking the first copy found.
+
+Parameters:
+paths - the results files to merge
+out_path - the file to write the merged results to
+
+Returns:
+The number of trials written
+"""
+def merge_results(paths, out_path):
+    seen = set()
+    out = open(out_path, 'w')
+    for path in paths:
+        f = open(path, 'r')
+        for line in f:
+            # skip anything left partly written by a crash
+            if not line.endswith("\n"):
+                continue
+            trial = json.loads(line)
+            key = (trial['_id'], config_key(trial.get('config')))
+            if key not in seen:
+                seen.add(key)
+                out.write(line)
+        f.close()
+    out.close()
+
+    print "Merged", len(seen), "trials into", out_path
+    return len(seen)
+
+# the fields of each trial the drivers need to list the trials: the id, and
+# enough of each move to count them. compare_trial fetches the whole trial
+TRIAL_LISTING_FIELDS = {'moves.image_id': 1}
+
+"""
+Function: run_all_trials
+Gathers all trial ids from the database and runs them all through compare_trial, saving the results out into a file.
+
+Parameters:
+workers - the number of processes to run trials on
+results_path - a results file to resume. If not given, a new one is created
+"""
+def run_all_trials(workers=1, results_path=None):
+    # runs all the trials and writes out each one as a line of json in results.jsonl
+    trials = db.iter_trials(fields=TRIAL_LISTING_FIELDS)
+    save_trials(trials, workers, results_path)
+
+"""
+Function: run_all_turk_trials
+Same as run_all_trials, but only for the mechanical turk trials with 40 moves.
+
+Parameters:
+workers - the number of processes to run trials on
+results_path - a results file to resume. If not given, a new one is created
+"""
+def run_all_turk_trials(workers=1, results_path=None):
+    trials = db.iter_turk_trials(fields=TRIAL_LISTING_FIELDS)
+    save_trials(trials, workers, results_path)
+
 """
 Function: run_all_trials_for_params
-Gathers all trial ids from the database and runs them all through compare_trial, saving the results out into a file. This function finds the best parameters for each move, rather than the likelihood of the human move.
+Gathers all trial ids from the database and runs them all through fit_trial_params, saving the results out into a file. This function finds the best parameters for each move, rather than the likelihood of the human move.
 
-This method now runs each child through compare_trial with find_params_for_move, rather than move_probability.
+Each move is fit with find_params_for_move, or with find_params_with_chains if chains is given.
+
+Parameters:
+results_path - a results file to resume. If not given, a new one is created
+chains - optional number of chains to run per move
+workers - the number of processes to run the chains of each move on
 """
-def run_all_trials_for_params():
-    # runs all the trials and writes out all data into a json string saved to results.json
-    trials = db.get_all_trials()
-    trialsData = {}
-    for trial in trials:
-        trial = compare_trial(trial['_id'], find_params_for_move)
-    # find a results file that does not yet exist
-    base = "./results"
-    name = base
-    number = 0
-    while os.path.exists(name + ".json"):
-        name = base + str(number)
-        number += 1
-    f = open(name + ".json", 'w')
-    json.dump(trials, f)
-    f.close()
+def run_all_trials_for_params(results_path=None, chains=None, workers=1):
+    # runs all the trials and writes out each one as a line of json in results.jsonl
+    pool = None
+    if chains != None:
+        # the chains of each move are spread over the workers
+        config = model_config('find_params_with_chains', chains)
+        if workers > 1:
+            pool = Pool(workers)
+        fit = lambda current_partition, move, group_stats: find_params_with_chains(
+            current_partition, move, group_stats=group_stats, chains=chains, pool=pool)
+    else:
+        config = model_config('find_params_for_move')
+        fit = find_params_for_move
+    completed = set()
+    if results_path != None:
+        completed = completed_trials(results_path, config)
+
+    # the ids are read up front, as fitting them takes far longer than the
+    # server keeps an idle cursor open
+    trial_ids = [trial['_id'] for trial in db.iter_trials(fields={'_id': 1})
+                 if str(trial['_id']) not in completed]
+
+    f = open_results(results_path)
+    try:
+        for trial_id in trial_ids:
+            trial = clean_trial(fit_trial_params(trial_id, fit))
+            trial['config'] = config
+            write_result(f, trial)
+    finally:
+        f.close()
+        if pool != None:
+            pool.terminate()
+            pool.join()
     
 def run_trial_for_params(trial_id):
     trial = db.get_trial(trial_id);
     print "Starting...";
-    trial = compare_trial(trial['_id'], find_params_for_move);
+    trial = fit_trial_params(trial['_id'], find_params_for_move);
     print "Done!"
 
 """
@@ -460,13 +1379,13 @@ Gibbs Sampling Functions
 These functions sample the various parameters of our particle filter model for the gibbs sampler.
 """
 
-def sample_mu(current_partition, move, time_elapsed, params):
+def sample_mu(current_partition, move, time_elapsed, params, group_stats=None):
     group = move['new_group'];
     # new random mu
     new_mu = truncnorm.rvs((0.0-params[0])/10.0, (255.0-params[0])/10.0, params[0], 10.0) # pretty random...
     # sample both probs
-    mu_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], params[3], params[4])[group]
-    new_mu_log_prob = move_probability(current_partition, move, new_mu, params[1], params[2], params[3], params[4])[group]
+    mu_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], params[3], params[4], group_stats=group_stats)[group]
+    new_mu_log_prob = move_probability(current_partition, move, new_mu, params[1], params[2], params[3], params[4], group_stats=group_stats)[group]
     diff = exp(new_mu_log_prob - mu_log_prob)
     # choose one
     prob = mu_log_prob
@@ -475,13 +1394,13 @@ def sample_mu(current_partition, move, time_elapsed, params):
         prob = new_mu_log_prob
     return [params, prob]
 
-def sample_mu_conf(current_partition, move, time_elapsed, params, last_probs):
+def sample_mu_conf(current_partition, move, time_elapsed, params, last_probs, group_stats=None):
     group = move['new_group'];
     # new random mu_conf
     new_mu_conf = truncnorm.rvs((0.0-params[1])/4.0, (500.0-params[1])/4.0, params[1], 4.0) # pretty random...
     # sample both probs
 
-    all_new_mu_conf_log_prob = move_probability(current_partition, move, params[0], new_mu_conf, params[2], params[3], params[4])
+    all_new_mu_conf_log_prob = move_probability(current_partition, move, params[0], new_mu_conf, params[2], params[3], params[4], group_stats=group_stats)
     mu_conf_log_prob = last_probs[group]
     new_mu_conf_log_prob = all_new_mu_conf_log_prob[group]
 
@@ -497,13 +1416,13 @@ def sample_mu_conf(current_partition, move, time_elapsed, params, last_probs):
         prob = new_mu_conf_log_prob
     return [params, prob, all_probs]
 
-def sample_var(current_partition, move, time_elapsed, params):
+def sample_var(current_partition, move, time_elapsed, params, group_stats=None):
     group = move['new_group'];
     # new random var
     new_var = truncnorm.rvs((0.0-params[2])/8.0, (256.0*256.0-params[2])/8.0, params[1], 8.0) # pretty random...
     # sample both probs
-    var_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], params[3], params[4])[group]
-    new_var_log_prob = move_probability(current_partition, move, params[0], params[1], new_var, params[3], params[4])[group]
+    var_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], params[3], params[4], group_stats=group_stats)[group]
+    new_var_log_prob = move_probability(current_partition, move, params[0], params[1], new_var, params[3], params[4], group_stats=group_stats)[group]
     diff = new_var_log_prob - var_log_prob
     # choose one
     prob = var_log_prob
@@ -512,13 +1431,13 @@ def sample_var(current_partition, move, time_elapsed, params):
         prob = new_var_log_prob
     return [params, prob]
 
-def sample_var_conf(current_partition, move, time_elapsed, params, last_probs):
+def sample_var_conf(current_partition, move, time_elapsed, params, last_probs, group_stats=None):
     group = move['new_group'];
     # new random var_conf
     new_var_conf = truncnorm.rvs((0.0-params[3])/4.0, (500.0-params[3])/4.0, params[3], 4.0) # pretty random...
 
     # sample both probs
-    all_new_var_conf_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], new_var_conf, params[4])
+    all_new_var_conf_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], new_var_conf, params[4], group_stats=group_stats)
     var_conf_log_prob = last_probs[group]
     new_var_conf_log_prob = all_new_var_conf_log_prob[group]
 
@@ -534,13 +1453,13 @@ def sample_var_conf(current_partition, move, time_elapsed, params, last_probs):
         prob = new_var_conf_log_prob
     return params, prob, all_probs
 
-def sample_disp(current_partition, move, time_elapsed, params, last_probs):
+def sample_disp(current_partition, move, time_elapsed, params, last_probs, group_stats=None):
     group = move['new_group'];
     # new random disp
     new_disp = truncnorm.rvs((0.0-params[4])/4.0, (1000.0-params[4])/4.0, params[4], 4.0) # pretty random...
 
     # sample the new probabailities
-    all_new_disp_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], params[3], new_disp)
+    all_new_disp_log_prob = move_probability(current_partition, move, params[0], params[1], params[2], params[3], new_disp, group_stats=group_stats)
     disp_log_prob = last_probs[group]
     new_disp_log_prob = all_new_disp_log_prob[group]
 
@@ -554,6 +1473,93 @@ def sample_disp(current_partition, move, time_elapsed, params, last_probs):
         prob = new_disp_log_prob
     return [params, prob, all_probs]
 
+# the order parameters are listed in, and where find_params_for_move starts
+PARAM_NAMES = ['prior_mean', 'mean_conf', 'prior_var', 'var_conf', 'dispersion']
+START_PARAMS = [255.0 / 2.0, 0.5, (256.0 / 4.0) ** 2, 10.0, 3.0]
+# proposals tried at once for each parameter in find_params_for_move
+PARAM_PROPOSALS = 4
+# index in the params list -> (proposal sd, upper bound). The lower bound is 0
+PARAM_STEPS = {1: (4.0, 500.0), # mu_conf
+               3: (4.0, 500.0), # var_conf
+               4: (4.0, 1000.0)} # dispersion
+
+"""
+Function: multiple_try_step
+One multiple-try Metropolis step for a single parameter. K proposals are drawn
+from a normal around the current value truncated to [0, upper], and one is
+picked in proportion to its weight. It is then accepted against K reference
+points drawn around it, one of which is the current value. The weights include
+the density of proposing back, which corrects for the truncation. With K = 1
+this is plain Metropolis-Hastings.
+
+Parameters:
+value - the current value
+log_target - the current value's log target
+log_target_fn - function taking an array of values and returning an array of their log targets
+sd - standard deviation of the proposals
+upper - upper bound of the parameter
+k - the number of proposals
+
+Returns:
+The new value and its log target
+"""
+def multiple_try_step(value, log_target, log_target_fn, sd, upper, k):
+    def propose(center, size):
+        return truncnorm.rvs((0.0 - center) / sd, (upper - center) / sd, center, sd, size=size)
+
+    def log_proposal(x, center):
+        return truncnorm.logpdf(x, (0.0 - center) / sd, (upper - center) / sd, center, sd)
+
+    proposals = atleast_1d(propose(value, k))
+    targets = log_target_fn(proposals)
+    weights = targets + log_proposal(value, proposals)
+    total = logaddexp.reduce(weights)
+
+    # pick a proposal in proportion to its weight
+    cumulative = cumsum(exp(weights - total))
+    chosen = minimum(searchsorted(cumulative, random.uniform(0.0, 1.0)), k - 1)
+    new_value = proposals[chosen]
+
+    references = append(atleast_1d(propose(new_value, k - 1)), value)
+    reference_targets = append(log_target_fn(references[:-1]), log_target)
+    reference_total = logaddexp.reduce(reference_targets + log_proposal(new_value, references))
+
+    if isfinite(total) and log(random.uniform(0.0, 1.0)) <= total - reference_total:
+        return new_value, targets[chosen]
+    return value, log_target
+
+"""
+Function: param_sweep
+Updates each of the sampled parameters in turn with a multiple_try_step.
+
+Parameters:
+state - the MoveLikelihoodState for the move, or anything else with a log_target method, like a PooledLikelihoodState
+params - list of [prior_mean, mean_conf, prior_var, var_conf, dispersion]
+prob - the log target of params, or None to compute it
+proposals - the number of proposals per step
+
+Returns:
+The new params, as a new list, and their log probability
+"""
+def param_sweep(state, params, prob, proposals):
+    params = list(params)
+    if prob == None:
+        prob = state.log_target(*params)[0]
+
+    # the log target, for values of params[index]
+    def log_target_fn(index):
+        def log_targets(values):
+            settings = [zeros(len(values)) + param for param in params]
+            settings[index] = values
+            return state.log_target(*settings)
+        return log_targets
+
+    for index in sorted(PARAM_STEPS):
+        sd, upper = PARAM_STEPS[index]
+        params[index], prob = multiple_try_step(params[index], prob, log_target_fn(index),
+                                                sd, upper, proposals)
+    return params, prob
+
 """
 Function: find_params_for_move
 Runs gibbs over the variables in our particle filter, attempting to find the ideal parameters for a given human move.d
@@ -565,65 +1571,779 @@ dispersion - dispersion parameter to dirichlet - > 0
 
 The mean and variance are fixed, forcing the program to optimize the confidences.
 
-All moves are made via a random sample from a normal distribution
+Each variable is updated by a multiple_try_step. The move's statistics are
+computed once in a MoveLikelihoodState, and each step evaluates all of its
+proposals in one call against that state.
 
 Parameters:
 current_partition - the current partition of the images into groups
 move - the move object being used in this calculation
+group_stats - optional GroupStatistics for current_partition
+proposals - the number of proposals per step. Defaults to PARAM_PROPOSALS
 
 Returns:
 The mean of the samples taken
 """
-def find_params_for_move(current_partition, move):
+def find_params_for_move(current_partition, move, group_stats=None, proposals=None):
+    if proposals == None:
+        proposals = PARAM_PROPOSALS
     # first generate a random start point
     print "GROUP IS ", move['new_group']
-    mu = 255.0/2.0
-    mu_conf = 0.5
-    sig = (256.0/4.0) ** 2
-    var_conf = 10.0
-    disp = 3.0
-
-    params = [mu, mu_conf, sig, var_conf, disp]
+    state = MoveLikelihoodState(current_partition, move, group_stats)
+    params = list(START_PARAMS)
     sample_params = []
 
     print "Starting with sample:", str(params)
 
-    all_probs = move_probability(current_partition, move, params[0], params[1], params[2], params[3], params[4])
-    time_elapsed = move['time_elapsed']
+    prob = None
     # iterate across the variables, testing each new suggestion in turn
     print "Walking in...."
-    for i in range(walk_in):
-        # sample mu_conf
-        params, prob, all_probs = sample_mu_conf(current_partition, move, time_elapsed, params, all_probs)
-        # sample var_conf
-        params, prob, all_probs = sample_var_conf(current_partition, move, time_elapsed, params, all_probs)
-        # sample disp
-        params, prob, all_probs = sample_disp(current_partition, move, time_elapsed, params, all_probs)
-        print "Walk in sample", i, ":", str(params)
-        print "resulting prob:", str(prob)
+    for i in range(walk_in + samples):
+        params, prob = param_sweep(state, params, prob, proposals)
 
-    print "Sampling..."
-    for j in range(samples):
-        # sample mu_conf
-        params, prob, all_probs = sample_mu_conf(current_partition, move, time_elapsed, params, all_probs)
-        # sample var_conf
-        params, prob, all_probs = sample_var_conf(current_partition, move, time_elapsed, params, all_probs)
-        # sample disp
-        params, prob, all_probs = sample_disp(current_partition, move, time_elapsed, params, all_probs)
-        print "Sample", j, ":", str(params)
-        print "Resulting probability:", str(prob)
-
-        # save the sample we just generated
-        sample_params.append(params[:])
+        if i < walk_in:
+            print "Walk in sample", i, ":", str(params)
+        else:
+            print "Sample", i - walk_in, ":", str(params)
+            # save the sample we just generated
+            sample_params.append(params[:])
+        print "resulting prob:", str(prob)
 
     image_id = move['image_id']
     group = move['new_group']
 
     print "Move of image " + str(image_id) + " to group " + str(group) + " found params: " + str(params)
-    print "Resulting probability is " + str(move_probability(current_partition, move, params[0], params[1], params[2], params[3], params[4]))
     print "mean is " + str(mean(array(sample_params), axis=0))
     return mean(array(sample_params), axis=0)
 
+CHAINS = 4
+CHAIN_BLOCK = 10 # sweeps each chain runs between convergence checks
+CHAIN_MAX_SWEEPS = 200
+RHAT_THRESHOLD = 1.05
+MIN_ESS = 100.0
+
+"""
+Function: split_chains
+Splits each chain of draws in half, so that a chain that is still drifting
+looks like two chains that disagree. A middle draw of an odd length chain is
+dropped.
+
+Parameters:
+draws - (chains x draws) array
+
+Returns:
+(2 chains x draws / 2) array
+"""
+def split_chains(draws):
+    half = draws.shape[1] // 2
+    return concatenate([draws[:, :half], draws[:, draws.shape[1] - half:]])
+
+"""
+Function: potential_scale_reduction
+The split R-hat of a parameter: how much wider the spread of all the draws is
+than the spread within each chain. Near 1 once the chains have mixed.
+
+Parameters:
+draws - (chains x draws) array, with at least 4 draws per chain
+
+Returns:
+R-hat. Chains that have never moved give 1 if they agree and inf otherwise
+"""
+def potential_scale_reduction(draws):
+    draws = split_chains(asarray(draws, dtype=float))
+    m, n = draws.shape
+    within = mean(var(draws, axis=1, ddof=1))
+    between = n * var(mean(draws, axis=1), ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else inf
+    var_plus = (n - 1.0) / n * within + between / n
+    return float(sqrt(var_plus / within))
+
+"""
+Function: effective_sample_size
+The number of independent draws that the correlated draws of several chains
+are worth, from their autocorrelations combined across split chains and
+truncated with Geyer's initial positive sequence.
+
+Parameters:
+draws - (chains x draws) array, with at least 4 draws per chain
+
+Returns:
+The effective sample size, or nan if no chain has ever moved
+"""
+def effective_sample_size(draws):
+    draws = split_chains(asarray(draws, dtype=float))
+    m, n = draws.shape
+    chain_means = mean(draws, axis=1)
+
+    # autocovariance of each chain at every lag, by fft
+    centered = draws - chain_means.reshape((-1, 1))
+    size = 2 ** int(ceil(log2(2 * n)))
+    spectrum = fft.rfft(centered, size, axis=1)
+    autocov = fft.irfft(spectrum * conjugate(spectrum), size, axis=1)[:, :n] / n
+
+    within = mean(autocov[:, 0]) * n / (n - 1.0)
+    var_plus = (n - 1.0) / n * within
+    if m > 1:
+        var_plus += var(chain_means, ddof=1)
+    if var_plus == 0:
+        return nan
+    rho = 1 - (within - mean(autocov, axis=0)) / var_plus
+
+    # sum the autocorrelations in pairs until a pair is negative
+    tau = -1.0
+    for lag in range(0, n - 1, 2):
+        pair = rho[lag] + rho[lag + 1]
+        if pair < 0:
+            break
+        tau += 2 * pair
+    return float(m * n / tau)
+
+"""
+Function: summarize_chains
+Posterior summaries and convergence diagnostics for the draws of several
+chains. The first half of each chain is discarded as warm up.
+
+Parameters:
+draws - (chains x sweeps x len(PARAM_NAMES)) array of the draws
+rhat_threshold - the largest R-hat that counts as converged
+min_ess - the smallest effective sample size that counts as converged
+
+Returns:
+A dict holding the mean, sd and central 95% interval of each parameter, the
+rhat and ess of the sampled parameters, the number of chains and sweeps, and
+converged, which is True if every sampled parameter met both thresholds
+"""
+def summarize_chains(draws, rhat_threshold=None, min_ess=None):
+    if rhat_threshold == None:
+        rhat_threshold = RHAT_THRESHOLD
+    if min_ess == None:
+        min_ess = MIN_ESS
+    draws = asarray(draws, dtype=float)
+    chains, sweeps = draws.shape[:2]
+    kept = draws[:, sweeps // 2:]
+    flat = kept.reshape((-1, draws.shape[2]))
+
+    summary = {'mean': {}, 'sd': {}, 'interval': {}, 'rhat': {}, 'ess': {},
+               'chains': chains, 'sweeps': sweeps, 'converged': False}
+    for index, name in enumerate(PARAM_NAMES):
+        summary['mean'][name] = float(mean(flat[:, index]))
+        summary['sd'][name] = float(std(flat[:, index]))
+        summary['interval'][name] = [float(percentile(flat[:, index], 2.5)),
+                                     float(percentile(flat[:, index], 97.5))]
+
+    if kept.shape[1] >= 4:
+        for index in sorted(PARAM_STEPS):
+            name = PARAM_NAMES[index]
+            summary['rhat'][name] = potential_scale_reduction(kept[:, :, index])
+            summary['ess'][name] = effective_sample_size(kept[:, :, index])
+        summary['converged'] = bool(all([summary['rhat'][name] <= rhat_threshold and summary['ess'][name] >= min_ess
+                                         for name in summary['rhat']]))
+    return summary
+
+"""
+Function: run_chain_block
+Advances one chain by a number of sweeps. This is the unit of work handed to
+the pool by find_params_with_chains, so it takes a single tuple.
+
+Parameters:
+args - tuple of (state, params, prob, sweeps, proposals, seed), where state,
+params, prob and proposals are as for param_sweep and seed seeds the random
+numbers of this block
+
+Returns:
+A list of the params after each sweep, and the log probability of the last
+"""
+def run_chain_block(args):
+    state, params, prob, sweeps, proposals, seed = args
+    random.seed(seed)
+    chain = []
+    for i in range(sweeps):
+        params, prob = param_sweep(state, params, prob, proposals)
+        chain.append(params)
+    return chain, prob
+
+"""
+Function: run_chains
+Samples the parameters of a state's log_target with several independent
+chains started from spread out points. The chains are advanced CHAIN_BLOCK
+sweeps at a time, on pool if one is given, and stop as soon as
+summarize_chains finds that they have converged, or after max_sweeps. The
+results are the same with or without a pool.
+
+Parameters:
+state - a MoveLikelihoodState, or anything else with a log_target method
+chains - the number of chains. Defaults to CHAINS
+pool - optional multiprocessing Pool to run the chains on
+proposals - the number of proposals per step. Defaults to PARAM_PROPOSALS
+max_sweeps - the most sweeps to run each chain for. Defaults to CHAIN_MAX_SWEEPS
+
+Returns:
+The summary from summarize_chains
+"""
+def run_chains(state, chains=None, pool=None, proposals=None, max_sweeps=None):
+    if chains == None:
+        chains = CHAINS
+    if proposals == None:
+        proposals = PARAM_PROPOSALS
+    if max_sweeps == None:
+        max_sweeps = CHAIN_MAX_SWEEPS
+
+    # the first chain starts where find_params_for_move does, and the others
+    # up to 4 times either side of it
+    chain_params = []
+    for c in range(chains):
+        params = list(START_PARAMS)
+        if c > 0:
+            for index in PARAM_STEPS:
+                upper = PARAM_STEPS[index][1]
+                params[index] = float(minimum(params[index] * exp(random.uniform(log(0.25), log(4.0))), upper))
+        chain_params.append(params)
+    chain_probs = [None] * chains
+    draws = [[] for c in range(chains)]
+
+    sweeps = 0
+    while True:
+        block = CHAIN_BLOCK if sweeps + CHAIN_BLOCK <= max_sweeps else max_sweeps - sweeps
+        seeds = random.randint(0, 2 ** 30, chains)
+        tasks = [(state, chain_params[c], chain_probs[c], block, proposals, seeds[c])
+                 for c in range(chains)]
+        if pool != None:
+            results = pool.map(run_chain_block, tasks)
+        else:
+            results = map(run_chain_block, tasks)
+
+        for c, (chain, prob) in enumerate(results):
+            draws[c].extend(chain)
+            chain_params[c] = chain[-1]
+            chain_probs[c] = prob
+        sweeps += block
+
+        summary = summarize_chains(draws)
+        print "After", sweeps, "sweeps of", chains, "chains: rhat", summary['rhat'], "ess", summary['ess']
+        if summary['converged'] or sweeps >= max_sweeps:
+            return summary
+
+"""
+Function: find_params_with_chains
+Fits the parameters for a move like find_params_for_move, but with run_chains.
+
+Parameters:
+current_partition - the current partition of the images into groups
+move - the move object being used in this calculation
+group_stats - optional GroupStatistics for current_partition
+chains, pool, proposals, max_sweeps - as for run_chains
+
+Returns:
+The summary from summarize_chains
+"""
+def find_params_with_chains(current_partition, move, group_stats=None, chains=None, pool=None, proposals=None, max_sweeps=None):
+    state = MoveLikelihoodState(current_partition, move, group_stats)
+    summary = run_chains(state, chains, pool, proposals, max_sweeps)
+
+    print "Move of image " + str(move['image_id']) + " to group " + str(move['new_group']) + " found params: " + str(summary['mean'])
+    return summary
+
+"""
+Class: PooledLikelihoodState
+
+The summed log probability of every move of one or more trials, so that a
+single parameter setting can be fit to all of them together. Holding the
+statistics of every move of many trials would take too much memory, so, like
+TrialsLikelihood, each trial is replayed whenever the log target is asked for
+and only one move's statistics are held at a time. The first move of each
+trial is left out, as in compare_trial.
+
+Parameters:
+trials - list of trial documents
+"""
+class PooledLikelihoodState(object):
+    def __init__(self, trials):
+        self.trials = list(trials)
+        self.moves = 0
+        for trial in self.trials:
+            self.moves += max(len(trial['moves']) - 1, 0)
+
+    """
+    Method: move_states
+    Replays the trials, making the MoveLikelihoodState of each move in turn
+
+    Returns:
+    A generator over the MoveLikelihoodStates
+    """
+    def move_states(self):
+        for trial in self.trials:
+            for moveNum, move, current_partition, group_stats in replay_trial(trial):
+                if moveNum > 0:
+                    yield MoveLikelihoodState(current_partition, move, group_stats)
+
+    """
+    Method: log_target
+    The summed log probability of every human move, for K parameter settings
+
+    Returns:
+    An array of K values
+    """
+    def log_target(self, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, dispersion=DISPERSION_PARAMETER):
+        total = 0
+        for move_state in self.move_states():
+            total = total + move_state.log_target(prior_mean, mean_conf, prior_var, var_conf, dispersion)
+        return total
+
+# raised to stop maximize_log_target once it has used its evaluations
+class EvaluationLimit(Exception):
+    pass
+
+# lower bound of every fitted parameter, which must stay positive
+PARAM_MIN = 1e-3
+# finite difference step, in log parameter space
+MAP_STEP = 1e-3
+# most evaluations of the log target one maximization may use
+MAP_MAX_EVALS = 100
+
+"""
+Function: maximize_log_target
+Finds the parameters that maximize a state's log_target with L-BFGS-B. The
+search runs over the log of each parameter, which keeps them positive and
+evens out parameters of very different sizes. The gradient is taken by
+forward differences, with the current point and one step along every
+parameter evaluated together in a single batched call.
+
+Parameters:
+state - anything with a log_target method
+params - list of [prior_mean, mean_conf, prior_var, var_conf, dispersion] to start from. Defaults to START_PARAMS
+bounds - dict of index in params -> (lower, upper) of each parameter to fit. The others are held fixed. Defaults to PARAM_STEPS's parameters between PARAM_MIN and their upper bounds
+max_evals - the most evaluations to use. Defaults to MAP_MAX_EVALS
+
+Returns:
+A dict holding the best params as a dict by name, their log_target, the number
+of evaluations used, converged, and a message from the optimizer
+"""
+def maximize_log_target(state, params=None, bounds=None, max_evals=None):
+    if params == None:
+        params = START_PARAMS
+    if bounds == None:
+        bounds = dict((index, (PARAM_MIN, PARAM_STEPS[index][1])) for index in PARAM_STEPS)
+    if max_evals == None:
+        max_evals = MAP_MAX_EVALS
+    indices = sorted(bounds)
+    params = array(params, dtype=float)
+
+    def settings_for(log_values):
+        settings = tile(params.reshape((-1, 1)), (1, len(log_values)))
+        settings[indices] = exp(array(log_values).T)
+        return settings
+
+    # the optimizer only checks maxfun between iterations, so the limit is
+    # enforced here and the best point so far is kept
+    evaluations = [0]
+    def negative_log_target(x):
+        if evaluations[0] >= max_evals:
+            raise EvaluationLimit()
+        evaluations[0] += 1
+
+        # the point itself, then a step along each parameter
+        points = [x] + [x + MAP_STEP * eye(len(x))[i] for i in range(len(x))]
+        values = state.log_target(*settings_for(points))
+        if not isfinite(values[0]):
+            return inf, zeros(len(x))
+        if -values[0] < best[0]:
+            best[:] = [-values[0], array(x)]
+        return -values[0], -(values[1:] - values[0]) / MAP_STEP
+
+    x0 = log(params[indices].clip([bounds[index][0] for index in indices],
+                                  [bounds[index][1] for index in indices]))
+    log_bounds = [(log(bounds[index][0]), log(bounds[index][1]) - MAP_STEP) for index in indices]
+    best = [inf, x0]
+    try:
+        x, value, info = fmin_l_bfgs_b(negative_log_target, x0, bounds=log_bounds,
+                                       maxfun=max_evals, pgtol=1e-3)
+        converged = info['warnflag'] == 0
+        message = str(info['task'])
+    except EvaluationLimit:
+        converged = False
+        message = "Stopped after " + str(max_evals) + " evaluations"
+    value, x = best
+
+    best_params = settings_for([x])[:, 0]
+    return {'params': dict((name, float(best_params[i])) for i, name in enumerate(PARAM_NAMES)),
+            'log_likelihood': float(-value),
+            'evaluations': evaluations[0],
+            'converged': converged,
+            'message': message}
+
+"""
+Function: fit_pooled_params
+Fits one set of parameters to every move of a group of trials.
+
+Parameters:
+trials - list of trial documents
+method - 'map' to maximize the summed log likelihood with maximize_log_target,
+or 'chains' to sample it with run_chains
+
+Returns:
+The result of maximize_log_target or the summary of run_chains, with moves,
+the number of moves it was fit to
+"""
+def fit_pooled_params(trials, method='map'):
+    state = PooledLikelihoodState(trials)
+    if method == 'map':
+        fit = maximize_log_target(state)
+    elif method == 'chains':
+        fit = run_chains(state)
+    else:
+        raise ValueError("Unknown fitting method " + str(method))
+    fit['moves'] = state.moves
+    return fit
+
+"""
+Function: fit_pooled_group
+Fetches a group of trials and fits them with fit_pooled_params. This is the
+unit of work handed to each worker process by run_pooled_fits.
+
+Parameters:
+args - tuple of (key, trial_ids, method), where key names the group
+
+Returns:
+A result holding the key as _id, the trial ids, and the fit
+"""
+def fit_pooled_group(args):
+    key, trial_ids, method = args
+    print "Fitting", key, "with", len(trial_ids), "trial(s)"
+    startTime = time.time()
+    trials = [db.get_trial(trial_id) for trial_id in trial_ids]
+    fit = fit_pooled_params(trials, method)
+    return {'_id': key,
+            'trial_ids': [str(trial_id) for trial_id in trial_ids],
+            'fit': fit,
+            'time': time.time() - startTime}
+
+# tester names that many people share, which say nothing about who made a trial
+SHARED_TESTERS = ("Mechanical Turker", "")
+
+"""
+Function: run_pooled_fits
+Fits one set of parameters per trial, or per tester, and writes each fit to a
+results file as a line of json, like run_all_trials does for trials. Trials
+with fewer than two moves have nothing to fit and are skipped. When pooling by
+tester, trials whose tester name is in SHARED_TESTERS, like the mechanical turk
+trials, are each fit on their own, as they can't be told apart by tester.
+
+Parameters:
+results_path - a results file to resume. If not given, a new one is created
+pooled_by - 'trial' to fit each trial on its own, or 'tester' to fit all of a tester's trials together
+method - 'map' or 'chains', as for fit_pooled_params
+turk - if True, only fit the mechanical turk trials with 40 moves
+workers - the number of processes to fit groups on
+"""
+def run_pooled_fits(results_path=None, pooled_by='trial', method='map', turk=False, workers=1):
+    if pooled_by not in ('trial', 'tester'):
+        raise ValueError("Can't pool trials by " + str(pooled_by))
+    if pooled_by == 'tester' and turk:
+        raise ValueError("The mechanical turk trials all have the same tester name, so they can't be " +
+                         "pooled by tester. Pool them by trial instead")
+
+    fields = dict(TRIAL_LISTING_FIELDS, tester=1)
+    if turk:
+        trials = db.iter_turk_trials(fields=fields)
+    else:
+        trials = db.iter_trials(fields=fields)
+
+    # group the trial ids, in the order they are first seen
+    groups = OrderedDict()
+    shared = 0
+    for trial in trials:
+        if len(trial['moves']) < 2:
+            continue
+        key = str(trial['_id'])
+        if pooled_by == 'tester':
+            if trial.get('tester', '') in SHARED_TESTERS:
+                shared += 1
+            else:
+                key = trial['tester']
+        groups.setdefault(key, []).append(trial['_id'])
+    if shared > 0:
+        print "Warning:", shared, "trial(s) have a shared tester name, and are fit on their own"
+
+    config = model_config('fit_pooled_params', pooled_by=pooled_by, method=method)
+    completed = set()
+    if results_path != None:
+        completed = completed_trials(results_path, config)
+    tasks = [(key, trial_ids, method) for key, trial_ids in groups.iteritems() if key not in completed]
+
+    if workers > 1:
+        pool = Pool(workers)
+        fits = pool.imap(fit_pooled_group, tasks)
+    else:
+        pool = None
+        fits = imap(fit_pooled_group, tasks)
+
+    f = open_results(results_path)
+    try:
+        for result in fits:
+            print "Fit", result['_id'], "in", result['time'], "seconds:", result['fit']
+            result['config'] = config
+            write_result(f, result)
+    finally:
+        f.close()
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+# index in the params list -> (lower, upper) for optimize_hyperparameters
+HYPERPARAM_BOUNDS = {0: (1.0, 255.0), # prior_mean
+                     1: (PARAM_MIN, 500.0), # mean_conf
+                     2: (1.0, 256.0 ** 2), # prior_var
+                     3: (PARAM_MIN, 500.0), # var_conf
+                     4: (PARAM_MIN, 1000.0)} # dispersion
+HYPERPARAM_MAX_EVALS = 50
+
+"""
+Function: trial_log_target
+The summed log probability of the human moves of one trial, for K parameter
+settings. This is the unit of work handed to each worker process by
+TrialsLikelihood.
+
+Parameters:
+args - tuple of (trial_id, settings), where settings is the list of
+prior_mean, mean_conf, prior_var, var_conf and dispersion arrays
+
+Returns:
+An array of K values
+"""
+def trial_log_target(args):
+    trial_id, settings = args
+    return PooledLikelihoodState([db.get_trial(trial_id)]).log_target(*settings)
+
+"""
+Class: TrialsLikelihood
+
+The summed log probability of every human move of many trials, with the same
+log_target method as PooledLikelihoodState. Holding the statistics of every
+move of every trial would take too much memory, so each trial is replayed
+whenever the log target is asked for. All the settings asked for at once are
+evaluated in the same replay, and the trials are spread over pool if one is
+given.
+
+Parameters:
+trial_ids - list of the ids of the trials
+pool - optional multiprocessing Pool to replay the trials on
+"""
+class TrialsLikelihood(object):
+    def __init__(self, trial_ids, pool=None):
+        self.trial_ids = list(trial_ids)
+        self.pool = pool
+
+    def log_target(self, prior_mean=mu0, mean_conf=l0, prior_var=sig_sq0, var_conf=a0, dispersion=DISPERSION_PARAMETER):
+        startTime = time.time()
+        settings = [atleast_1d(asarray(setting, dtype=float))
+                    for setting in (prior_mean, mean_conf, prior_var, var_conf, dispersion)]
+        tasks = [(trial_id, settings) for trial_id in self.trial_ids]
+        if self.pool != None:
+            totals = self.pool.map(trial_log_target, tasks)
+        else:
+            totals = map(trial_log_target, tasks)
+
+        total = 0
+        for trial_total in totals:
+            total = total + trial_total
+        print "Evaluated", len(total), "setting(s) over", len(self.trial_ids), "trials in", time.time() - startTime, "seconds"
+        return total
+
+"""
+Function: optimize_hyperparameters
+Finds the prior hyperparameters mu0, l0, sig_sq0, a0 and DISPERSION_PARAMETER
+that make the human moves most likely, with maximize_log_target on a
+TrialsLikelihood. Each evaluation replays the trials once for the current
+point and a finite difference step along all five parameters together.
+
+Parameters:
+turk - if True, only use the mechanical turk trials with 40 moves
+workers - the number of processes to replay trials on
+max_trials - optional limit on the number of trials used, for a quicker fit
+out_path - optional json file to write the fit to
+
+Returns:
+The result of maximize_log_target, with the trial ids used
+"""
+def optimize_hyperparameters(turk=False, workers=1, max_trials=None, out_path=None):
+    if turk:
+        trials = db.iter_turk_trials(fields=TRIAL_LISTING_FIELDS)
+    else:
+        trials = db.iter_trials(fields=TRIAL_LISTING_FIELDS)
+    trial_ids = [trial['_id'] for trial in trials if len(trial['moves']) >= 2]
+    if max_trials != None:
+        trial_ids = trial_ids[:max_trials]
+
+    pool = None
+    if workers > 1:
+        pool = Pool(workers)
+    try:
+        start = [mu0, l0, sig_sq0, a0, DISPERSION_PARAMETER]
+        fit = maximize_log_target(TrialsLikelihood(trial_ids, pool), start,
+                                  HYPERPARAM_BOUNDS, HYPERPARAM_MAX_EVALS)
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    fit['trial_ids'] = [str(trial_id) for trial_id in trial_ids]
+    print "Best hyperparameters:", fit['params']
+    print "Log likelihood:", fit['log_likelihood'], "after", fit['evaluations'], "evaluations"
+    if out_path != None:
+        f = open(out_path, 'w')
+        json.dump(fit, f, indent=2)
+        f.close()
+    return fit
+
+# the default grid run_grid_sweep evaluates
+GRID_MEAN_CONF = [0.1, 0.5, 2.0, 10.0, 50.0, 250.0]
+GRID_VAR_CONF = [0.1, 0.5, 2.0, 10.0, 50.0, 250.0]
+GRID_DISPERSION = [0.3, 1.0, 3.0, 10.0, 30.0, 100.0, 300.0]
+# (mean_conf, var_conf) pairs evaluated together, which bounds the memory used
+GRID_BLOCK = 16
+
+"""
+Function: grid_log_probs
+The log probability of the human's move at every point of a parameter grid.
+The likelihoods are computed once for each (mean_conf, var_conf) pair, and
+the priors once for each dispersion, since log_prior only depends on the
+dispersion. They are then combined and normalized for the whole grid at once.
+
+Parameters:
+state - the MoveLikelihoodState for the move
+mean_confs - the mean_conf values of the grid
+var_confs - the var_conf values of the grid
+dispersions - the dispersion values of the grid
+prior_mean - the prior mean used at every grid point
+prior_var - the prior variance used at every grid point
+
+Returns:
+(mean_confs x var_confs x dispersions) array
+"""
+def grid_log_probs(state, mean_confs, var_confs, dispersions, prior_mean=mu0, prior_var=sig_sq0):
+    mean_column = repeat(mean_confs, len(var_confs))
+    var_column = tile(var_confs, len(mean_confs))
+    likelihoods = concatenate([state.log_likelihoods(prior_mean, mean_column[start:start + GRID_BLOCK],
+                                                     prior_var, var_column[start:start + GRID_BLOCK])
+                               for start in range(0, len(mean_column), GRID_BLOCK)])
+    priors = state.log_priors(dispersions)
+
+    # (pairs x dispersions x groups)
+    log_probs = likelihoods[:, newaxis, :] + priors[newaxis, :, :]
+    log_probs = log_probs[:, :, state.choice] - logaddexp.reduce(log_probs, axis=2)
+    return log_probs.reshape((len(mean_confs), len(var_confs), len(dispersions)))
+
+"""
+Function: sweep_trial
+Replays a trial once and evaluates every move at every point of a grid with
+grid_log_probs.
+
+Parameters:
+trial - the trial document
+mean_confs, var_confs, dispersions, prior_mean, prior_var - as for grid_log_probs
+
+Returns:
+(moves x mean_confs x var_confs x dispersions) float32 array. The first move
+is 0 everywhere, as in compare_trial
+"""
+def sweep_trial(trial, mean_confs, var_confs, dispersions, prior_mean=mu0, prior_var=sig_sq0):
+    log_probs = zeros((len(trial['moves']), len(mean_confs), len(var_confs), len(dispersions)), dtype=float32)
+    for moveNum, move, current_partition, group_stats in replay_trial(trial):
+        if moveNum > 0:
+            state = MoveLikelihoodState(current_partition, move, group_stats)
+            log_probs[moveNum] = grid_log_probs(state, mean_confs, var_confs, dispersions,
+                                                prior_mean, prior_var)
+    return log_probs
+
+"""
+Function: sweep_trial_by_id
+Fetches a trial and runs it through sweep_trial. This is the unit of work
+handed to each worker process by run_grid_sweep.
+
+Parameters:
+args - tuple of (trial_id, mean_confs, var_confs, dispersions)
+
+Returns:
+The trial id and the array from sweep_trial
+"""
+def sweep_trial_by_id(args):
+    trial_id, mean_confs, var_confs, dispersions = args
+    startTime = time.time()
+    log_probs = sweep_trial(db.get_trial(trial_id), mean_confs, var_confs, dispersions)
+    print "Swept trial", trial_id, "in", time.time() - startTime, "seconds"
+    return trial_id, log_probs
+
+"""
+Function: run_grid_sweep
+Evaluates the human moves of every trial at every point of a grid of
+(mean_conf, var_conf, dispersion), replaying each trial only once, and saves
+the results with trialArrays.save_arrays. The moves are in the same order as
+trialArrays.export_trials, and the arrays are:
+
+log_likelihood - (moves x mean_confs x var_confs x dispersions) float32 log probability of each human move
+trial, move - the index of each move's trial, and of the move within it
+trial_ids, trial_offsets - as in trialArrays
+mean_conf, var_conf, dispersion - the grid
+prior_mean, prior_var - the fixed prior used
+
+Parameters:
+path - a .npz file, or a directory for memory-mappable .npy files
+mean_confs, var_confs, dispersions - the grid. Default to GRID_MEAN_CONF, GRID_VAR_CONF and GRID_DISPERSION
+turk - if True, only sweep the mechanical turk trials with 40 moves
+workers - the number of processes to sweep trials on
+
+Returns:
+The dict of arrays
+"""
+def run_grid_sweep(path, mean_confs=None, var_confs=None, dispersions=None, turk=False, workers=1):
+    mean_confs = array(GRID_MEAN_CONF if mean_confs is None else mean_confs, dtype=float)
+    var_confs = array(GRID_VAR_CONF if var_confs is None else var_confs, dtype=float)
+    dispersions = array(GRID_DISPERSION if dispersions is None else dispersions, dtype=float)
+
+    if turk:
+        trials = db.iter_turk_trials(fields=TRIAL_LISTING_FIELDS)
+    else:
+        trials = db.iter_trials(fields=TRIAL_LISTING_FIELDS)
+    tasks = [(trial['_id'], mean_confs, var_confs, dispersions) for trial in trials]
+
+    if workers > 1:
+        pool = Pool(workers)
+        swept = pool.imap(sweep_trial_by_id, tasks)
+    else:
+        pool = None
+        swept = imap(sweep_trial_by_id, tasks)
+
+    trial_ids = []
+    trial_offsets = [0]
+    tensors = []
+    try:
+        for trial_id, log_probs in swept:
+            trial_ids.append(str(trial_id))
+            trial_offsets.append(trial_offsets[-1] + len(log_probs))
+            tensors.append(log_probs)
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    grid_shape = (len(mean_confs), len(var_confs), len(dispersions))
+    trial_offsets = array(trial_offsets, dtype=int64)
+    trial = repeat(arange(len(trial_ids)), diff(trial_offsets))
+    arrays = {'log_likelihood': concatenate(tensors) if tensors else zeros((0,) + grid_shape, dtype=float32),
+              'trial': trial.astype(int32),
+              'move': (arange(trial_offsets[-1]) - trial_offsets[trial]).astype(int32),
+              'trial_ids': array(trial_ids, dtype='S24'),
+              'trial_offsets': trial_offsets,
+              'mean_conf': mean_confs,
+              'var_conf': var_confs,
+              'dispersion': dispersions,
+              'prior_mean': array(mu0),
+              'prior_var': array(sig_sq0)}
+    trialArrays.save_arrays(arrays, path)
+    print "Swept", len(trial_ids), "trials with", len(arrays['move']), "moves over", grid_shape, "grid points to", path
+    return arrays
+
 """
 Function: randomize
 Randomize the list by permuting in place. Knuth's algorithm
@@ -646,12 +2366,13 @@ Given an image and a partition, decides with group to add the image to.
 Parameters:
 partition - the exisiting partition of the data
 image_id - the id of the image that is going to be added
+group_stats - optional GroupStatistics for partition
 
 Returns:
 The group to add the image to.
 """
-def decide_group(partition, move):
-    probabilities = move_probability(partition, move)
+def decide_group(partition, move, group_stats=None):
+    probabilities = move_probability(partition, move, group_stats=group_stats)
     print 'Probabilities:', probabilities
     maxVal = -inf
     group = -1
@@ -680,13 +2401,15 @@ def sort_image_set(set_id):
 
     # for each image in the list, run it through the algoritm
     partition = {}
+    group_stats = GroupStatistics()
     probs = {}
     for image in images:
         image_id = str(image['image_id'])
         move = {'image_id':image_id, 'new_group':None};
-        probs, group = decide_group(partition, move)
+        probs, group = decide_group(partition, move, group_stats)
         print "Adding image to group " + str(group)
         partition[image_id] = group
+        group_stats.move(image_id, group)
         probs[image_id] = probs
     return (probs, partition)
 
@@ -738,3 +2461,51 @@ def sort_and_print_set(set_id=None):
     print "DONE"
     f.write("DONE\n")
     f.close()
+
+parser = argparse.ArgumentParser(description='Compare the human moves in the stored trials to the model')
+parser.add_argument('--turk', action='store_true',
+                    help='only analyze the mechanical turk trials with 40 moves')
+parser.add_argument('--workers', type=int, default=1,
+                    help='the number of processes to replay trials on')
+parser.add_argument('--resume', metavar='RESULTS',
+                    help='a results file to add to, skipping the trials it already holds')
+parser.add_argument('--merge', nargs='+', metavar=('OUT', 'RESULTS'),
+                    help='merge the RESULTS files into OUT instead of running trials')
+parser.add_argument('--params', action='store_true',
+                    help='fit the model parameters to every human move instead of comparing the moves to the model')
+parser.add_argument('--chains', type=int,
+                    help='with --params, run this many chains per move on the workers, stopping once they converge')
+parser.add_argument('--pooled', choices=['trial', 'tester'],
+                    help='fit one set of parameters to all the moves of each trial, or of each tester. Trials with a shared tester name, like the mechanical turk ones, are fit on their own')
+parser.add_argument('--method', choices=['map', 'chains'], default='map',
+                    help='with --pooled, maximize the likelihood or sample it')
+parser.add_argument('--optimize', metavar='OUT',
+                    help='find the prior hyperparameters that make the human moves most likely, and save them to OUT')
+parser.add_argument('--max-trials', type=int,
+                    help='with --optimize, only use this many trials')
+parser.add_argument('--grid', metavar='OUT',
+                    help='evaluate every human move over a grid of parameters, saving the log likelihoods to OUT (.npz or a directory)')
+parser.add_argument('--mean-conf', type=float, nargs='+', default=GRID_MEAN_CONF,
+                    help='with --grid, the mean_conf values of the grid')
+parser.add_argument('--var-conf', type=float, nargs='+', default=GRID_VAR_CONF,
+                    help='with --grid, the var_conf values of the grid')
+parser.add_argument('--dispersion', type=float, nargs='+', default=GRID_DISPERSION,
+                    help='with --grid, the dispersion values of the grid')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_results(args.merge[1:], args.merge[0])
+    elif args.grid:
+        run_grid_sweep(args.grid, args.mean_conf, args.var_conf, args.dispersion, args.turk, args.workers)
+    elif args.optimize:
+        optimize_hyperparameters(args.turk, args.workers, args.max_trials, args.optimize)
+    elif args.pooled:
+        run_pooled_fits(args.resume, args.pooled, args.method, args.turk, args.workers)
+    elif args.params:
+        run_all_trials_for_params(args.resume, args.chains, args.workers)
+    elif args.turk:
+        run_all_turk_trials(args.workers, args.resume)
+    else:
+        run_all_trials(args.workers, args.resume)
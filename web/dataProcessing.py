@@ -47,6 +47,38 @@ def extract(fName):
     resultsFile.close()
 
 
+"""
+Function: readResults
+Reads the trials written, one json object per line, to a results .jsonl file by analysis.run_all_trials. Trials are read one at a time, so the whole file is never held in memory.
+"""
+def readResults(fName):
+    f = open(fName, 'r')
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+    f.close()
+
+"""
+Function: extractResults
+Pulls the likelihood of each move out of a results .jsonl file and saves them in the same parsed-results.json format as extract, ready for makeHist.
+"""
+def extractResults(fName):
+    data = []
+    for trial in readResults(fName):
+        data.append([move['likelihood'] for move in trial['moves']])
+
+    base = "parsed-results"
+    name = base
+    number = 0
+    while os.path.exists(name + ".json"):
+        name = base + str(number)
+        number += 1
+    print "Saving parsed results in", name, ".json"
+    resultsFile = open(name + ".json", 'w')
+    json.dump(data, resultsFile)
+    resultsFile.close()
+
 """
 Function: makeHist
 Makes a histogram of the parsed data in the file fName. The file should contain an array of log probabilities. In addition to the histogram, this function outputs the mean and median of those log probabilities. All this is saved to other-results.txt, while the histogram is saved in hist.png.
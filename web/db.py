@@ -4,27 +4,109 @@ from gridfs import GridFS
 from os import listdir, makedirs
 from os.path import isfile, join, splitext, basename, exists
 from mimetypes import guess_type, guess_extension
+from multiprocessing.pool import ThreadPool
 from numpy.random import randint
+from threading import Lock
 import os
 import pymongo
+import pymongo.errors
+import re
+import time
 from urlparse import urlparse
 
 MONGO_URL = os.environ.get('MONGOHQ_URL')
 
-# connect to mongo
-if MONGO_URL:
-    # Get a connection
-    conn = pymongo.Connection(MONGO_URL)
-    
-    # Get the database
-    db = conn[urlparse(MONGO_URL).path[1:]]
-else:
-    # Not on an app with the MongoHQ add-on, do some localhost action
-    conn = pymongo.Connection('localhost', 27017)
-    db = conn['human-gibbs']
-
-# connect gridFS
-fs = GridFS(db)
+### Connecting ###
+
+# the client and gridFS for this process. They are made on first use rather
+# than at import, and made again in a forked child, since a client can't be
+# shared across a fork
+client = None
+client_pid = None
+fs = None
+client_lock = Lock()
+
+# reads the connection settings from the environment:
+#   MONGO_POOL_SIZE - the most connections each process keeps open
+#   MONGO_CONNECT_TIMEOUT_MS - how long to wait when opening a connection
+#   MONGO_SOCKET_TIMEOUT_MS - how long to wait for a response
+#   MONGO_W - the write concern, a number of servers or e.g. "majority"
+#   MONGO_READ_PREFERENCE - e.g. primary or secondaryPreferred
+# returns the keyword arguments for pymongo.MongoClient
+def client_options(environ=os.environ):
+    options = {'max_pool_size': int(environ.get('MONGO_POOL_SIZE', 10)),
+               'connectTimeoutMS': int(environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000))}
+    if environ.get('MONGO_SOCKET_TIMEOUT_MS'):
+        options['socketTimeoutMS'] = int(environ['MONGO_SOCKET_TIMEOUT_MS'])
+
+    w = environ.get('MONGO_W', '1')
+    options['w'] = int(w) if w.isdigit() else w
+
+    preference = environ.get('MONGO_READ_PREFERENCE')
+    if preference:
+        # secondaryPreferred -> SECONDARY_PREFERRED
+        name = re.sub('([a-z])([A-Z])', r'\1_\2', preference).upper()
+        if not hasattr(pymongo.ReadPreference, name):
+            raise ValueError('Unknown read preference %s' % preference)
+        options['read_preference'] = getattr(pymongo.ReadPreference, name)
+    return options
+
+# returns the mongo client for this process, connecting if need be
+def get_client():
+    global client, client_pid, fs
+    with client_lock:
+        if client == None or client_pid != os.getpid():
+            if MONGO_URL:
+                # on an app with the MongoHQ add-on
+                client = pymongo.MongoClient(MONGO_URL, **client_options())
+            else:
+                # Not on an app with the MongoHQ add-on, do some localhost action
+                client = pymongo.MongoClient('localhost', 27017, **client_options())
+            client_pid = os.getpid()
+            fs = None
+        return client
+
+# returns the database
+def get_db():
+    if MONGO_URL:
+        return get_client()[urlparse(MONGO_URL).path[1:]]
+    else:
+        return get_client()['human-gibbs']
+
+# returns gridFS for this process
+def get_fs():
+    global fs
+    database = get_db()
+    with client_lock:
+        if fs == None:
+            fs = GridFS(database)
+        return fs
+
+### Indexes ###
+
+# makes the indexes the app's queries rely on, and fills in move_count for
+# trials made before it was kept. Safe to run more than once. This is a one-off
+# maintenance step, run by ensure_indexes.py, and is never run by the web app.
+# Raises a ValueError naming them if image set names are not unique
+def ensure_indexes():
+    database = get_db()
+    database.trials.ensure_index([('tester', pymongo.ASCENDING),
+                                  ('move_count', pymongo.ASCENDING)])
+
+    for trial in database.trials.find({'move_count': {'$exists': False}}, {'moves': 1}):
+        database.trials.update({'_id': trial['_id'], 'move_count': {'$exists': False}},
+                               {'$set': {'move_count': len(trial['moves'])}})
+
+    try:
+        database.images.ensure_index('name', unique=True)
+    except pymongo.errors.OperationFailure as e:
+        if e.code not in (11000, 11001):
+            raise
+        names = [image_set.get('name') for image_set in database.images.find({}, {'name': 1})]
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        raise ValueError(('Image set names must be unique before they can be indexed, but ' +
+                          'these are used more than once: %s. Rename or remove the extra ' +
+                          'sets and run this again.') % ', '.join(str(name) for name in duplicates))
 
 ### Adding and reading image ###
 
@@ -34,49 +116,99 @@ def is_image(file_path):
     file_name, file_ext = splitext(file_path)
     return isfile(file_path) and file_ext in image_extensions
 
+# the number of files read and put into gridFS at once when uploading
+UPLOAD_WORKERS = 8
+
+# guesses the content type of each image file, raising a TypeError before
+# anything is uploaded if one can't be guessed
+def content_types(paths):
+    types = []
+    for path in paths:
+        content_type = guess_type(path)[0]
+        if content_type == None:
+            raise TypeError(('Couldn\'t guess the file extension for %s. ' +
+                             'Check the filename.') % path)
+        types.append(content_type)
+    return types
+
+# reads a file and puts it into gridFS. Returns the file's objectId, or the
+# exception if it failed, so one failure doesn't lose track of the others
+def put_file(args):
+    path, content_type = args
+    try:
+        with open(path, 'rb') as f:
+            return get_fs().put(f.read(), content_type=content_type)
+    except Exception as e:
+        return e
+
+# removes files from gridFS
+def delete_files(file_ids):
+    for file_id in file_ids:
+        get_fs().delete(file_id)
+
+# reads the files and puts them into gridFS using a pool of threads, returning
+# their objectIds in the same order. If any of them fail, the ones that were
+# put are deleted again and the first error is raised
+def put_files(paths, workers=UPLOAD_WORKERS):
+    jobs = zip(paths, content_types(paths))
+    if len(jobs) == 0:
+        return []
+
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        results = pool.map(put_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    if len(errors) > 0:
+        delete_files([r for r in results if not isinstance(r, Exception)])
+        raise errors[0]
+    return results
+
+# inserts an image set document, deleting its files from gridFS if the insert
+# fails
+def insert_image_set(document, file_ids):
+    try:
+        set_id = get_db().images.insert(document)
+    except pymongo.errors.DuplicateKeyError:
+        # another upload took the name since it was checked
+        delete_files(file_ids)
+        raise ValueError(('An image set with the name %s already exists. Please ' +
+                         'change the folder name and try uploading again.') % document['name'])
+    except:
+        delete_files(file_ids)
+        raise
+    forget_image_set_ids()
+    return set_id
+
 # adds an image set. Uses the directory name for the folder path. Returns the
 # objectId for the image document
 #
 # The uses of ValueError and TypeError are stretches for their defined purpose,
 # but using different errors allows us to detect what went wrong in imageGen
-def add_image_set_by_array(images, parents, name):
+def add_image_set_by_array(images, parents, name, workers=UPLOAD_WORKERS):
     # check for duplicate name
-    if db.images.find_one({'name': name}) != None:
+    if get_db().images.find_one({'name': name}) != None:
         raise ValueError(('An image set with the name %s already exists. Please ' +
                          'change the folder name and try uploading again.') % name)
 
-    # put all the parent images into gridFS, save their object IDs
-    parent_list = []
-    for image in parents:
-        with open(image, 'rb') as f:
-            data = f.read()
-            content_type = guess_type(image)[0]
-            if content_type == None:
-                raise TypeError(('Couldn\'t guess the file extension for %s. ' +
-                                 'Check the filename.') % image)
-            parent_id = fs.put(data, content_type=content_type)
-            parent_list.append(parent_id)
-
-    # put all the images into gridFS, save their object IDs
+    # put all the parent images and images into gridFS, save their object IDs
+    file_ids = put_files(list(parents) + [image['path'] for image in images], workers)
+    parent_list = file_ids[:len(parents)]
     image_list = []
-    for image in images:
-        with open(image['path'], 'rb') as f:
-            data = f.read()
-            content_type = guess_type(image['path'])[0]
-            if content_type == None:
-                raise TypeError(('Couldn\'t guess the file extension for %s. ' +
-                                 'Check the filename.') % image['path'])
-            image_id = fs.put(data, content_type=content_type)
-            image_list.append({'image_id': image_id, 'parent': parent_list[image['category']], 'category': image['category']})
+    for image, image_id in zip(images, file_ids[len(parents):]):
+        image_list.append({'image_id': image_id, 'parent': parent_list[image['category']], 'category': image['category']})
 
     # save the image set, return the 
-    return db.images.insert({'name': name,
+    return insert_image_set({'name': name,
                              'parents': parent_list,
-                             'images': image_list})
+                             'images': image_list}, file_ids)
 
 # adds an image set. Uses the directory name for the folder path. Returns the
 # objectId for the image document
-def add_image_set(dir_path, name=None):
+def add_image_set(dir_path, name=None, workers=UPLOAD_WORKERS):
     # get all the images
     paths = [join(dir_path, f) for f in listdir(dir_path)] # get full paths
     images = filter(is_image, paths) # keep only image files
@@ -84,30 +216,22 @@ def add_image_set(dir_path, name=None):
     # get name for set from folder name
     if name == None:
         name = basename(dir_path)
-    if db.images.find_one({'name': name}) != None:
+    if get_db().images.find_one({'name': name}) != None:
         raise ValueError(('An image set with the name %s already exists. Please ' +
                          'change the folder name and try uploading again.') % name)
 
     # put all the images into gridFS, save their object IDs
-    image_list = []
-    for image in images:
-        with open(image, 'rb') as f:
-            data = f.read()
-            content_type = guess_type(image)[0]
-            if content_type == None:
-                raise TypeError(('Couldn\'t guess the file extension for %s. ' +
-                                 'Check the filename.') % image)
-            image_id = fs.put(data, content_type=content_type)
-            image_list.append({'image_id': image_id})
+    image_ids = put_files(images, workers)
+    image_list = [{'image_id': image_id} for image_id in image_ids]
 
     # save the image set, return the 
-    return db.images.insert({'name': name,
-                             'images': image_list})
+    return insert_image_set({'name': name,
+                             'images': image_list}, image_ids)
 
 # takes the trial_id as a string and returns the image set        
 def get_image_set_by_trial_id(trial_id):
-    trial = db.trials.find_one({'_id': ObjectId(trial_id)})
-    return db.dereference(trial['image_set'])
+    trial = get_db().trials.find_one({'_id': ObjectId(trial_id)})
+    return get_db().dereference(trial['image_set'])
 
 # gets a list of all names in the image set
 def image_names(image_set):
@@ -116,7 +240,7 @@ def image_names(image_set):
     i = 0 # index for filenames
     for image_map in image_set['images']:
         # find the image
-        image = fs.get(image_map['image_id'])
+        image = get_fs().get(image_map['image_id'])
 
         # choose the filename
         ext = guess_extension(image.content_type)
@@ -137,58 +261,88 @@ def write_image_set(image_set_name, target_dir):
         makedirs(target_dir)
     
     # find image set
-    image_set = db.images.find_one({'name': image_set_name})
+    image_set = get_db().images.find_one({'name': image_set_name})
 
     # get a list of filenames
     filenames = [join(target_dir, x) for x in image_names(image_set)]
 
     for i in range(len(filenames)):
-        image = fs.get(image_set['images'][i]['image_id'])
+        image = get_fs().get(image_set['images'][i]['image_id'])
         
         with open(filenames[i], 'wb') as f:
             f.write(image.read())
 
 def get_image_file(image_id):
     # get the image
-    return fs.get(ObjectId(image_id))
+    return get_fs().get(ObjectId(image_id))
 
 # returns a list of all image sets
 def get_all_image_sets():
     # list of image sets
-    image_sets = []
-    
-    # get a cursor over the sets
-    set_cursor = db.images.find()
+    return list(iter_image_sets())
 
-    # add all image_sets
-    for i in range(set_cursor.count()):
-        image_sets.append(set_cursor[i])
-        
-    return image_sets
+# streams the image sets from a single cursor, batch_size at a time. fields is
+# a projection, e.g. {'_id': 1} to skip the image lists
+def iter_image_sets(fields=None, batch_size=None):
+    if batch_size == None:
+        batch_size = BATCH_SIZE
+    for image_set in get_db().images.find({}, fields).batch_size(batch_size):
+        yield image_set
 
 # return a specific image set
 def get_image_set(set_id):
-    return db.images.find_one({'_id': ObjectId(set_id)})
+    return get_db().images.find_one({'_id': ObjectId(set_id)})
+
+# how long the list of image set ids is kept before being read again, to pick
+# up sets added by other processes
+IMAGE_SET_IDS_SECONDS = 60
+
+image_set_ids = None
+image_set_ids_time = 0
+
+# returns the ids of all the image sets, read at most every
+# IMAGE_SET_IDS_SECONDS
+def get_image_set_ids():
+    global image_set_ids, image_set_ids_time
+    if image_set_ids == None or time.time() - image_set_ids_time > IMAGE_SET_IDS_SECONDS:
+        image_set_ids = [s['_id'] for s in get_db().images.find({}, {'_id': 1})]
+        image_set_ids_time = time.time()
+    return image_set_ids
+
+# makes the next get_image_set_ids read the ids again
+def forget_image_set_ids():
+    global image_set_ids
+    image_set_ids = None
+
+# returns a random image set, looked up by id
+def get_random_image_set():
+    for attempt in range(2):
+        set_ids = get_image_set_ids()
+        if len(set_ids) == 0:
+            break
+        image_set = get_db().images.find_one({'_id': set_ids[randint(len(set_ids))]})
+        if image_set != None:
+            return image_set
+        # the set was removed since the ids were read
+        forget_image_set_ids()
+    raise ValueError('There are no image sets to choose from')
 
 ### Adding and getting trials ###
     
 # add a trial to the system, returns string of the ID for the trial. 
 def add_trial(init_state, image_set, tester):
-    trial_id = db.trials.insert({'init_state': init_state,
-                                 'moves': [],
-                                 'image_set': DBRef('images', image_set['_id']),
-                                 'tester': tester})
+    trial_id = get_db().trials.insert({'init_state': init_state,
+                                       'moves': [],
+                                       'move_count': 0,
+                                       'image_set': DBRef('images', image_set['_id']),
+                                       'tester': tester})
     return str(trial_id)
 
 # adds a trial based off a random image set from the database. All images are
 # assumed to not start on the board, i.e., all images are unstaged
 def add_unstaged_trial(tester):
-    # get a cursor over the image sets
-    image_sets = db.images.find()
-
     # choose a random image set
-    num_sets = image_sets.count()
-    image_set = image_sets[randint(num_sets)]
+    image_set = get_random_image_set()
 
     # add all the images to the trial
     init_state = []
@@ -201,35 +355,74 @@ def add_unstaged_trial(tester):
     return add_trial(init_state, image_set, tester)
 
 def get_trial(trial_id):
-    return db.trials.find_one({'_id': ObjectId(trial_id)})
+    return get_db().trials.find_one({'_id': ObjectId(trial_id)})
 
 def get_all_trials():
     # return all the trials in the database
-    trials_cursor = db.trials.find()
-    trials = []
-
-    for i in range(trials_cursor.count()):
-        trials.append(trials_cursor[i])
-
-    return trials
+    return list(iter_trials())
 
 # returns all mechanical turk runs with 40 moves
 def get_all_turk_trials():
-    # return all the trials in the database
-    trials_cursor = db.trials.find({"moves": {"$size":40}, "tester":"Mechanical Turker"})
-    trials = []
-
-    for i in range(trials_cursor.count()):
-        trials.append(trials_cursor[i])
-
-    return trials
+    return list(iter_turk_trials())
+
+# the number of documents fetched per round trip when streaming
+BATCH_SIZE = 50
+
+# streams the trials matching query from a single cursor, batch_size at a
+# time, so only one batch is held in memory. fields is a projection, e.g.
+# {'init_state': 0} to leave out the initial state
+def iter_trials(query=None, fields=None, batch_size=None):
+    if query == None:
+        query = {}
+    if batch_size == None:
+        batch_size = BATCH_SIZE
+    for trial in get_db().trials.find(query, fields).batch_size(batch_size):
+        yield trial
+
+# streams the mechanical turk runs with 40 moves, as iter_trials
+def iter_turk_trials(fields=None, batch_size=None):
+    # trials made before move_count was kept, and not yet filled in by
+    # ensure_indexes, are matched on the length of their moves
+    query = {"tester": "Mechanical Turker",
+             "$or": [{"move_count": 40},
+                     {"move_count": {"$exists": False}, "moves": {"$size": 40}}]}
+    return iter_trials(query, fields, batch_size)
 
 ### Adding moves ###
 
 # add a move to a trial. Takes the trial ID as a string
 def add_move(trial_id, move):
-    return db.trials.update({'_id': ObjectId(trial_id)},
-                            {'$push': {'moves': move}})
+    return get_db().trials.update({'_id': ObjectId(trial_id)},
+                                  {'$push': {'moves': move}, '$inc': {'move_count': 1}})
+
+# appends a batch of moves to a trial with a single update. first_seq is the
+# index in the trial's moves of the first move in the batch, which makes
+# retries safe: moves that are already stored are skipped, and a batch that
+# would leave a gap raises a ValueError. Returns the number of moves stored for
+# the trial afterwards
+def add_moves(trial_id, first_seq, moves):
+    trial_id = ObjectId(trial_id)
+    while True:
+        if len(moves) > 0:
+            # only applies if the trial has exactly first_seq moves so far
+            result = get_db().trials.update({'_id': trial_id, 'moves': {'$size': first_seq}},
+                                            {'$push': {'moves': {'$each': moves}},
+                                             '$inc': {'move_count': len(moves)}}, w=1)
+            if result['n'] == 1:
+                return first_seq + len(moves)
+
+        trial = get_db().trials.find_one({'_id': trial_id}, {'moves': 1})
+        if trial == None:
+            raise ValueError('No trial with id %s' % trial_id)
+        stored = len(trial['moves'])
+        if stored < first_seq:
+            raise ValueError('Trial %s has %d moves, so can\'t add move %d' % (trial_id, stored, first_seq))
+        if stored >= first_seq + len(moves):
+            return stored
+
+        # some of the batch was stored by an earlier try. Add the rest
+        moves = moves[stored - first_seq:]
+        first_seq = stored
 
 # checks a dict representing a move to make sure it has all the required fields
 def has_move_fields(move):
@@ -0,0 +1,145 @@
+"""
+Dump database
+
+A read-only stand-in for db.py that reads a mongodump directory (such as
+data/app10093207) instead of a live Mongo, so analysis can run with no
+database service. It has the same reading functions as db.py.
+
+The BSON files are scanned once per process to find where each document
+starts, and documents are decoded from the file as they are asked for, so the
+whole dump is never held in memory. GridFS images are put back together from
+their chunks in fs.chunks.bson.
+
+analysis and matrixStore use this instead of db.py when the GIBBS_DUMP_DIR
+environment variable is set to the dump directory.
+"""
+from bson import BSON
+from bson.objectid import ObjectId
+from StringIO import StringIO
+import os
+import struct
+
+DUMP_DIR = os.environ.get('GIBBS_DUMP_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'app10093207'))
+
+# collection name -> {_id: (offset, length)} of each document in its file, and
+# files_id -> [(n, offset, length)] of each GridFS file's chunks. Per process
+offsets = {}
+chunk_offsets = None
+
+### Reading BSON ###
+
+# streams (offset, length, document) for each document in a BSON file
+def read_documents(path):
+    f = open(path, 'rb')
+    try:
+        offset = 0
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                break
+            length = struct.unpack('<i', head)[0]
+            data = head + f.read(length - 4)
+            if len(data) < length:
+                raise ValueError('%s ends part way through a document' % path)
+            yield offset, length, BSON(data).decode()
+            offset += length
+    finally:
+        f.close()
+
+# reads the document of the given length at offset in the file
+def read_document(path, offset, length):
+    f = open(path, 'rb')
+    try:
+        f.seek(offset)
+        return BSON(f.read(length)).decode()
+    finally:
+        f.close()
+
+def collection_path(collection):
+    return os.path.join(DUMP_DIR, collection + '.bson')
+
+# returns {_id: (offset, length)} for the documents of a collection
+def collection_offsets(collection):
+    if collection not in offsets:
+        offsets[collection] = dict((doc['_id'], (offset, length)) for offset, length, doc
+                                   in read_documents(collection_path(collection)))
+    return offsets[collection]
+
+# returns a document by id, or None if there isn't one
+def find_one(collection, doc_id):
+    location = collection_offsets(collection).get(ObjectId(str(doc_id)))
+    if location == None:
+        return None
+    return read_document(collection_path(collection), *location)
+
+# checks the top level fields of a document against a query of plain values
+def matches(doc, query):
+    for key, value in query.iteritems():
+        if doc.get(key) != value:
+            return False
+    return True
+
+### Reading images ###
+
+# a GridFS file read back from the dump. Reads like the GridOut db.py returns
+class DumpFile(StringIO):
+    def __init__(self, data, file_doc):
+        StringIO.__init__(self, data)
+        self._id = file_doc['_id']
+        self.content_type = file_doc.get('contentType')
+        self.md5 = file_doc.get('md5')
+        self.length = file_doc.get('length')
+        self.filename = file_doc.get('filename')
+
+def get_image_file(image_id):
+    global chunk_offsets
+    if chunk_offsets == None:
+        chunk_offsets = {}
+        for offset, length, chunk in read_documents(collection_path('fs.chunks')):
+            chunk_offsets.setdefault(chunk['files_id'], []).append((chunk['n'], offset, length))
+
+    file_doc = find_one('fs.files', image_id)
+    if file_doc == None:
+        raise ValueError('No image with id %s in %s' % (image_id, DUMP_DIR))
+    chunks = sorted(chunk_offsets.get(file_doc['_id'], []))
+    data = ''.join(str(read_document(collection_path('fs.chunks'), offset, length)['data'])
+                   for n, offset, length in chunks)
+    return DumpFile(data, file_doc)
+
+def get_all_image_sets():
+    return list(iter_image_sets())
+
+def iter_image_sets(fields=None, batch_size=None):
+    for offset, length, image_set in read_documents(collection_path('images')):
+        yield image_set
+
+def get_image_set(set_id):
+    return find_one('images', set_id)
+
+def get_image_set_by_trial_id(trial_id):
+    return get_image_set(get_trial(trial_id)['image_set'].id)
+
+### Reading trials ###
+
+def get_trial(trial_id):
+    return find_one('trials', trial_id)
+
+def get_all_trials():
+    return list(iter_trials())
+
+def get_all_turk_trials():
+    return list(iter_turk_trials())
+
+# streams the trials matching query, a dict of top level fields and plain
+# values. fields and batch_size are taken for compatibility with db.py; whole
+# documents are always returned
+def iter_trials(query=None, fields=None, batch_size=None):
+    for offset, length, trial in read_documents(collection_path('trials')):
+        if query == None or matches(trial, query):
+            yield trial
+
+# streams the mechanical turk runs with 40 moves
+def iter_turk_trials(fields=None, batch_size=None):
+    for trial in iter_trials({'tester': 'Mechanical Turker'}):
+        if len(trial['moves']) == 40:
+            yield trial
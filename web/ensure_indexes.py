@@ -0,0 +1,10 @@
+import argparse
+import db
+
+parser = argparse.ArgumentParser(description='Make the database indexes the app relies on, and fill in move_count on older trials. Run once after deploying, and again whenever it is safe to')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    db.ensure_indexes()
+    print "Indexes are in place"
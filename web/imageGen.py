@@ -1,9 +1,11 @@
 from math import floor, ceil, exp, sqrt, pi
-from numpy import random, zeros, convolve, transpose
+from numpy import random, zeros, convolve, transpose, array, asarray, ascontiguousarray, clip, fft, indices, newaxis, rollaxis, uint8
+from numpy import floor as npfloor
 from PIL import Image
 from os import listdir
 from os.path import join, basename, normpath, normpath
 import db
+import time
 
 """
 Function: generateMatrix
@@ -14,63 +16,99 @@ This samples from a gaussian for each pixel. The mean of the gaussian is the ori
 Parameters:
 baseMatrix - the matrix to randomize to produce the new matrix
 randomization - the probability of flipping each bit
+rng - the numpy RandomState to draw from. Defaults to numpy.random
+filterMethod - how to blur the matrix, as in gaussianFilterBatch
 """
-def generateMatrix(baseMatrix, randomization, filterSize):
-    newMatrix = []
-    for i in range(len(baseMatrix)):
-        newRow = []
-        for j in range(len(baseMatrix[0])):
-            origVal = baseMatrix[i][j]
-            newRow.append(clamp(0, 255, random.normal(origVal, randomization)))
-        newMatrix.append(newRow)
-    return gaussianFilter(newMatrix, filterSize)
+def generateMatrix(baseMatrix, randomization, filterSize, rng=None, filterMethod="direct"):
+    if rng is None:
+        rng = random
+    newMatrix = clip(rng.normal(asarray(baseMatrix, dtype=float), randomization), 0, 255)
+    return gaussianFilter(newMatrix, filterSize, filterMethod)
+
+"""
+Function: drawChunks
+Draws the unfiltered matrices for a batch of images in one go. Each image is split into chunkSize x chunkSize chunks, the value of every chunk is drawn at once, and the chunks are upsampled to pixels with repeat. As in the original generators, any pixels left over when chunkSize does not divide size stay 0.
+
+Parameters:
+num - the number of images to draw
+size - the width and height of each image
+chunkSize - the width and height of each chunk
+sd - the standard deviation of the chunk values around the image's mean
+t - "pos" for images whose mean falls off with the distance from a random position, "bw" for solid black or white images, anything else for images with a uniform mean
+rng - the numpy RandomState to draw from
+
+Returns:
+A numpy array of shape (num, size, size)
+"""
+def drawChunks(num, size, chunkSize, sd, t, rng):
+    matrices = zeros([num, size, size])
+    if t == "bw":
+        white = npfloor(rng.uniform(0.0, 2.0, num))
+        matrices[:] = 255*white[:, newaxis, newaxis]
+        return matrices
+
+    chunks = int(size/chunkSize)
+    if t == "pos":
+        mean = rng.uniform(50, 205, num)
+        posMean = rng.uniform(0, size/chunkSize, (num, 2))
+        i, j = indices((chunks, chunks))
+        dist = ((i - posMean[:, 0, newaxis, newaxis])**2 + (j - posMean[:, 1, newaxis, newaxis])**2) ** (0.1)
+        mean = mean[:, newaxis, newaxis]/dist
+    else:
+        mean = rng.uniform(0, 255, num)[:, newaxis, newaxis]
+    values = clip(rng.normal(mean, sd, (num, chunks, chunks)), 0, 255)
+
+    matrices[:, :chunks*chunkSize, :chunks*chunkSize] = values.repeat(chunkSize, axis=1).repeat(chunkSize, axis=2)
+    return matrices
+
+"""
+Function: generateImageBatch
+Generates a batch of random images at once.
+
+Parameters:
+num - the number of images to generate
+size - the width and height of each image
+chunkSize - the width and height of each chunk of similar pixels
+filterSize - the size of the gaussian filter used to blur the chunks together
+sd - the standard deviation of the chunk values around each image's mean
+t - the kind of image to generate. "pos", "bw" or anything else, as in drawChunks
+seed - the seed for the random numbers, so the same batch can be generated again. If None, a fresh seed is used
+filterMethod - how to blur the batch, as in gaussianFilterBatch
+
+Returns:
+A numpy array of shape (num, size, size)
+"""
+def generateImageBatch(num, size=100, chunkSize=10, filterSize=15, sd=50, t="pos", seed=None, filterMethod="direct"):
+    matrices = drawChunks(num, size, chunkSize, sd, t, random.RandomState(seed))
+    if t == "bw":
+        return matrices
+    return gaussianFilterBatch(matrices, filterSize, filterMethod)
 
 # downsamples to 5x5 chunks and randomizes
-def generateImage(size, chunkSize, filterSize, sd=100):
-    matrix = zeros([size, size])
-    mean = random.uniform(0, 255)
-    for i in range(int(size/chunkSize)):
-        for j in range(int(size/chunkSize)):
-            val = clamp(0, 255, random.normal(mean, sd))
-            for m in range(chunkSize):
-                for n in range(chunkSize):
-                    matrix[i*chunkSize + m][j*chunkSize + n] = val
-    return gaussianFilter(matrix, filterSize)
-
-def generatePositionImage(size, chunkSize, filterSize, sd=100):
-    matrix = zeros([size, size])
-    mean = random.uniform(50, 205)
-    #neg = random.uniform(0.0, 1.0)
-    posMean = random.uniform(0, size/chunkSize, 2)
-    for i in range(int(size/chunkSize)):
-        for j in range(int(size/chunkSize)):
-            dist = ( (i - posMean[0])**2 + (j - posMean[1]) ** 2 ) ** (0.1)
-            val = clamp(0, 255, random.normal(mean/dist, sd))
-            #if neg > 0.5:
-            #val = 255-val
-            for m in range(chunkSize):
-                for n in range(chunkSize):
-                    matrix[i*chunkSize + m][j*chunkSize + n] = val
-    return gaussianFilter(matrix, filterSize)
-
-def bwImage(size):
-    matrix = zeros([size, size])
-    white = int(floor(random.uniform(0.0, 2.0)))
-    for i in range(int(size)):
-        for j in range(int(size)):
-            if white == 1.0:
-                matrix[i][j] = 255
-            else:
-                matrix[i][j] = 0
-    return matrix
+def generateImage(size, chunkSize, filterSize, sd=100, seed=None):
+    return generateImageBatch(1, size, chunkSize, filterSize, sd, "uniform", seed)[0]
+
+def generatePositionImage(size, chunkSize, filterSize, sd=100, seed=None):
+    return generateImageBatch(1, size, chunkSize, filterSize, sd, "pos", seed)[0]
+
+def bwImage(size, seed=None):
+    return generateImageBatch(1, size, t="bw", seed=seed)[0]
+
+"""
+Function: saveImageBatch
+Saves each matrix in a batch as <index>.png in rootPath.
+
+Parameters:
+matrices - the batch of matrices, as returned by generateImageBatch
+rootPath - the directory in which to save the images
+"""
+def saveImageBatch(matrices, rootPath):
+    for i in range(len(matrices)):
+        saveMatrixAsImage(matrices[i], join(rootPath, str(i) + ".png"))
 
 # default values create a good group for testin
-def generateBW(rootPath, num=40, size=100):
-    for i in range(num):
-        randomImage = bwImage(size)
-        path = join(rootPath, str(i) + ".png")
-        # save the image
-        saveMatrixAsImage(randomImage, path)
+def generateBW(rootPath, num=40, size=100, seed=None):
+    saveImageBatch(generateImageBatch(num, size, t="bw", seed=seed), rootPath)
 
     # now that everything is saved in the filesystem, load it to the db
     saved = False
@@ -89,15 +127,8 @@ def generateBW(rootPath, num=40, size=100):
             saved = False
             raise
 # default values create a good group for testin
-def generateImages(rootPath, num=40, size=100, filterSize=15, chunkSize=10, sd=50, t="pos"):
-    for i in range(num):
-        if t == "pos":
-            randomImage = generatePositionImage(size, chunkSize, filterSize, sd)
-        else:
-            randomImage = generateImage(size, chunkSize, filterSize, sd)
-        path = join(rootPath, str(i) + ".png")
-        # save the image
-        saveMatrixAsImage(randomImage, path)
+def generateImages(rootPath, num=40, size=100, filterSize=15, chunkSize=10, sd=50, t="pos", seed=None, filterMethod="direct"):
+    saveImageBatch(generateImageBatch(num, size, chunkSize, filterSize, sd, t, seed, filterMethod), rootPath)
 
     # now that everything is saved in the filesystem, load it to the db
     saved = False
@@ -133,11 +164,123 @@ def gaussianValue(mean, sd, x):
 def discreteGaussian(num, mean=0.5, sd=0.2):
     return [gaussianValue(mean, sd, float(x+1)/(num+1)) for x in range(int(num))]
 
-def gaussianFilter(matrix, filterSize):
+"""
+Function: gaussianFilter
+Blurs a matrix with the separable gaussian kernel from discreteGaussian, first along each row and then along each column, matching numpy.convolve in "same" mode.
+
+Parameters:
+matrix - the matrix to blur
+filterSize - the number of taps in the kernel
+method - how to convolve. "direct", "fft" or "loop", as in gaussianFilterBatch
+
+Returns:
+The blurred matrix, as a numpy array
+"""
+def gaussianFilter(matrix, filterSize, method="direct"):
+    if method == "loop":
+        return gaussianFilterLoop(matrix, filterSize)
+    return gaussianFilterBatch(asarray(matrix, dtype=float)[newaxis], filterSize, method)[0]
+
+# the number of matrices gaussianFilterBatch blurs at a time
+FILTER_BLOCK = 8
+
+"""
+Function: gaussianFilterBatch
+Blurs a whole stack of matrices at once with the separable gaussian kernel from discreteGaussian. The matrices do not need to be square.
+
+Parameters:
+matrices - a numpy array of shape (N, width, height)
+filterSize - the number of taps in the kernel
+method - "direct" to add up a shifted copy of the stack for each tap, "fft" to multiply in the frequency domain, or "loop" to filter each matrix with gaussianFilterLoop. "direct" is fastest for the small kernels used in stimulus generation, "fft" for large ones
+
+Returns:
+A numpy array of the blurred matrices, of the same shape
+"""
+def gaussianFilterBatch(matrices, filterSize, method="direct"):
+    matrices = asarray(matrices, dtype=float)
+    if method == "loop":
+        return array([gaussianFilterLoop(matrix, filterSize) for matrix in matrices]).reshape(matrices.shape)
+    elif method == "direct":
+        convolveAxis = convolveAxisDirect
+    elif method == "fft":
+        convolveAxis = convolveAxisFFT
+    else:
+        raise ValueError("Unknown filter method " + str(method))
+
+    kernel = asarray(discreteGaussian(filterSize))
+    kernel = kernel/kernel.sum()
+
+    # blur columns, then rows, a few matrices at a time so the working set
+    # stays in cache
+    result = zeros(matrices.shape)
+    for i in range(0, len(matrices), FILTER_BLOCK):
+        block = matrices[i:i + FILTER_BLOCK]
+        result[i:i + FILTER_BLOCK] = convolveAxis(convolveAxis(block, kernel, -1), kernel, -2)
+    return result
+
+"""
+Function: convolveAxisDirect
+Convolves every line along one axis of an array with a kernel, like numpy.convolve in "same" mode, by adding a shifted copy of the array for each tap.
+
+Parameters:
+matrices - the array to convolve
+kernel - the kernel
+axis - the axis along which to convolve
+
+Returns:
+The convolved array
+"""
+def convolveAxisDirect(matrices, kernel, axis):
+    matrices = rollaxis(matrices, axis, matrices.ndim)
+    n = matrices.shape[-1]
+    center = (len(kernel) - 1)//2
+    result = zeros(matrices.shape)
+    for tap in range(len(kernel)):
+        # result[..., p] += kernel[tap]*matrices[..., p + shift], where in range
+        shift = center - tap
+        if shift >= 0:
+            result[..., :n - shift] += kernel[tap]*matrices[..., shift:]
+        else:
+            result[..., -shift:] += kernel[tap]*matrices[..., :n + shift]
+    return rollaxis(result, result.ndim - 1, axis % result.ndim)
+
+"""
+Function: convolveAxisFFT
+Convolves every line along one axis of an array with a kernel, like numpy.convolve in "same" mode, by multiplying in the frequency domain.
+
+Parameters:
+matrices - the array to convolve
+kernel - the kernel
+axis - the axis along which to convolve
+
+Returns:
+The convolved array
+"""
+def convolveAxisFFT(matrices, kernel, axis):
+    matrices = rollaxis(matrices, axis, matrices.ndim)
+    n = matrices.shape[-1]
+    fullLength = n + len(kernel) - 1
+    full = fft.irfft(fft.rfft(matrices, fullLength)*fft.rfft(kernel, fullLength), fullLength)
+    center = (len(kernel) - 1)//2
+    result = full[..., center:center + n]
+    return rollaxis(result, result.ndim - 1, axis % result.ndim)
+
+"""
+Function: gaussianFilterLoop
+The original row by row version of gaussianFilter, kept as a reference for testing and benchmarking.
+
+Parameters:
+matrix - the matrix to blur
+filterSize - the number of taps in the kernel
+
+Returns:
+The blurred matrix, as a numpy array
+"""
+def gaussianFilterLoop(matrix, filterSize):
     # filters the images using a gaussian
     size = (len(matrix), len(matrix[0]))
     xFilterMatrix = zeros(size)
-    yFilterMatrix = zeros(size)
+    yFilterMatrix = zeros((size[1], size[0]))
     kernel = discreteGaussian(filterSize)
     kernelSum = sum(kernel)
 
@@ -148,21 +291,61 @@ def gaussianFilter(matrix, filterSize):
     xFilterMatrix = transpose(xFilterMatrix)
 
     # blur rows
-    for j in range(size[0]):
+    for j in range(size[1]):
         yFilterMatrix[j] = [x/kernelSum for x in convolve(xFilterMatrix[j], kernel, "same")]
 
     return transpose(yFilterMatrix)
 
-
 """
 Function: loadImage
-loads an image from the path provided. Downsamples by a factor of 9 to make images large enough to be viewed by humans. Any 3x3 square containing more dark than light is black, and vise versa.
+loads an image from the path provided. Converts it to gray-scale and, if asked, downsamples it by averaging each downsample x downsample block of pixels. If downsample does not divide the image size, the blocks along the right and bottom edges are averaged over the pixels they do contain.
 
 Parameters:
-path - the path to the image to be loaded
+path - the path to the image to be loaded, or a file object
 downsample - an integer indicating how much to downsample the image. A value of 1 indicates no downsampling
+
+Returns:
+A numpy array of the pixel values indexed [x][y]
 """
 def loadImage(path, downsample=1):
+    baseImage = Image.open(path)
+    if baseImage.mode == "1":
+        # black and white pixels are 0 or 255, as they are from pixelObj
+        matrix = asarray(baseImage.convert("L"), dtype=float)
+    elif baseImage.mode == "L":
+        matrix = asarray(baseImage, dtype=float)
+    else:
+        # we are not dealing with grayscale, but instead a color image
+        matrix = asarray(baseImage.convert("RGB"), dtype=float).sum(axis=2)/3.0
+    # PIL arrays are indexed [y][x]
+    matrix = matrix.T
+
+    if downsample > 1:
+        width, height = matrix.shape
+        blocksX = int(ceil(width/float(downsample)))
+        blocksY = int(ceil(height/float(downsample)))
+        padded = zeros((blocksX*downsample, blocksY*downsample))
+        padded[:width, :height] = matrix
+        counts = zeros(padded.shape)
+        counts[:width, :height] = 1
+        blockSums = padded.reshape(blocksX, downsample, blocksY, downsample).sum(axis=3).sum(axis=1)
+        blockCounts = counts.reshape(blocksX, downsample, blocksY, downsample).sum(axis=3).sum(axis=1)
+        matrix = npfloor(blockSums/blockCounts)
+
+    return matrix
+
+"""
+Function: loadImageLoop
+The original pixel by pixel version of loadImage, kept as a reference for testing and benchmarking. Only handles color and black and white images, and throws away the extra pixels if downsample does not divide the image size.
+
+Parameters:
+path - the path to the image to be loaded, or a file object
+downsample - an integer indicating how much to downsample the image. A value of 1 indicates no downsampling
+
+Returns:
+A list of columns of pixel values
+"""
+def loadImageLoop(path, downsample=1):
     baseImage = Image.open(path)
     pixelObj = baseImage.load()
     size = baseImage.size
@@ -180,8 +363,6 @@ def loadImage(path, downsample=1):
         matrix.append(newColumn)
 
     # downsample, if required
-    # this is messy. if downsample does not divide the image size, the extra pixels are just thrown away
-    # TODO: fix the above error
     downsampleMatrix = []
     if downsample > 1:
         for i in range(int(floor(size[0]/downsample))):
@@ -198,6 +379,33 @@ def loadImage(path, downsample=1):
 
     return downsampleMatrix
 
+"""
+Function: benchmarkLoadImage
+Times loadImage against loadImageLoop on the same image and prints the results.
+
+Parameters:
+path - the path to the image to be loaded, or a file object
+downsample - the downsample factor to pass to both
+repeats - the number of times to load the image with each
+
+Returns:
+A tuple of the mean seconds per load for loadImage and for loadImageLoop
+"""
+def benchmarkLoadImage(path, downsample=1, repeats=10):
+    times = []
+    for load in [loadImage, loadImageLoop]:
+        start = time.time()
+        for i in range(repeats):
+            if hasattr(path, "seek"):
+                path.seek(0)
+            load(path, downsample)
+        times.append((time.time() - start)/repeats)
+
+    print "loadImage:     %.5f s" % times[0]
+    print "loadImageLoop: %.5f s" % times[1]
+    print "speedup:       %.1fx" % (times[1]/times[0])
+    return tuple(times)
+
 """
 Function: saveMatrixAsImage
 Saves a black and white image file generated from the provided matrix at the specified path. Upsamples the image by a factor of 9 (9 pixels per matrix entry)
@@ -207,15 +415,9 @@ matrix - the matrix of values (1s and 0s) to be converted to an image
 path - the path at which to save the image
 """
 def saveMatrixAsImage(matrix, path):
-    size = (len(matrix), len(matrix[0]))
-    newImage = Image.new("RGB", size)
-    for i in range(size[0]):
-        for j in range(size[1]):
-            # for each entry in the matrix
-            val = int(matrix[i][j])
-            newImage.putpixel((i, j), (val, val, val))
-
-    newImage.save(path, 'PNG')
+    # matrices are indexed [x][y] and PIL arrays [y][x]
+    pixels = clip(asarray(matrix, dtype=float), 0, 255).astype(uint8).T
+    Image.fromarray(ascontiguousarray(pixels), "L").convert("RGB").save(path, 'PNG')
 
 
 """
@@ -228,8 +430,12 @@ resultFolder - folder in which to store the resulting randomized images
 randomization - probability that dictate how much to distort each base image
 numTotal - the total number of new images to produce
 numPerImage - the number of random images to produce for each base image. If left out, will be generated
+seed - the seed for the random numbers. If None, a fresh seed is used
+filterMethod - how to blur the images, as in gaussianFilterBatch
 """
-def generateRandomSets(baseFolder, resultFolder, randomization, numTotal, filterSize=10, numPerImage=None):
+def generateRandomSets(baseFolder, resultFolder, randomization, numTotal, filterSize=10, numPerImage=None, seed=None, filterMethod="direct"):
+    rng = random.RandomState(seed)
+
     # get the base image files that we will be using to generate the image set
     normpath(baseFolder) # i think this should take care of trailing separators for the name gen below
     baseImages = [join(baseFolder, f) for f in listdir(baseFolder)]
@@ -237,7 +443,7 @@ def generateRandomSets(baseFolder, resultFolder, randomization, numTotal, filter
 
     # if numPerImage was not provided or is of the wrong length, generate it
     if not numPerImage or len(numPerImage) != len(baseImages):
-        randNums = random.uniform(0.0, 1.0, len(baseImages))
+        randNums = rng.uniform(0.0, 1.0, len(baseImages))
         total = sum(randNums)
         numPerImage = [numTotal*x/total for x in randNums]
 
@@ -245,8 +451,12 @@ def generateRandomSets(baseFolder, resultFolder, randomization, numTotal, filter
     results = []
     for i in range(len(baseImages)):
         baseMatrix = loadImage(baseImages[i])
-        for j in range(numPerImage[i]):
-            randomImage = generateMatrix(baseMatrix, randomization, filterSize)
+        # randomize and blur all of this image's copies at once
+        count = int(numPerImage[i])
+        randomImages = clip(rng.normal(baseMatrix, randomization, (count,) + baseMatrix.shape), 0, 255)
+        randomImages = gaussianFilterBatch(randomImages, filterSize, filterMethod)
+        for j in range(count):
+            randomImage = randomImages[j]
             path = join(resultFolder, str(i) + "-" + str(j) + ".png")
             # save the image
             saveMatrixAsImage(randomImage, path)
@@ -3,8 +3,14 @@
 """
 Flask server
 """
-from flask import Flask, render_template, request, make_response, send_file, redirect
+from flask import Flask, render_template, request, make_response, redirect
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from threading import Lock
+import base64
 import db
+import hashlib
 import json
 import os
 import imageGen
@@ -12,6 +18,12 @@ import imageGen
 app = Flask(__name__)
 app.config['DEBUG'] = False
 
+# the most image bytes held in memory, and how long browsers may cache images
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', 64 * 1024 * 1024))
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+# the number of image set bundles held in memory
+BUNDLE_CACHE_SIZE = 16
+
 # if in DEBUG mode, set static resources to expire immediately
 if app.config['DEBUG']:
     app.get_send_file_max_age = lambda x: 0
@@ -101,6 +113,41 @@ def move():
     except KeyError:
         return "Must have value for move key in form data!", 500
 
+@app.route("/moves", methods=['POST'])
+def moves():
+    """ Adds a batch of moves to the trial. Takes a JSON body of
+    {"first_seq": index of the first move in the trial, "moves": [move, ...]}
+    and returns {"stored": number of moves stored for the trial}. Sending the
+    same batch again is harmless"""
+    # get trial id
+    trial_id = request.cookies.get('trial_id')
+    if not trial_id:
+        return "Must have a trial_id cookie!", 400
+
+    try:
+        batch = json.loads(request.data)
+        first_seq = batch['first_seq']
+        move_list = batch['moves']
+    except (ValueError, KeyError, TypeError):
+        return "Body must be JSON with first_seq and moves keys!", 400
+
+    # bool is a subclass of int, but true is not a sequence number
+    if (not isinstance(first_seq, int) or isinstance(first_seq, bool) or first_seq < 0 or
+            not isinstance(move_list, list)):
+        return "first_seq must be a non-negative integer and moves a list", 400
+
+    # make sure every move has all the necessary fields
+    for move in move_list:
+        if not isinstance(move, dict) or not db.has_move_fields(move):
+            return "Move missing some of the required fields. Check the README to see which", 400
+
+    # add the moves to the database
+    try:
+        stored = db.add_moves(trial_id, first_seq, move_list)
+    except ValueError as e:
+        return str(e), 409
+    return json.dumps({'stored': stored})
+
 @app.route("/images")
 def images():
     # get trial id
@@ -113,12 +160,108 @@ def images():
 
     return json.dumps(image_ids)
 
+class ImageCache(object):
+    """ A bounded, thread safe LRU of image files keyed by ObjectId. Holds
+    the bytes, content type and md5 of each image, and drops the least
+    recently used images once the total size passes max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.images = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, image_id):
+        """ Returns (data, content_type, md5) for the image, reading it from
+        gridFS if it isn't cached"""
+        with self.lock:
+            entry = self.images.pop(image_id, None)
+            if entry != None:
+                self.images[image_id] = entry
+                return entry
+
+        # read outside the lock so one slow read doesn't hold up the others
+        image = db.get_image_file(image_id)
+        data = image.read()
+        md5 = getattr(image, 'md5', None) or hashlib.md5(data).hexdigest()
+        entry = (data, image.content_type, md5)
+
+        with self.lock:
+            if image_id not in self.images and len(data) <= self.max_bytes:
+                self.images[image_id] = entry
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    dropped_id, dropped = self.images.popitem(last=False)
+                    self.size -= len(dropped[0])
+        return entry
+
+image_cache = ImageCache(IMAGE_CACHE_BYTES)
+
+# image set id -> (bundle JSON, ETag) for the most recently used image sets
+bundle_cache = OrderedDict()
+bundle_lock = Lock()
+
+def image_set_bundle(image_set):
+    """ Returns the JSON bundle of every image in the image set, as a list of
+    {"id": image id, "src": data URI}, and an ETag for it. Bundles are built
+    once per image set and cached"""
+    set_id = str(image_set['_id'])
+    with bundle_lock:
+        entry = bundle_cache.pop(set_id, None)
+        if entry != None:
+            bundle_cache[set_id] = entry
+            return entry
+
+    images = []
+    md5s = []
+    for image_map in image_set['images']:
+        data, content_type, md5 = image_cache.get(image_map['image_id'])
+        images.append({'id': str(image_map['image_id']),
+                       'src': 'data:%s;base64,%s' % (content_type, base64.b64encode(data))})
+        md5s.append(md5)
+    entry = (json.dumps(images), hashlib.md5(set_id + ''.join(md5s)).hexdigest())
+
+    with bundle_lock:
+        bundle_cache[set_id] = entry
+        while len(bundle_cache) > BUNDLE_CACHE_SIZE:
+            bundle_cache.popitem(last=False)
+    return entry
+
+@app.route("/images/bundle")
+def image_bundle():
+    # get trial id
+    trial_id = request.cookies.get('trial_id')
+
+    # get the trials image set
+    image_set = db.get_image_set_by_trial_id(trial_id)
+
+    bundle, etag = image_set_bundle(image_set)
+
+    # the bundle depends on the trial cookie, so only the browser may cache it
+    resp = make_response(bundle)
+    resp.mimetype = 'application/json'
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, max-age=%d' % IMAGE_MAX_AGE
+    resp.headers['Vary'] = 'Cookie'
+    return resp.make_conditional(request)
+
 @app.route("/images/<image_id>")
 def image(image_id):
+    try:
+        image_id = ObjectId(image_id)
+    except InvalidId:
+        return "No image with id " + image_id, 404
+
     # get the image
-    image = db.get_image_file(image_id)
+    data, content_type, md5 = image_cache.get(image_id)
 
-    return send_file(image, mimetype=image.content_type, cache_timeout=0)
+    # images never change once uploaded, so they can be cached for good and
+    # revalidated with their md5
+    resp = make_response(data)
+    resp.mimetype = content_type
+    resp.set_etag(md5)
+    resp.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMAGE_MAX_AGE
+    return resp.make_conditional(request)
 
 @app.route("/trial-id")
 def trial_id():
@@ -0,0 +1,180 @@
+"""
+Matrix store
+
+A persistent, memory-mapped store of the image matrices used in analysis, so
+that images don't have to be pulled out of GridFS and decoded on every run.
+
+Each image set is saved as one contiguous uint8 array of shape
+(images, width, height) in <set_id>.npy, with an index in <set_id>.json mapping
+each image id to its offset in the array. The matrices are the same as those
+returned by imageGen.loadImage, indexed [x][y], rounded by quantize.
+
+The store lives in the directory given by the MATRIX_STORE environment
+variable, or ./matrices if it is not set.
+"""
+import argparse
+import os
+# read from a mongodump instead of Mongo if GIBBS_DUMP_DIR is set
+if os.environ.get('GIBBS_DUMP_DIR'):
+    import dumpDb as db
+else:
+    import db
+import imageGen
+import json
+from numpy import rint, uint8, load
+from numpy.lib.format import open_memmap
+
+STORE_DIR = os.environ.get('MATRIX_STORE', './matrices')
+
+# store_dir -> {image_id: (set_id, offset)} for every image in each store, and
+# (store_dir, set_id) -> the open memory map of each set. Both are per process
+store_indexes = {}
+store_arrays = {}
+
+"""
+Function: quantize
+Rounds a matrix from imageGen.loadImage to the uint8 values kept in the store.
+Matrices that aren't in the store should be passed through this too, so that
+every image is seen the same way wherever it was read from.
+
+Parameters:
+matrix - the matrix of an image
+
+Returns:
+A uint8 array of the same shape
+"""
+def quantize(matrix):
+    return rint(matrix).clip(0, 255).astype(uint8)
+
+"""
+Function: build_image_set
+Decodes every image in an image set and saves them to the store.
+
+Parameters:
+set_id - the id of the image set
+store_dir - the directory of the store. Defaults to STORE_DIR
+
+Returns:
+The number of images saved
+"""
+def build_image_set(set_id, store_dir=None):
+    if store_dir == None:
+        store_dir = STORE_DIR
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    set_id = str(set_id)
+    image_set = db.get_image_set(set_id)
+    image_ids = [str(image['image_id']) for image in image_set['images']]
+
+    # write to temporary files and move them into place once complete, so
+    # readers never see a half written set
+    array_path = os.path.join(store_dir, set_id + '.npy')
+    index_path = os.path.join(store_dir, set_id + '.json')
+    matrices = None
+    for i in range(len(image_ids)):
+        matrix = imageGen.loadImage(db.get_image_file(image_ids[i]))
+        if matrices is None:
+            matrices = open_memmap(array_path + '.tmp', mode='w+', dtype=uint8,
+                                   shape=(len(image_ids),) + matrix.shape)
+        matrices[i] = quantize(matrix)
+
+    if matrices is None:
+        return 0
+    matrices.flush()
+    del matrices
+
+    f = open(index_path + '.tmp', 'w')
+    json.dump({'images': dict((image_ids[i], i) for i in range(len(image_ids)))}, f)
+    f.close()
+
+    os.rename(array_path + '.tmp', array_path)
+    os.rename(index_path + '.tmp', index_path)
+    reset()
+
+    return len(image_ids)
+
+"""
+Function: build_all
+Saves every image set in the database to the store.
+
+Parameters:
+store_dir - the directory of the store. Defaults to STORE_DIR
+rebuild - if False, image sets already in the store are skipped
+"""
+def build_all(store_dir=None, rebuild=False):
+    if store_dir == None:
+        store_dir = STORE_DIR
+
+    for image_set in db.iter_image_sets({'_id': 1}):
+        set_id = str(image_set['_id'])
+        if not rebuild and os.path.exists(os.path.join(store_dir, set_id + '.json')):
+            print "Skipping image set", set_id
+            continue
+        print "Saving image set", set_id
+        num = build_image_set(set_id, store_dir)
+        print "\tSaved", num, "images"
+
+"""
+Function: reset
+Forgets the index and open arrays, so the store is read again on next use.
+"""
+def reset():
+    store_indexes.clear()
+    store_arrays.clear()
+
+"""
+Function: load_index
+Reads the index of every image set in the store.
+"""
+def load_index(store_dir):
+    index = {}
+    if not os.path.isdir(store_dir):
+        return index
+
+    for name in os.listdir(store_dir):
+        set_id, ext = os.path.splitext(name)
+        if ext != '.json':
+            continue
+        f = open(os.path.join(store_dir, name), 'r')
+        for image_id, offset in json.load(f)['images'].iteritems():
+            index[image_id] = (set_id, offset)
+        f.close()
+    return index
+
+"""
+Function: get_matrix
+Gets the matrix for an image from the store, without copying it out of the
+memory map.
+
+Parameters:
+image_id - the id of the image
+store_dir - the directory of the store. Defaults to STORE_DIR
+
+Returns:
+A read only uint8 array, or None if the image isn't in the store
+"""
+def get_matrix(image_id, store_dir=None):
+    if store_dir == None:
+        store_dir = STORE_DIR
+    if store_dir not in store_indexes:
+        store_indexes[store_dir] = load_index(store_dir)
+
+    location = store_indexes[store_dir].get(str(image_id))
+    if location == None:
+        return None
+
+    set_id, offset = location
+    key = (store_dir, set_id)
+    if key not in store_arrays:
+        store_arrays[key] = load(os.path.join(store_dir, set_id + '.npy'), mmap_mode='r')
+    return store_arrays[key][offset]
+
+parser = argparse.ArgumentParser(description='Save the image matrices of every image set to the matrix store')
+parser.add_argument('--dir', help='the directory of the store. Defaults to $MATRIX_STORE or ./matrices')
+parser.add_argument('--rebuild', action='store_true', help='rebuild image sets already in the store')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    build_all(args.dir, args.rebuild)
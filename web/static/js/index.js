@@ -8,6 +8,11 @@ var GROUP_COL = 2;
 // Trial constants
 var ONE_PLACEMENT_PER_IMAGE = true; // first image placement cannot be changed
 
+// Move submission constants
+var BUFFER_MOVES = true; // send moves in batches instead of one request per move
+var MOVE_FLUSH_INTERVAL = 5000; // ms between sending buffered moves
+var MOVE_BATCH_SIZE = 10; // send as soon as this many moves are buffered
+
 // create a place for us to store important variables on the doc
 var gibbs = {};
 gibbs.dragObj = null;
@@ -18,6 +23,9 @@ gibbs.images = [];
 gibbs.objects = {};
 gibbs.trialFinished = false;
 gibbs.highestZ = 2;
+gibbs.moveBuffer = []; // moves not yet stored by the server, in order
+gibbs.movesStored = 0; // the number of moves the server has stored
+gibbs.flushing = false;
 
 /*
  * Function: cancel
@@ -118,28 +126,59 @@ function randomizeList(l) {
 
 /*
  * Function: loadImages
- * loads all images from server (or, as of now, from a given URL) and saves them
- * in the gibbs.images array
+ * loads all images of the trial's image set from the server in one request and
+ * saves them in the gibbs.images array. Falls back on loading each image
+ * separately if the bundle can't be fetched
  */
 function loadImages() {
+    $.ajax({
+        url: "/images/bundle",
+        success: function(data) {
+            var bundle = (typeof data === "string") ? JSON.parse(data) : data;
+            addImages(bundle);
+        },
+        error: loadImagesSeparately,
+        async: false
+    });
+}
+
+/*
+ * Function: loadImagesSeparately
+ * loads the list of image ids from the server and points each image at its own
+ * URL
+ */
+function loadImagesSeparately() {
     $.ajax({
         url: "/images",
         success: function(data) {
             var imageIDs = JSON.parse(data);
-            gibbs.counter = imageIDs.length + 1;
+            var bundle = [];
             for (i = 0; i < imageIDs.length; i++) {
-                var id = imageIDs[i];
-                var newImage = new Image("/images/" + id, gibbs.game, id);
-                gibbs.objects[id] = newImage;
-                gibbs.images.push(newImage);
+                bundle.push({id: imageIDs[i], src: "/images/" + imageIDs[i]});
             }
-            // randomize
-            randomizeList(gibbs.images);
+            addImages(bundle);
         },
         async: false
     });
 }
 
+/*
+ * Function: addImages
+ * creates an Image for each {id, src} entry and saves them, in random order, in
+ * the gibbs.images array
+ */
+function addImages(bundle) {
+    gibbs.counter = bundle.length + 1;
+    for (i = 0; i < bundle.length; i++) {
+        var id = bundle[i].id;
+        var newImage = new Image(bundle[i].src, gibbs.game, id);
+        gibbs.objects[id] = newImage;
+        gibbs.images.push(newImage);
+    }
+    // randomize
+    randomizeList(gibbs.images);
+}
+
 /*
  * Function: loadGroups
  * Creates the first group on screen
@@ -173,6 +212,7 @@ function warn(text) {
   */
 function endTrial() {
   gibbs.trialFinished = true;
+  flushMoves(true);
   $('#noMoreImages').show();
   $.ajax({
     url: '/trial-id',
@@ -278,18 +318,74 @@ function sendMoveData(image, groupID) {
         time_elapsed: time_elasped
     };
 
-    // post the move data in a form to the database
-    var moveForm = new FormData();
-    moveForm.append('move', JSON.stringify(moveData));
+    gibbs.moveBuffer.push(moveData);
+    if (!BUFFER_MOVES || gibbs.trialFinished || gibbs.moveBuffer.length >= MOVE_BATCH_SIZE) {
+        flushMoves(false);
+    }
+}
+
+/*
+ * Function: flushMoves
+ * Sends the buffered moves to the server in one request. Each batch carries
+ * the index of its first move, so a batch that is sent again after a failure
+ * is not stored twice. Moves are only dropped from the buffer once the server
+ * says it has them.
+ *
+ * Parameters:
+ * sync - if true, waits for the server to respond before returning
+ */
+function flushMoves(sync) {
+    if (gibbs.moveBuffer.length == 0 || (gibbs.flushing && !sync)) {
+        return;
+    }
+    gibbs.flushing = true;
 
     $.ajax({
-        url: "/move",
-        data: moveForm,
+        url: "/moves",
+        data: JSON.stringify({first_seq: gibbs.movesStored, moves: gibbs.moveBuffer}),
+        contentType: "application/json",
         processData: false,
-        contentType: false,
-        type: 'POST'
+        type: 'POST',
+        async: !sync,
+        success: function(data) {
+            movesStored(JSON.parse(data).stored);
+        },
+        complete: function() {
+            gibbs.flushing = false;
+        }
     });
 }
+
+/*
+ * Function: movesStored
+ * Drops the moves the server has stored from the buffer
+ *
+ * Parameters:
+ * stored - the number of moves the server has stored
+ */
+function movesStored(stored) {
+    if (stored > gibbs.movesStored) {
+        gibbs.moveBuffer.splice(0, stored - gibbs.movesStored);
+        gibbs.movesStored = stored;
+    }
+}
+
+/*
+ * Function: flushMovesOnUnload
+ * Sends any buffered moves as the page is closed, using a beacon where the
+ * browser supports one so the page doesn't have to wait
+ */
+function flushMovesOnUnload() {
+    if (gibbs.moveBuffer.length == 0) {
+        return;
+    }
+    var batch = JSON.stringify({first_seq: gibbs.movesStored, moves: gibbs.moveBuffer});
+    if (navigator.sendBeacon && navigator.sendBeacon("/moves", new Blob([batch], {type: "application/json"}))) {
+        return;
+    }
+    flushMoves(true);
+}
+
 ///////////////////////////////////////////////////////////////////////////////
 ///////////////////////////////// Image Object ////////////////////////////////
 ///////////////////////////////////////////////////////////////////////////////
@@ -718,4 +814,10 @@ $(document).ready(function() {
         sizeDocument();
         cancel(ev);
     });
+
+    // send buffered moves every so often, and before the page goes away
+    setInterval(function() {
+        flushMoves(false);
+    }, MOVE_FLUSH_INTERVAL);
+    $(window).on('pagehide beforeunload', flushMovesOnUnload);
 });
@@ -1,7 +1,24 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from StringIO import StringIO
 from numpy import *
-from numpy.testing import assert_approx_equal
+from numpy.testing import assert_approx_equal, assert_allclose, assert_array_equal
+from PIL import Image
 import analysis
+import db
+import dumpDb
+import imageGen
+import main
+import matrixStore
+import trialArrays
 
 class TestDiscreteTruncT(unittest.TestCase):
     def test_default_loc_and_scale(self):
@@ -53,6 +70,116 @@ class TestDiscreteTruncT(unittest.TestCase):
         self.assertTrue(result[0] > result[1])
 
 
+class TestFastDiscreteTruncT(unittest.TestCase):
+    def test_matches_exact(self):
+        # set up an image-like test with per-pixel mean and scale
+        random.seed(0)
+        x = random.randint(0, 256, (6, 6))
+        loc = random.uniform(0, 255, (6, 6))
+        scale = random.uniform(1, 80, (6, 6))
+
+        exact = analysis.discrete_trunc_t_logpdf(x, 3.5, range(256), loc=loc, scale=scale)
+        fast = analysis.fast_discrete_trunc_t_logpdf(x, 3.5, range(256), loc=loc, scale=scale)
+
+        assert_allclose(fast, exact)
+
+    def test_scalar_params(self):
+        x = arange(12).reshape((3,4))
+        exact = analysis.discrete_trunc_t_logpdf(x, 4, range(12), loc=5, scale=2)
+        fast = analysis.fast_discrete_trunc_t_logpdf(x, 4, range(12), loc=5, scale=2)
+
+        assert_allclose(fast, exact)
+        assert_approx_equal(sum(exp(fast[0,:])), sum(exp(exact[0,:])))
+
+    def test_unordered_domain(self):
+        domain = [3, 1, 2, 0]
+        exact = analysis.discrete_trunc_t_logpdf([0, 2, 3], 1, domain, loc=1)
+        fast = analysis.fast_discrete_trunc_t_logpdf([0, 2, 3], 1, domain, loc=1)
+
+        assert_allclose(fast, exact)
+
+    def test_value_outside_domain(self):
+        self.assertRaises(ValueError, analysis.fast_discrete_trunc_t_logpdf, [0, 2], 1, range(2))
+        self.assertRaises(ValueError, analysis.fast_discrete_trunc_t_logpdf, [0.5], 1, range(2))
+
+
+class TestNormalizerTable(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.x = random.randint(0, 256, (20, 20))
+        self.loc = random.uniform(0, 255, (20, 20))
+        self.scale = exp(random.uniform(log(3), log(150), (20, 20)))
+
+    def test_matches_exact(self):
+        exact = analysis.fast_discrete_trunc_t_logpdf(self.x, 3.0, range(256),
+                                                      loc=self.loc, scale=self.scale)
+        table = analysis.table_discrete_trunc_t_logpdf(self.x, 3.0,
+                                                       loc=self.loc, scale=self.scale)
+
+        assert_allclose(table, exact, rtol=0, atol=1e-3)
+        assert_allclose(sum(table), sum(exact), rtol=0, atol=1e-2)
+
+    def test_finer_tolerance(self):
+        exact = analysis.fast_discrete_trunc_t_logpdf(self.x, 5.0, range(256),
+                                                      loc=self.loc, scale=self.scale)
+        coarse = analysis.table_discrete_trunc_t_logpdf(self.x, 5.0, loc=self.loc,
+                                                        scale=self.scale, tolerance=2.0)
+        fine = analysis.table_discrete_trunc_t_logpdf(self.x, 5.0, loc=self.loc,
+                                                      scale=self.scale, tolerance=0.5)
+
+        self.assertTrue(abs(fine - exact).max() < abs(coarse - exact).max())
+
+    def test_outside_table(self):
+        # scales below NORMALIZER_MIN_SCALE are computed exactly
+        scale = self.scale.copy()
+        scale[0] = 0.5
+        exact = analysis.fast_discrete_trunc_t_logpdf(self.x, 3.0, range(256),
+                                                      loc=self.loc, scale=scale)
+        table = analysis.table_discrete_trunc_t_logpdf(self.x, 3.0, loc=self.loc, scale=scale)
+
+        assert_allclose(table[0], exact[0])
+
+    def test_lru_eviction(self):
+        old_size = analysis.NORMALIZER_CACHE_SIZE
+        old_tables = analysis.normalizer_tables.copy()
+        try:
+            analysis.NORMALIZER_CACHE_SIZE = 2
+            analysis.normalizer_tables.clear()
+            analysis.get_normalizer_table(2.0)
+            analysis.get_normalizer_table(3.0)
+            analysis.get_normalizer_table(2.0)
+            analysis.get_normalizer_table(4.0)
+
+            keys = [key[0] for key in analysis.normalizer_tables.keys()]
+            self.assertEqual(keys, [2.0, 4.0])
+        finally:
+            analysis.NORMALIZER_CACHE_SIZE = old_size
+            analysis.normalizer_tables.clear()
+            analysis.normalizer_tables.update(old_tables)
+
+
+class TestClosedFormNormalizer(unittest.TestCase):
+    def setUp(self):
+        random.seed(3)
+        self.x = random.randint(0, 256, (20, 20))
+        self.df = random.uniform(0.5, 60, (20, 20))
+        self.loc = random.uniform(-50, 300, (20, 20))
+        self.scale = exp(random.uniform(log(0.5), log(2000), (20, 20)))
+
+    def test_matches_exact(self):
+        closed_form = analysis.closed_form_discrete_trunc_t_logpdf(self.x, self.df, self.loc, self.scale)
+        for i in range(20):
+            exact = analysis.fast_discrete_trunc_t_logpdf(self.x[i], self.df[i], range(256),
+                                                          loc=self.loc[i], scale=self.scale[i])
+            assert_allclose(closed_form[i], exact, rtol=0, atol=1e-5)
+
+    def test_broadcasts(self):
+        normalizer = analysis.closed_form_log_normalizer(self.df[:, :1], self.loc, 20.0)
+
+        self.assertEqual(normalizer.shape, (20, 20))
+        assert_allclose(normalizer[3], analysis.closed_form_log_normalizer(self.df[3, 0], self.loc[3], 20.0))
+
+
 class TestLogLikelihood(unittest.TestCase):
     def setUp(self):
         # create images and add them to the image_matrices dict
@@ -199,6 +326,1308 @@ class TestLogLikelihood(unittest.TestCase):
         assert_approx_equal(mostly_black_to_white, mostly_white_to_black)
         self.assertTrue(mostly_black_to_black > mostly_black_to_white)
 
+class FakeTrials(object):
+    # serves trials from a dict in place of db
+    def __init__(self, trials):
+        self.trials = trials
+
+    def get_trial(self, trial_id):
+        return self.trials[trial_id]
+
+    def iter_trials(self, fields=None):
+        return iter([self.trials[trial_id] for trial_id in sorted(self.trials)])
+
+
+# makes a trial document from (image_id, group) pairs for its initial state and moves
+def fake_trial(trial_id, init_state, moves):
+    return {'_id': trial_id,
+            'init_state': [{'_id': image_id, 'group': group} for image_id, group in init_state],
+            'moves': [{'image_id': image_id, 'new_group': group} for image_id, group in moves]}
+
+
+class AnalysisTest(unittest.TestCase):
+    # base for tests that put images in analysis.image_matrices or serve trials
+    # from FakeTrials. Both module globals are put back after each test
+    def keep_globals(self):
+        if not hasattr(self, 'saved_globals'):
+            self.saved_globals = (dict(analysis.image_matrices), analysis.db)
+            self.addCleanup(self.restore_globals)
+
+    def restore_globals(self):
+        image_matrices, old_db = self.saved_globals
+        analysis.image_matrices.clear()
+        analysis.image_matrices.update(image_matrices)
+        analysis.db = old_db
+        del self.saved_globals
+
+    # fills analysis.image_matrices with count random images named prefix0,
+    # prefix1, ..., returning their ids
+    def add_images(self, prefix, count, seed, shape=(3, 3)):
+        self.keep_globals()
+        random.seed(seed)
+        ids = ['%s%d' % (prefix, i) for i in range(count)]
+        for image_id in ids:
+            analysis.image_matrices[image_id] = random.randint(0, 256, shape).astype(float)
+        return ids
+
+    # serves trials from analysis.db, keeping them in self.trials by id
+    def use_trials(self, trials):
+        self.keep_globals()
+        self.trials = dict((trial['_id'], trial) for trial in trials)
+        analysis.db = FakeTrials(self.trials)
+
+
+class TestGroupStatistics(AnalysisTest):
+    def setUp(self):
+        self.ids = self.add_images('stats', 5, seed=2)
+        self.partition = {'stats0': 0, 'stats1': 0, 'stats2': 1, 'stats3': 0}
+
+    def check_group(self, stats, partition, group):
+        members = [analysis.image_matrices[i] for i in analysis.images_in_group(partition, group)]
+        n, group_mean, group_var = stats.summary(group)
+
+        self.assertEqual(n, len(members))
+        assert_allclose(group_mean, mean(members, axis=0))
+        assert_allclose(group_var, var(members, axis=0), atol=1e-8)
+
+    def test_initial_statistics(self):
+        stats = analysis.GroupStatistics(self.partition)
+
+        self.check_group(stats, self.partition, 0)
+        self.check_group(stats, self.partition, 1)
+        self.assertEqual(stats.summary(2), (0, 0, 0))
+
+    def test_move(self):
+        stats = analysis.GroupStatistics(self.partition)
+        self.partition['stats1'] = 1
+        self.partition['stats4'] = 2
+        stats.move('stats1', 1)
+        stats.move('stats4', 2)
+
+        for group in [0, 1, 2]:
+            self.check_group(stats, self.partition, group)
+
+    def test_sync(self):
+        stats = analysis.GroupStatistics(self.partition)
+        partition = {'stats0': 1, 'stats2': 1, 'stats4': 0}
+        stats.sync(partition)
+
+        self.check_group(stats, partition, 0)
+        self.check_group(stats, partition, 1)
+        self.assertEqual(sorted(stats.assignments.keys()), sorted(partition.keys()))
+
+    def test_log_likelihood_matches(self):
+        stats = analysis.GroupStatistics(self.partition)
+        for group in [0, 1, 2]:
+            with_stats = analysis.log_likelihood(self.partition, group, 'stats4', group_stats=stats)
+            without_stats = analysis.log_likelihood(self.partition, group, 'stats4')
+            assert_approx_equal(with_stats, without_stats)
+
+    # the log likelihood of one group, as the original per-group code found it,
+    # from the member images and the reference discrete_trunc_t_logpdf
+    def reference_log_likelihood(self, group, image_id, prior_mean, mean_conf, prior_var, var_conf):
+        members = [analysis.image_matrices[i] for i in analysis.images_in_group(self.partition, group)]
+        n = len(members)
+        group_mean = mean(members, axis=0) if n > 0 else 0
+        group_var = var(members, axis=0) if n > 0 else 0
+        l = mean_conf + n
+        a = var_conf + n
+        mu = (mean_conf * prior_mean + n * group_mean) / l
+        sig_sq = (var_conf * prior_var + (n - 1) * group_var +
+                  mean_conf * n * (prior_mean - group_mean) ** 2 / l) / a
+        scale = sqrt(sig_sq * (1 + 1 / l))
+        image = analysis.image_matrices[image_id]
+        return sum(analysis.discrete_trunc_t_logpdf(image, a, range(256), loc=mu, scale=scale))
+
+    def test_batch_log_likelihood(self):
+        stats = analysis.GroupStatistics(self.partition)
+        old_use_table = analysis.USE_NORMALIZER_TABLE
+        try:
+            for params in [(analysis.mu0, analysis.l0, analysis.sig_sq0, analysis.a0),
+                           (90.0, 3.0, 2000.0, 6.0)]:
+                expected = [self.reference_log_likelihood(group, 'stats4', *params) for group in [0, 1, 2]]
+
+                analysis.USE_NORMALIZER_TABLE = False
+                assert_allclose(analysis.batch_log_likelihood(stats, [0, 1, 2], 'stats4', *params),
+                                expected, rtol=1e-10)
+                # the normalizer table is within its tolerance of the exact values
+                analysis.USE_NORMALIZER_TABLE = True
+                assert_allclose(analysis.batch_log_likelihood(stats, [0, 1, 2], 'stats4', *params),
+                                expected, rtol=1e-3)
+        finally:
+            analysis.USE_NORMALIZER_TABLE = old_use_table
+
+    def test_move_probability_normalized(self):
+        move = {'image_id': 'stats4', 'new_group': 2}
+        probs = analysis.move_probability(self.partition, move)
+
+        self.assertEqual(sorted(probs.keys()), [0, 1, 2])
+        assert_approx_equal(sum(exp(probs.values())), 1)
+
+class TestMoveLikelihoodState(AnalysisTest):
+    def setUp(self):
+        self.ids = self.add_images('state', 6, seed=4, shape=(4, 4))
+        self.partition = {'state0': 0, 'state1': 0, 'state2': 1, 'state3': 0, 'state4': 1}
+        self.move = {'image_id': 'state5', 'new_group': 1}
+
+    def test_matches_move_probability(self):
+        state = analysis.MoveLikelihoodState(self.partition, self.move)
+        probs = state.log_move_probs(120.0, 2.0, 3000.0, 5.0, 4.0)
+        expected = analysis.move_probability(self.partition, self.move, 120.0, 2.0, 3000.0, 5.0, 4.0)
+
+        self.assertEqual(state.groups, [0, 1, 2])
+        for i, group in enumerate(state.groups):
+            assert_allclose(probs[0, i], expected[group], rtol=0, atol=1e-4)
+
+    def test_batch_matches_single(self):
+        state = analysis.MoveLikelihoodState(self.partition, self.move)
+        mean_conf = [0.5, 3.0, 10.0]
+        var_conf = [2.0, 8.0, 40.0]
+        dispersion = [1.0, 5.0, 30.0]
+        batch = state.log_move_probs(127.5, mean_conf, 4096.0, var_conf, dispersion)
+
+        self.assertEqual(batch.shape, (3, 3))
+        for k in range(3):
+            single = analysis.MoveLikelihoodState(self.partition, self.move).log_move_probs(
+                127.5, mean_conf[k], 4096.0, var_conf[k], dispersion[k])
+            assert_allclose(batch[k], single[0])
+
+    def test_priors_match(self):
+        state = analysis.MoveLikelihoodState(self.partition, self.move)
+        priors = state.log_priors([3.0, 30.0])
+        for i, group in enumerate(state.groups):
+            assert_allclose(priors[:, i], [analysis.log_prior(self.partition, group, 3.0),
+                                           analysis.log_prior(self.partition, group, 30.0)])
+
+    def test_likelihood_cache(self):
+        old_size = analysis.LIKELIHOOD_CACHE_SIZE
+        try:
+            analysis.LIKELIHOOD_CACHE_SIZE = 2
+            state = analysis.MoveLikelihoodState(self.partition, self.move)
+            first = state.log_likelihoods(127.5, [1.0, 2.0, 3.0], 4096.0, 5.0)
+
+            self.assertEqual(len(state.likelihood_cache), 2)
+            assert_allclose(state.log_likelihoods(127.5, 3.0, 4096.0, 5.0)[0], first[2])
+        finally:
+            analysis.LIKELIHOOD_CACHE_SIZE = old_size
+
+    def test_find_params_for_move(self):
+        old_walk_in, old_samples = analysis.walk_in, analysis.samples
+        try:
+            analysis.walk_in, analysis.samples = 2, 2
+            random.seed(5)
+            params = analysis.find_params_for_move(self.partition, self.move, proposals=3)
+        finally:
+            analysis.walk_in, analysis.samples = old_walk_in, old_samples
+
+        self.assertEqual(len(params), 5)
+        self.assertTrue(all(params > 0))
+        self.assertTrue(params[1] <= 500 and params[3] <= 500 and params[4] <= 1000)
+
+class TestChainDiagnostics(unittest.TestCase):
+    def setUp(self):
+        random.seed(6)
+
+    def ar1(self, chains, draws, rho):
+        values = zeros((chains, draws))
+        values[:, 0] = random.normal(size=chains)
+        for i in range(1, draws):
+            values[:, i] = rho * values[:, i - 1] + sqrt(1 - rho ** 2) * random.normal(size=chains)
+        return values
+
+    def test_mixed_chains(self):
+        draws = random.normal(size=(4, 500))
+
+        self.assertTrue(abs(analysis.potential_scale_reduction(draws) - 1) < 0.02)
+        ess = analysis.effective_sample_size(draws)
+        self.assertTrue(1600 < ess < 2400)
+
+    def test_separate_chains(self):
+        draws = random.normal(size=(4, 500)) + arange(4).reshape((-1, 1))
+
+        self.assertTrue(analysis.potential_scale_reduction(draws) > 1.5)
+
+    def test_correlated_chains(self):
+        # the ess of an AR(1) chain is about n (1 - rho) / (1 + rho)
+        ess = analysis.effective_sample_size(self.ar1(4, 2000, 0.9))
+
+        self.assertTrue(250 < ess < 600)
+
+    def test_stuck_chains(self):
+        self.assertEqual(analysis.potential_scale_reduction(ones((3, 10))), 1.0)
+        self.assertEqual(analysis.potential_scale_reduction(ones((3, 10)) * arange(3).reshape((-1, 1))), inf)
+        self.assertTrue(isnan(analysis.effective_sample_size(ones((3, 10)))))
+
+    def test_summarize_chains(self):
+        draws = zeros((4, 400, 5)) + analysis.START_PARAMS
+        for index in analysis.PARAM_STEPS:
+            draws[:, :, index] += random.normal(size=(4, 400))
+        draws[:, :200] += 100
+        summary = analysis.summarize_chains(draws)
+
+        # the warm up half is dropped
+        assert_allclose(summary['mean']['mean_conf'], 0.5, atol=0.2)
+        self.assertEqual(summary['mean']['prior_var'], analysis.START_PARAMS[2])
+        self.assertEqual(sorted(summary['rhat'].keys()), ['dispersion', 'mean_conf', 'var_conf'])
+        self.assertTrue(summary['converged'])
+        self.assertFalse(analysis.summarize_chains(draws, min_ess=1000)['converged'])
+        json.dumps(summary)
+
+
+class TestParamChains(AnalysisTest):
+    def setUp(self):
+        self.ids = self.add_images('chain', 4, seed=7)
+        self.partition = {'chain0': 0, 'chain1': 0, 'chain2': 1}
+        self.move = {'image_id': 'chain3', 'new_group': 1}
+
+    def test_stops_at_max_sweeps(self):
+        old_threshold = analysis.RHAT_THRESHOLD
+        try:
+            analysis.RHAT_THRESHOLD = 0
+            summary = analysis.find_params_with_chains(self.partition, self.move, chains=2,
+                                                       proposals=2, max_sweeps=15)
+        finally:
+            analysis.RHAT_THRESHOLD = old_threshold
+
+        self.assertEqual(summary['sweeps'], 15)
+        self.assertEqual(summary['chains'], 2)
+        self.assertFalse(summary['converged'])
+
+    def test_stops_once_converged(self):
+        old_threshold, old_ess = analysis.RHAT_THRESHOLD, analysis.MIN_ESS
+        try:
+            analysis.RHAT_THRESHOLD, analysis.MIN_ESS = 100, 1
+            summary = analysis.find_params_with_chains(self.partition, self.move, chains=2,
+                                                       proposals=2, max_sweeps=200)
+        finally:
+            analysis.RHAT_THRESHOLD, analysis.MIN_ESS = old_threshold, old_ess
+
+        self.assertTrue(summary['converged'])
+        self.assertTrue(summary['sweeps'] < 200)
+
+    def test_pool_matches_serial(self):
+        random.seed(8)
+        serial = analysis.find_params_with_chains(self.partition, self.move, chains=2,
+                                                  proposals=2, max_sweeps=10)
+        pool = analysis.Pool(2)
+        try:
+            random.seed(8)
+            pooled = analysis.find_params_with_chains(self.partition, self.move, chains=2, pool=pool,
+                                                      proposals=2, max_sweeps=10)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.assertEqual(serial, pooled)
+
+    def test_replay_trial(self):
+        trial = {'init_state': [{'_id': 'chain0', 'group': 0}, {'_id': 'chain1', 'group': -1}],
+                 'moves': [{'image_id': 'chain1', 'new_group': 0},
+                           {'image_id': 'chain2', 'new_group': 1},
+                           {'image_id': 'chain0', 'new_group': 1}]}
+        partitions = [(move_num, dict(partition), stats.summary(1)[0])
+                      for move_num, move, partition, stats in analysis.replay_trial(trial)]
+
+        self.assertEqual(partitions, [(0, {'chain0': 0}, 0),
+                                      (1, {'chain0': 0, 'chain1': 0}, 0),
+                                      (2, {'chain0': 0, 'chain1': 0, 'chain2': 1}, 1)])
+
+class QuadraticTarget(object):
+    # a log_target that peaks at mean_conf 3, var_conf 20 and dispersion 7
+    def log_target(self, prior_mean, mean_conf, prior_var, var_conf, dispersion):
+        return -((log(mean_conf) - log(3)) ** 2 + (log(var_conf) - log(20)) ** 2 +
+                 (log(dispersion) - log(7)) ** 2 + (prior_mean - 127.5) ** 2)
+
+
+class TestPooledParams(AnalysisTest):
+    def setUp(self):
+        self.add_images('pooled', 5, seed=9)
+        self.trials = [fake_trial('a', [('pooled0', 0)], [('pooled1', 0), ('pooled2', 1), ('pooled3', 0)]),
+                       fake_trial('b', [], [('pooled4', 0), ('pooled0', 0)])]
+
+    def test_sums_moves(self):
+        state = analysis.PooledLikelihoodState(self.trials)
+        total = state.log_target(127.5, [0.5, 4.0], 4096.0, [10.0, 2.0], [3.0, 9.0])
+        move_states = list(state.move_states())
+
+        self.assertEqual(state.moves, 3)
+        self.assertEqual(len(move_states), 3)
+        partition = {'pooled0': 0, 'pooled1': 0}
+        move = self.trials[0]['moves'][1]
+        single = analysis.MoveLikelihoodState(partition, move).log_target(127.5, 4.0, 4096.0, 2.0, 9.0)
+        assert_allclose(single, move_states[0].log_target(127.5, 4.0, 4096.0, 2.0, 9.0))
+        assert_allclose(total, sum([move_state.log_target(127.5, [0.5, 4.0], 4096.0, [10.0, 2.0], [3.0, 9.0])
+                                    for move_state in move_states], axis=0))
+        # each call replays the trials, and gives the same answer
+        assert_allclose(state.log_target(127.5, [0.5, 4.0], 4096.0, [10.0, 2.0], [3.0, 9.0]), total)
+
+    def test_maximize_finds_peak(self):
+        fit = analysis.maximize_log_target(QuadraticTarget())
+
+        self.assertTrue(fit['converged'])
+        assert_allclose([fit['params']['mean_conf'], fit['params']['var_conf'], fit['params']['dispersion']],
+                        [3, 20, 7], rtol=0.02)
+        self.assertEqual(fit['params']['prior_var'], analysis.START_PARAMS[2])
+        self.assertTrue(fit['evaluations'] < 50)
+
+    def test_maximize_respects_bounds(self):
+        fit = analysis.maximize_log_target(QuadraticTarget(), bounds={1: (0.1, 2.0), 4: (10.0, 20.0)})
+
+        assert_allclose(fit['params']['mean_conf'], 2.0, rtol=1e-2)
+        assert_allclose(fit['params']['dispersion'], 10.0, rtol=1e-6)
+        self.assertEqual(fit['params']['var_conf'], analysis.START_PARAMS[3])
+
+    def test_fit_pooled_params(self):
+        fit = analysis.fit_pooled_params(self.trials, 'map')
+        state = analysis.PooledLikelihoodState(self.trials)
+        start = state.log_target(*analysis.START_PARAMS)[0]
+
+        self.assertEqual(fit['moves'], 3)
+        self.assertTrue(fit['log_likelihood'] >= start)
+        best = [fit['params'][name] for name in analysis.PARAM_NAMES]
+        assert_allclose(state.log_target(*best)[0], fit['log_likelihood'])
+        json.dumps(fit)
+        self.assertRaises(ValueError, analysis.fit_pooled_params, self.trials, 'guess')
+
+class TestPooledGroups(AnalysisTest):
+    def setUp(self):
+        moves = [{'image_id': 'x', 'new_group': 0}, {'image_id': 'y', 'new_group': 0}]
+        testers = {'a': 'alice', 'b': 'Mechanical Turker', 'c': 'alice', 'd': 'Mechanical Turker', 'e': 'bob'}
+        trials = [{'_id': trial_id, 'tester': tester, 'moves': moves}
+                  for trial_id, tester in testers.iteritems()]
+        self.use_trials(trials + [{'_id': 'f', 'tester': 'bob', 'moves': moves[:1]}])
+        self.fit_pooled_group = analysis.fit_pooled_group
+        analysis.fit_pooled_group = lambda args: {'_id': args[0], 'trial_ids': args[1], 'fit': {}, 'time': 0}
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        analysis.fit_pooled_group = self.fit_pooled_group
+        shutil.rmtree(self.dir)
+
+    def groups(self, pooled_by):
+        path = os.path.join(self.dir, pooled_by + '.jsonl')
+        analysis.run_pooled_fits(path, pooled_by)
+        return [(result['_id'], result['trial_ids']) for result in map(json.loads, open(path))]
+
+    def test_by_tester(self):
+        # the turk trials share a tester name, so each is its own group
+        self.assertEqual(self.groups('tester'), [('alice', ['a', 'c']), ('b', ['b']),
+                                                 ('d', ['d']), ('bob', ['e'])])
+
+    def test_by_trial(self):
+        self.assertEqual(self.groups('trial'), [(trial_id, [trial_id]) for trial_id in 'abcde'])
+
+    def test_rejected(self):
+        self.assertRaises(ValueError, analysis.run_pooled_fits, None, 'tester', turk=True)
+        self.assertRaises(ValueError, analysis.run_pooled_fits, None, 'image')
+
+
+class TestHyperparameters(AnalysisTest):
+    def setUp(self):
+        self.add_images('hyper', 4, seed=10)
+        self.use_trials([fake_trial('a', [], [('hyper0', 0), ('hyper1', 1), ('hyper2', 0)]),
+                         fake_trial('b', [('hyper3', 0)], [('hyper0', 0), ('hyper1', 0)])])
+
+    def test_matches_pooled(self):
+        settings = ([100.0, 127.5], [0.5, 3.0], [4096.0, 1000.0], [2.0, 9.0], [30.0, 4.0])
+        pooled = analysis.PooledLikelihoodState(self.trials.values()).log_target(*settings)
+
+        assert_allclose(analysis.TrialsLikelihood(['a', 'b']).log_target(*settings), pooled)
+        pool = analysis.Pool(2)
+        try:
+            assert_allclose(analysis.TrialsLikelihood(['a', 'b'], pool).log_target(*settings), pooled)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_optimize_hyperparameters(self):
+        path = tempfile.mktemp(suffix='.json')
+        try:
+            fit = analysis.optimize_hyperparameters(out_path=path)
+            saved = json.load(open(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        start = analysis.TrialsLikelihood(['a', 'b']).log_target()[0]
+        self.assertTrue(fit['log_likelihood'] >= start)
+        self.assertEqual(fit['trial_ids'], ['a', 'b'])
+        self.assertTrue(fit['evaluations'] <= analysis.HYPERPARAM_MAX_EVALS)
+        for index, name in enumerate(analysis.PARAM_NAMES):
+            lower, upper = analysis.HYPERPARAM_BOUNDS[index]
+            self.assertTrue(lower <= fit['params'][name] <= upper)
+        self.assertEqual(saved['params'], fit['params'])
+
+class TestGridSweep(AnalysisTest):
+    def setUp(self):
+        self.add_images('grid', 4, seed=11)
+        self.use_trials([fake_trial('a', [], [('grid0', 0), ('grid1', 1), ('grid2', 0)]),
+                         fake_trial('b', [('grid3', 0)], [('grid0', 1), ('grid1', 0)])])
+        self.grid = ([0.5, 5.0], [2.0, 20.0, 200.0], [1.0, 30.0])
+        self.path = tempfile.mktemp(suffix='.npz')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_grid_matches_points(self):
+        partition = {'grid0': 0, 'grid1': 1}
+        move = self.trials['a']['moves'][2]
+        state = analysis.MoveLikelihoodState(partition, move)
+        log_probs = analysis.grid_log_probs(state, *self.grid)
+
+        self.assertEqual(log_probs.shape, (2, 3, 2))
+        for i, mean_conf in enumerate(self.grid[0]):
+            for j, var_conf in enumerate(self.grid[1]):
+                for k, dispersion in enumerate(self.grid[2]):
+                    single = analysis.MoveLikelihoodState(partition, move).log_target(
+                        analysis.mu0, mean_conf, analysis.sig_sq0, var_conf, dispersion)
+                    assert_allclose(log_probs[i, j, k], single[0])
+
+    def test_sweep_trial(self):
+        log_probs = analysis.sweep_trial(self.trials['a'], *self.grid)
+
+        self.assertEqual(log_probs.shape, (3, 2, 3, 2))
+        self.assertEqual(log_probs.dtype, float32)
+        self.assertTrue(all(log_probs[0] == 0))
+        expected = analysis.move_probability({'grid0': 0}, self.trials['a']['moves'][1],
+                                             mean_conf=5.0, var_conf=20.0, dispersion=30.0)
+        assert_allclose(log_probs[1, 1, 1, 1], expected[1], rtol=1e-5)
+
+    def test_run_grid_sweep(self):
+        analysis.run_grid_sweep(self.path, *self.grid)
+        arrays = trialArrays.load_arrays(self.path)
+
+        self.assertEqual(arrays['log_likelihood'].shape, (5, 2, 3, 2))
+        self.assertEqual(list(arrays['trial_ids']), ['a', 'b'])
+        self.assertEqual(list(arrays['trial_offsets']), [0, 3, 5])
+        self.assertEqual(list(arrays['trial']), [0, 0, 0, 1, 1])
+        self.assertEqual(list(arrays['move']), [0, 1, 2, 0, 1])
+        assert_allclose(arrays['var_conf'], self.grid[1])
+        assert_allclose(arrays['log_likelihood'][3:], analysis.sweep_trial(self.trials['b'], *self.grid))
+
+class TestResultsSerialization(unittest.TestCase):
+    def test_json_default(self):
+        trial = {'_id': ObjectId('50ccf7d809fedb0002ada440'),
+                 'image_set': DBRef('images', ObjectId('50ccf7b609fedb0002ada39d')),
+                 'params': array([1.0, 2.0]),
+                 'likelihood': float64(-3.5)}
+        result = json.loads(json.dumps(trial, default=analysis.json_default))
+
+        self.assertEqual(result['_id'], '50ccf7d809fedb0002ada440')
+        self.assertEqual(result['image_set'], '50ccf7b609fedb0002ada39d')
+        self.assertEqual(result['params'], [1.0, 2.0])
+        self.assertEqual(result['likelihood'], -3.5)
+
+    def test_write_result(self):
+        f = tempfile.TemporaryFile()
+        analysis.write_result(f, {'_id': '1', 'moves': []})
+        analysis.write_result(f, {'_id': '2', 'moves': []})
+        f.seek(0)
+
+        self.assertEqual([json.loads(line)['_id'] for line in f], ['1', '2'])
+
+# stands in for analysis.analyze_trial. The earlier trials take longest, so
+# with several workers they finish out of order
+def quick_analyze_trial(trial_id):
+    time.sleep(0.01 * (5 - trial_id))
+    return {'_id': trial_id, 'moves': [trial_id] * trial_id}, os.getpid(), 0.0
+
+
+class TestRunTrials(unittest.TestCase):
+    def setUp(self):
+        self.analyze_trial = analysis.analyze_trial
+        analysis.analyze_trial = quick_analyze_trial
+        self.trials = [{'_id': i, 'moves': range(40)} for i in range(5)]
+
+    def tearDown(self):
+        analysis.analyze_trial = self.analyze_trial
+
+    def test_order(self):
+        serial = list(analysis.run_trials(iter(self.trials), 1))
+        parallel = list(analysis.run_trials(iter(self.trials), 2))
+
+        self.assertEqual([trial['_id'] for trial in serial], range(5))
+        self.assertEqual(parallel, serial)
+
+    def test_no_trials(self):
+        self.assertEqual(list(analysis.run_trials(iter([]), 2)), [])
+
+
+class TestResumableResults(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = analysis.model_config()
+        self.other_config = dict(self.config, dispersion=1.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_lines(self, name, trials, partial=''):
+        path = os.path.join(self.dir, name)
+        f = open(path, 'w')
+        for trial in trials:
+            f.write(json.dumps(trial) + "\n")
+        f.write(partial)
+        f.close()
+        return path
+
+    def test_completed_trials(self):
+        path = self.write_lines('results.jsonl',
+                                [{'_id': 'a', 'config': self.config},
+                                 {'_id': 'b', 'config': self.other_config}],
+                                partial='{"_id": "c", "conf')
+
+        self.assertEqual(analysis.completed_trials(path, self.config), set(['a']))
+        self.assertEqual(analysis.completed_trials(path, self.other_config), set(['b']))
+
+        # the partly written trial was cut off
+        self.assertTrue(open(path).read().endswith("\n"))
+
+    def test_completed_trials_missing_file(self):
+        path = os.path.join(self.dir, 'missing.jsonl')
+        self.assertEqual(analysis.completed_trials(path, self.config), set())
+
+    def test_merge_results(self):
+        first = self.write_lines('first.jsonl',
+                                 [{'_id': 'a', 'config': self.config},
+                                  {'_id': 'b', 'config': self.config}])
+        second = self.write_lines('second.jsonl',
+                                  [{'_id': 'b', 'config': self.config},
+                                   {'_id': 'b', 'config': self.other_config}],
+                                  partial='{"_id": "c"')
+        out = os.path.join(self.dir, 'merged.jsonl')
+
+        self.assertEqual(analysis.merge_results([first, second], out), 3)
+        self.assertEqual(analysis.completed_trials(out, self.config), set(['a', 'b']))
+
+class TestMatrixStore(AnalysisTest):
+    def setUp(self):
+        # a small image set of color images, whose grey values aren't whole
+        self.dir = tempfile.mkdtemp()
+        random.seed(13)
+        self.paths = {}
+        for i in range(4):
+            path = os.path.join(self.dir, 'image%d.png' % i)
+            Image.fromarray(random.randint(0, 256, (6, 5, 3)).astype(uint8)).save(path)
+            self.paths[str(ObjectId())] = path
+        self.image_ids = sorted(self.paths)
+        self.image_set = {'_id': ObjectId(), 'images': [{'image_id': ObjectId(image_id)}
+                                                        for image_id in self.image_ids]}
+
+        # serve the set and its files in place of the database
+        for module in (matrixStore.db, analysis.db):
+            self.stub(module, 'get_image_set', lambda set_id: self.image_set)
+            self.stub(module, 'get_image_file', lambda image_id: self.paths[str(image_id)])
+        self.store_dir = os.path.join(self.dir, 'store')
+
+    def tearDown(self):
+        matrixStore.reset()
+        shutil.rmtree(self.dir)
+
+    def stub(self, module, name, value):
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def test_matches_decoded_images(self):
+        num = matrixStore.build_image_set(self.image_set['_id'], self.store_dir)
+        self.assertEqual(num, len(self.image_ids))
+
+        for image_id in self.image_ids:
+            stored = matrixStore.get_matrix(image_id, self.store_dir)
+            expected = imageGen.loadImage(self.paths[image_id])
+            self.assertEqual(stored.dtype, uint8)
+            self.assertEqual(stored.shape, (5, 6))
+            assert_array_equal(stored, rint(expected))
+
+    def test_missing_image(self):
+        self.assertTrue(matrixStore.get_matrix(self.image_ids[0], self.store_dir) is None)
+
+    def test_store_matches_gridfs(self):
+        matrixStore.build_image_set(self.image_set['_id'], self.store_dir)
+        store_dir = matrixStore.STORE_DIR
+        self.keep_globals()
+        try:
+            matrixStore.STORE_DIR = self.store_dir
+            analysis.image_matrices.clear()
+            stored = [analysis.get_image_matrix(image_id) for image_id in self.image_ids]
+
+            # and again, with nothing in the store
+            matrixStore.STORE_DIR = os.path.join(self.dir, 'empty')
+            analysis.image_matrices.clear()
+            loaded = [analysis.get_image_matrix(image_id) for image_id in self.image_ids]
+        finally:
+            matrixStore.STORE_DIR = store_dir
+
+        for stored_matrix, loaded_matrix in zip(stored, loaded):
+            # the stored matrices are views of the memory map, not copies
+            self.assertTrue(isinstance(stored_matrix.base, memmap))
+            self.assertEqual(loaded_matrix.dtype, uint8)
+            assert_array_equal(stored_matrix, loaded_matrix)
+
+class TestQuantize(AnalysisTest):
+    def test_quantize(self):
+        matrix = array([[-3.0, 0.4, 0.6], [127.5, 254.6, 300.0]])
+        quantized = matrixStore.quantize(matrix)
+
+        self.assertEqual(quantized.dtype, uint8)
+        assert_array_equal(quantized, [[0, 0, 1], [128, 255, 255]])
+
+    def test_statistics_dont_overflow(self):
+        self.keep_globals()
+        analysis.image_matrices['bright0'] = full((2, 2), 200, dtype=uint8)
+        analysis.image_matrices['bright1'] = full((2, 2), 250, dtype=uint8)
+        n, mean, var = analysis.GroupStatistics({'bright0': 0, 'bright1': 0}).summary(0)
+
+        self.assertEqual(n, 2)
+        assert_allclose(mean, 225.0)
+        assert_allclose(var, 625.0)
+
+class TestLoadImage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def save(self, pixels, mode):
+        path = os.path.join(self.dir, 'image.png')
+        Image.fromarray(pixels).convert(mode).save(path)
+        return path
+
+    def test_matches_loop(self):
+        pixels = random.randint(0, 256, (12, 10, 3)).astype(uint8)
+        f = open(self.save(pixels, 'RGB'), 'rb')
+        matrix = imageGen.loadImage(f)
+        f.seek(0)
+        assert_allclose(matrix, imageGen.loadImageLoop(f))
+        f.close()
+
+    def test_color_orientation(self):
+        pixels = random.randint(0, 256, (6, 9, 3)).astype(uint8)
+        matrix = imageGen.loadImage(self.save(pixels, 'RGB'))
+
+        self.assertEqual(matrix.shape, (9, 6))
+        assert_allclose(matrix, pixels.sum(axis=2).T/3.0)
+        assert_allclose(matrix, imageGen.loadImageLoop(self.save(pixels, 'RGB')))
+
+    def test_grayscale_and_bw(self):
+        pixels = random.randint(0, 256, (5, 7)).astype(uint8)
+        assert_allclose(imageGen.loadImage(self.save(pixels, 'L')), pixels.T)
+
+        bw = where(pixels > 127, 255, 0).astype(uint8)
+        path = self.save(bw, '1')
+        assert_allclose(imageGen.loadImage(path), bw.T)
+        assert_allclose(imageGen.loadImage(path), imageGen.loadImageLoop(path))
+
+    def test_downsample(self):
+        pixels = random.randint(0, 256, (8, 12, 3)).astype(uint8)
+        path = self.save(pixels, 'RGB')
+        assert_allclose(imageGen.loadImage(path, 4), imageGen.loadImageLoop(path, 4))
+
+    def test_downsample_uneven(self):
+        pixels = random.randint(0, 256, (7, 5)).astype(uint8)
+        matrix = imageGen.loadImage(self.save(pixels, 'L'), 3)
+        values = pixels.T.astype(float)
+
+        self.assertEqual(matrix.shape, (2, 3))
+        self.assertEqual(matrix[0, 0], floor(values[:3, :3].mean()))
+        self.assertEqual(matrix[1, 2], floor(values[3:, 6:].mean()))
+
+class TestImageGeneration(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_seeded(self):
+        first = imageGen.generateImageBatch(3, seed=12)
+        self.assertEqual(first.shape, (3, 100, 100))
+        assert_allclose(first, imageGen.generateImageBatch(3, seed=12))
+        self.assertFalse(allclose(first, imageGen.generateImageBatch(3, seed=13)))
+
+    def test_chunks(self):
+        for t in ["pos", "uniform"]:
+            matrices = imageGen.drawChunks(4, 23, 5, 50, t, random.RandomState(0))
+            self.assertTrue(matrices.min() >= 0 and matrices.max() <= 255)
+            # every chunk is a single value, and the leftover pixels are 0
+            chunks = matrices[:, :20, :20].reshape(4, 4, 5, 4, 5)
+            assert_allclose(chunks, chunks[:, :, :1, :, :1] * ones((1, 1, 5, 1, 5)))
+            self.assertTrue((matrices[:, 20:, :] == 0).all())
+            self.assertTrue((matrices[:, :, 20:] == 0).all())
+
+    def test_bw(self):
+        matrices = imageGen.generateImageBatch(10, 8, t="bw", seed=3)
+        for matrix in matrices:
+            self.assertTrue((matrix == 0).all() or (matrix == 255).all())
+
+    def test_save_round_trip(self):
+        matrix = imageGen.generateImage(30, 5, 5, seed=1)[:, :20]
+        imageGen.saveImageBatch([matrix], self.dir)
+        loaded = imageGen.loadImage(os.path.join(self.dir, '0.png'))
+        assert_allclose(loaded, floor(matrix))
+
+class TestGaussianFilter(unittest.TestCase):
+    def test_methods_match_convolve(self):
+        matrices = random.RandomState(0).uniform(0, 255, (3, 21, 34))
+        for filterSize in [4, 15]:
+            kernel = array(imageGen.discreteGaussian(filterSize))
+            kernel /= kernel.sum()
+            expected = array([[convolve(row, kernel, 'same') for row in matrix] for matrix in matrices])
+            expected = array([[convolve(column, kernel, 'same') for column in matrix.T] for matrix in expected]).transpose(0, 2, 1)
+
+            for method in ['direct', 'fft', 'loop']:
+                assert_allclose(imageGen.gaussianFilterBatch(matrices, filterSize, method), expected, atol=1e-9)
+
+    def test_single_matrix(self):
+        matrix = random.RandomState(1).uniform(0, 255, (30, 12))
+        assert_allclose(imageGen.gaussianFilter(matrix, 7), imageGen.gaussianFilterLoop(matrix, 7), atol=1e-9)
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, imageGen.gaussianFilterBatch, zeros((1, 5, 5)), 3, 'median')
+
+# indexes are made by ensure_indexes.py, so no request should ever get here
+def fail_ensure_indexes():
+    raise AssertionError('requests must not make indexes')
+
+
+class TestImageServing(unittest.TestCase):
+    def setUp(self):
+        self.reads = []
+        self.get_image_file = main.db.get_image_file
+        main.db.get_image_file = self.fake_image_file
+        self.image_cache = main.image_cache
+        main.image_cache = main.ImageCache(10)
+        self.ensure_indexes = main.db.ensure_indexes
+        main.db.ensure_indexes = fail_ensure_indexes
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        main.db.get_image_file = self.get_image_file
+        main.image_cache = self.image_cache
+        main.db.ensure_indexes = self.ensure_indexes
+
+    def fake_image_file(self, image_id):
+        self.reads.append(image_id)
+        image = StringIO(str(image_id)[-4:])
+        image.content_type = 'image/png'
+        image.md5 = 'md5' + str(image_id)
+        return image
+
+    def test_cached(self):
+        image_id = str(ObjectId())
+        for i in range(3):
+            resp = self.client.get('/images/' + image_id)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, image_id[-4:])
+            self.assertEqual(resp.headers['ETag'], '"md5' + image_id + '"')
+            self.assertTrue('immutable' in resp.headers['Cache-Control'])
+        self.assertEqual(len(self.reads), 1)
+
+    def test_not_modified(self):
+        image_id = str(ObjectId())
+        resp = self.client.get('/images/' + image_id,
+                               headers={'If-None-Match': '"md5' + image_id + '"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+    def test_eviction(self):
+        image_ids = [str(ObjectId()) for i in range(3)]
+        for image_id in image_ids + image_ids[-1:] + image_ids[:1]:
+            self.client.get('/images/' + image_id)
+        # only two 4 byte images fit, so the first was dropped and read again
+        self.assertEqual(len(self.reads), 4)
+        self.assertEqual(main.image_cache.size, 8)
+
+    def test_bad_id(self):
+        self.assertEqual(self.client.get('/images/nope').status_code, 404)
+
+    def test_bundle(self):
+        image_set = {'_id': ObjectId(), 'images': [{'image_id': ObjectId()} for i in range(3)]}
+        get_image_set_by_trial_id = main.db.get_image_set_by_trial_id
+        main.db.get_image_set_by_trial_id = lambda trial_id: image_set
+        main.image_cache = main.ImageCache(1000)
+        try:
+            resp = self.client.get('/images/bundle')
+            bundle = json.loads(resp.data)
+            self.assertEqual([image['id'] for image in bundle],
+                             [str(image['image_id']) for image in image_set['images']])
+            self.assertEqual(bundle[0]['src'].split(',')[1].decode('base64'),
+                             str(image_set['images'][0]['image_id'])[-4:])
+
+            # built once per image set, and revalidated with its ETag
+            resp = self.client.get('/images/bundle', headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(len(self.reads), 3)
+        finally:
+            main.db.get_image_set_by_trial_id = get_image_set_by_trial_id
+            main.bundle_cache.clear()
+
+class TestMoveBatches(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.add_moves = main.db.add_moves
+        main.db.add_moves = self.fake_add_moves
+        self.ensure_indexes = main.db.ensure_indexes
+        main.db.ensure_indexes = fail_ensure_indexes
+        self.client = main.app.test_client()
+        self.client.set_cookie('localhost', 'trial_id', str(ObjectId()))
+
+    def tearDown(self):
+        main.db.add_moves = self.add_moves
+        main.db.ensure_indexes = self.ensure_indexes
+
+    def fake_add_moves(self, trial_id, first_seq, moves):
+        if first_seq > 5:
+            raise ValueError('gap')
+        self.batches.append((first_seq, moves))
+        return first_seq + len(moves)
+
+    def post(self, batch):
+        return self.client.post('/moves', data=json.dumps(batch), content_type='application/json')
+
+    def move(self, image_id):
+        return {'image_id': image_id, 'old_group': -1, 'new_group': 0, 'old_x': 0,
+                'new_x': 1, 'old_y': 0, 'new_y': 1, 'time_elapsed': 100}
+
+    def test_batch(self):
+        moves = [self.move(str(i)) for i in range(3)]
+        resp = self.post({'first_seq': 2, 'moves': moves})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {'stored': 5})
+        self.assertEqual(self.batches, [(2, moves)])
+
+    def test_invalid(self):
+        self.assertEqual(self.post({'moves': []}).status_code, 400)
+        self.assertEqual(self.post({'first_seq': -1, 'moves': []}).status_code, 400)
+        self.assertEqual(self.post({'first_seq': True, 'moves': [self.move('1')]}).status_code, 400)
+        self.assertEqual(self.post({'first_seq': False, 'moves': [self.move('1')]}).status_code, 400)
+        self.assertEqual(self.post({'first_seq': 0, 'moves': [{'image_id': '1'}]}).status_code, 400)
+        self.assertEqual(self.client.post('/moves', data='{').status_code, 400)
+        self.assertEqual(self.batches, [])
+
+    def test_gap(self):
+        self.assertEqual(self.post({'first_seq': 8, 'moves': [self.move('1')]}).status_code, 409)
+
+class FakeCursor(object):
+    # hands out its documents one at a time, counting how many have been read
+    def __init__(self, docs):
+        self.docs = docs
+        self.read = 0
+        self.size = None
+
+    def batch_size(self, size):
+        self.size = size
+        return self
+
+    def __iter__(self):
+        for doc in self.docs:
+            self.read += 1
+            yield doc
+
+
+class FakeCollection(object):
+    # just enough of a pymongo collection for the db tests, working on a list
+    # of documents in memory
+    def __init__(self, docs=None):
+        self.docs = [dict(doc) for doc in (docs or [])]
+        self.indexes = []
+        self.unique = []
+        self.finds = 0
+        self.insert_error = None
+        self.cursor = None
+        self.query = None
+
+    def matches(self, doc, query):
+        for key, value in (query or {}).iteritems():
+            if isinstance(value, dict) and '$exists' in value:
+                if (key in doc) != value['$exists']:
+                    return False
+            elif doc.get(key) != value:
+                return False
+        return True
+
+    def find(self, query=None, fields=None):
+        self.finds += 1
+        self.query = query
+        self.cursor = FakeCursor([dict(doc) for doc in self.docs if self.matches(doc, query)])
+        return self.cursor
+
+    def find_one(self, query=None, fields=None):
+        found = [dict(doc) for doc in self.docs if self.matches(doc, query)]
+        return found[0] if found else None
+
+    def insert(self, doc):
+        if self.insert_error != None:
+            raise self.insert_error
+        for key in self.unique:
+            if any([other.get(key) == doc.get(key) for other in self.docs]):
+                raise db.pymongo.errors.DuplicateKeyError('E11000 duplicate key', 11000)
+        doc.setdefault('_id', ObjectId())
+        self.docs.append(dict(doc))
+        return doc['_id']
+
+    def update(self, query, change):
+        for doc in self.docs:
+            if self.matches(doc, query):
+                doc.update(change['$set'])
+
+    def remove(self, query):
+        self.docs = [doc for doc in self.docs if not self.matches(doc, query)]
+
+    def ensure_index(self, keys, unique=False):
+        if unique:
+            values = [doc.get(keys) for doc in self.docs]
+            if len(set(values)) != len(values):
+                raise db.pymongo.errors.OperationFailure('E11000 duplicate key', 11000)
+            self.unique.append(keys)
+        self.indexes.append(keys)
+
+
+class FakeDatabase(object):
+    def __init__(self, **collections):
+        self.images = collections.get('images', FakeCollection())
+        self.trials = collections.get('trials', FakeCollection())
+
+
+class FakeFs(object):
+    # a gridFS in memory, whose put fails from the fail_at'th call on
+    def __init__(self, fail_at=None):
+        self.files = {}
+        self.puts = 0
+        self.fail_at = fail_at
+        self.lock = threading.Lock()
+
+    def put(self, data, content_type=None):
+        with self.lock:
+            self.puts += 1
+            if self.fail_at != None and self.puts >= self.fail_at:
+                raise IOError('connection lost')
+            file_id = ObjectId()
+            self.files[file_id] = data
+            return file_id
+
+    def delete(self, file_id):
+        with self.lock:
+            self.files.pop(file_id, None)
+
+
+class FakeDbTest(unittest.TestCase):
+    # swaps in a FakeDatabase for db.get_db, and puts it back afterwards
+    def use_database(self, database):
+        self.get_db = db.get_db
+        db.get_db = lambda: database
+        self.addCleanup(setattr, db, 'get_db', self.get_db)
+        db.forget_image_set_ids()
+        self.addCleanup(db.forget_image_set_ids)
+        return database
+
+    # swaps in a FakeFs for db.get_fs, and puts it back afterwards
+    def use_fs(self, fs):
+        self.get_fs = db.get_fs
+        db.get_fs = lambda: fs
+        self.addCleanup(setattr, db, 'get_fs', self.get_fs)
+        return fs
+
+
+class TestIndexes(FakeDbTest):
+    def test_indexes_and_backfill(self):
+        database = self.use_database(FakeDatabase(
+            images=FakeCollection([{'name': 'a'}, {'name': 'b'}]),
+            trials=FakeCollection([{'_id': 1, 'moves': [{}, {}]},
+                                   {'_id': 2, 'moves': [{}], 'move_count': 1}])))
+        db.ensure_indexes()
+        db.ensure_indexes()
+
+        self.assertEqual(database.images.unique, ['name', 'name'])
+        self.assertEqual(len(database.trials.indexes), 2)
+        self.assertEqual([trial['move_count'] for trial in database.trials.docs], [2, 1])
+
+    def test_duplicate_names(self):
+        database = self.use_database(FakeDatabase(
+            images=FakeCollection([{'name': 'a'}, {'name': 'b'}, {'name': 'a'}]),
+            trials=FakeCollection([{'_id': 1, 'moves': []}])))
+        try:
+            db.ensure_indexes()
+            self.fail('duplicate names were indexed')
+        except ValueError as e:
+            self.assertTrue(': a.' in str(e))
+
+        # the trials are still indexed and backfilled
+        self.assertEqual(database.trials.docs[0]['move_count'], 0)
+        self.assertEqual(database.images.unique, [])
+
+    def test_not_run_by_app(self):
+        calls = []
+        ensure_indexes = main.db.ensure_indexes
+        main.db.ensure_indexes = lambda: calls.append(1)
+        try:
+            resp = main.app.test_client().get('/')
+        finally:
+            main.db.ensure_indexes = ensure_indexes
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(calls, [])
+
+
+class TestRandomImageSet(FakeDbTest):
+    def test_picks_a_set(self):
+        sets = [{'_id': ObjectId(), 'name': str(i)} for i in range(3)]
+        database = self.use_database(FakeDatabase(images=FakeCollection(sets)))
+        random.seed(12)
+        picked = set(db.get_random_image_set()['name'] for i in range(30))
+
+        self.assertEqual(picked, set(['0', '1', '2']))
+        # the ids are read once and then kept
+        self.assertEqual(database.images.finds, 1)
+
+    def test_removed_set(self):
+        sets = [{'_id': ObjectId(), 'name': str(i)} for i in range(2)]
+        database = self.use_database(FakeDatabase(images=FakeCollection(sets)))
+        db.get_image_set_ids()
+        database.images.remove({'_id': sets[0]['_id']})
+
+        for i in range(10):
+            self.assertEqual(db.get_random_image_set()['name'], '1')
+
+    def test_ids_refreshed(self):
+        database = self.use_database(FakeDatabase(images=FakeCollection([{'_id': ObjectId(), 'name': 'a'}])))
+        db.get_random_image_set()
+        database.images.docs.append({'_id': ObjectId(), 'name': 'b'})
+        old_seconds = db.IMAGE_SET_IDS_SECONDS
+        try:
+            db.IMAGE_SET_IDS_SECONDS = -1
+            self.assertEqual(len(db.get_image_set_ids()), 2)
+        finally:
+            db.IMAGE_SET_IDS_SECONDS = old_seconds
+
+    def test_no_sets(self):
+        self.use_database(FakeDatabase())
+        self.assertRaises(ValueError, db.get_random_image_set)
+
+class TestImageUpload(FakeDbTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(6):
+            path = os.path.join(self.dir, 'image%d.png' % i)
+            open(path, 'wb').write('image %d' % i)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_files(self):
+        fs = self.use_fs(FakeFs())
+        file_ids = db.put_files(self.paths, 3)
+
+        self.assertEqual([fs.files[file_id] for file_id in file_ids],
+                         ['image %d' % i for i in range(6)])
+
+    def test_put_fails_midway(self):
+        fs = self.use_fs(FakeFs(fail_at=4))
+        self.assertRaises(IOError, db.put_files, self.paths, 2)
+
+        # the files that were put before the failure are deleted again
+        self.assertEqual(fs.puts, 6)
+        self.assertEqual(fs.files, {})
+
+    def test_missing_file(self):
+        fs = self.use_fs(FakeFs())
+        self.assertRaises(IOError, db.put_files, self.paths + [os.path.join(self.dir, 'gone.png')], 3)
+        self.assertEqual(fs.files, {})
+
+    def test_insert_fails(self):
+        fs = self.use_fs(FakeFs())
+        database = self.use_database(FakeDatabase())
+        database.images.insert_error = db.pymongo.errors.AutoReconnect('connection lost')
+        self.assertRaises(db.pymongo.errors.AutoReconnect, db.add_image_set, self.dir, 'set')
+
+        self.assertEqual(fs.puts, 6)
+        self.assertEqual(fs.files, {})
+        self.assertEqual(database.images.docs, [])
+
+    def test_insert_duplicate(self):
+        fs = self.use_fs(FakeFs())
+        database = self.use_database(FakeDatabase(images=FakeCollection([{'name': 'set'}])))
+        database.images.unique.append('name')
+        file_ids = db.put_files(self.paths[:2])
+        self.assertRaises(ValueError, db.insert_image_set, {'name': 'set'}, file_ids)
+
+        self.assertEqual(fs.files, {})
+        self.assertEqual(len(database.images.docs), 1)
+
+    def test_insert(self):
+        fs = self.use_fs(FakeFs())
+        database = self.use_database(FakeDatabase())
+        self.assertEqual(len(db.get_image_set_ids()), 0)
+        set_id = db.add_image_set(self.dir, 'set', 2)
+
+        image_set = database.images.find_one({'_id': set_id})
+        self.assertEqual(sorted(fs.files), sorted(image['image_id'] for image in image_set['images']))
+        # a new set is picked up straight away
+        self.assertEqual(db.get_image_set_ids(), [set_id])
+
+
+class TestTrialStreams(FakeDbTest):
+    def test_batches(self):
+        database = self.use_database(FakeDatabase(
+            trials=FakeCollection([{'_id': i, 'moves': []} for i in range(5)])))
+        trials = db.iter_trials(fields={'_id': 1}, batch_size=2)
+        self.assertEqual(trials.next()['_id'], 0)
+
+        # the cursor is read as the trials are used, not all at once
+        self.assertEqual(database.trials.cursor.size, 2)
+        self.assertEqual(database.trials.cursor.read, 1)
+        self.assertEqual([trial['_id'] for trial in trials], range(1, 5))
+
+        list(db.iter_trials())
+        self.assertEqual(database.trials.cursor.size, db.BATCH_SIZE)
+
+    def test_turk_batches(self):
+        database = self.use_database(FakeDatabase())
+        list(db.iter_turk_trials(batch_size=3))
+
+        self.assertEqual(database.trials.cursor.size, 3)
+        self.assertEqual(database.trials.query['tester'], 'Mechanical Turker')
+
+
+class StreamedTrials(object):
+    # stands in for the db module, noting when each trial id is read
+    def __init__(self, events, count):
+        self.events = events
+        self.count = count
+
+    def iter_trials(self, query=None, fields=None, batch_size=None):
+        for i in range(self.count):
+            self.events.append(('read', i))
+            yield {'_id': i}
+
+
+class TestLongRunners(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.db = analysis.db
+        self.fit_trial_params = analysis.fit_trial_params
+        analysis.db = StreamedTrials(self.events, 3)
+        analysis.fit_trial_params = self.fake_fit
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        analysis.db = self.db
+        analysis.fit_trial_params = self.fit_trial_params
+        shutil.rmtree(self.dir)
+
+    def fake_fit(self, trial_id, fit):
+        self.events.append(('fit', trial_id))
+        return {'_id': trial_id, 'image_set': DBRef('images', ObjectId()), 'moves': []}
+
+    def test_ids_read_first(self):
+        path = os.path.join(self.dir, 'results.jsonl')
+        analysis.run_all_trials_for_params(path)
+
+        # every id is read before the first, slow, fit starts
+        self.assertEqual(self.events, [('read', 0), ('read', 1), ('read', 2),
+                                       ('fit', 0), ('fit', 1), ('fit', 2)])
+
+        # and a resumed run only reads the ids, skipping the finished trials
+        del self.events[:]
+        analysis.run_all_trials_for_params(path)
+        self.assertEqual(self.events, [('read', 0), ('read', 1), ('read', 2)])
+
+
+class TestClientOptions(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(db.client_options({}),
+                         {'max_pool_size': 10, 'connectTimeoutMS': 5000, 'w': 1})
+
+    def test_environment(self):
+        options = db.client_options({'MONGO_POOL_SIZE': '50',
+                                     'MONGO_SOCKET_TIMEOUT_MS': '2000',
+                                     'MONGO_W': 'majority',
+                                     'MONGO_READ_PREFERENCE': 'secondaryPreferred'})
+        self.assertEqual(options['max_pool_size'], 50)
+        self.assertEqual(options['socketTimeoutMS'], 2000)
+        self.assertEqual(options['w'], 'majority')
+        self.assertEqual(options['read_preference'], db.pymongo.ReadPreference.SECONDARY_PREFERRED)
+
+    def test_bad_read_preference(self):
+        self.assertRaises(ValueError, db.client_options, {'MONGO_READ_PREFERENCE': 'sideways'})
+
+class TestDumpDb(unittest.TestCase):
+    def test_trials(self):
+        trials = dumpDb.get_all_trials()
+        self.assertEqual(len(trials), 204)
+        trial = dumpDb.get_trial(str(trials[10]['_id']))
+        self.assertEqual(trial, trials[10])
+        self.assertTrue(dumpDb.get_trial(ObjectId()) is None)
+
+        for trial in dumpDb.iter_turk_trials():
+            self.assertEqual(trial['tester'], 'Mechanical Turker')
+            self.assertEqual(len(trial['moves']), 40)
+
+    def test_images(self):
+        image_set = dumpDb.get_image_set_by_trial_id(dumpDb.get_all_trials()[0]['_id'])
+        self.assertEqual(len(image_set['images']), 40)
+
+        image_file = dumpDb.get_image_file(str(image_set['images'][0]['image_id']))
+        self.assertEqual(image_file.content_type, 'image/png')
+        self.assertEqual(hashlib.md5(image_file.read()).hexdigest(), image_file.md5)
+        image_file.seek(0)
+        self.assertEqual(imageGen.loadImage(image_file).shape, (100, 100))
+
+class TestTrialArrays(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.trials = dumpDb.get_all_trials()[:30]
+        # a drop at a fractional position, as the browser sometimes reports
+        self.trials.append({'_id': ObjectId(), 'tester': 'fractional',
+                            'moves': [{'image_id': 'a', 'old_group': -1, 'new_group': 0,
+                                       'old_x': 10, 'new_x': 120.75, 'old_y': 20, 'new_y': 33.5,
+                                       'time_elapsed': 900}]})
+        self.arrays = trialArrays.trials_to_arrays(self.trials)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_columns(self):
+        arrays = self.arrays
+        for i in range(len(self.trials)):
+            moves = self.trials[i]['moves']
+            start, end = arrays['trial_offsets'][i], arrays['trial_offsets'][i + 1]
+            self.assertEqual(end - start, len(moves))
+            self.assertEqual(arrays['trial_ids'][i], str(self.trials[i]['_id']))
+            for j in range(len(moves)):
+                self.assertEqual(arrays['trial'][start + j], i)
+                self.assertEqual(arrays['move'][start + j], j)
+                self.assertEqual(arrays['image_ids'][arrays['image'][start + j]], moves[j]['image_id'])
+                self.assertEqual(arrays['new_group'][start + j], moves[j]['new_group'])
+                self.assertEqual(arrays['time_elapsed'][start + j], moves[j]['time_elapsed'])
+                for name in ['old_x', 'new_x', 'old_y', 'new_y']:
+                    self.assertEqual(arrays[name][start + j], moves[j][name])
+        self.assertEqual(arrays['new_x'][-1], 120.75)
+        self.assertEqual(arrays['new_y'][-1], 33.5)
+
+    def test_save_and_load(self):
+        for path, mmap in [(os.path.join(self.dir, 'trials.npz'), False),
+                           (os.path.join(self.dir, 'trials'), True)]:
+            trialArrays.save_arrays(self.arrays, path)
+            loaded = trialArrays.load_arrays(path, mmap)
+            self.assertEqual(sorted(loaded.keys()), sorted(self.arrays.keys()))
+            for name in loaded:
+                self.assertTrue((loaded[name] == self.arrays[name]).all())
+
+    def test_group_nums(self):
+        expected = []
+        for trial in self.trials:
+            groups = []
+            for move in trial['moves']:
+                expected.append(min(len(groups) + 1, 8))
+                if move['new_group'] not in groups:
+                    groups.append(move['new_group'])
+        self.assertEqual(list(trialArrays.group_nums(self.arrays)), expected)
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,192 @@
+"""
+Trial arrays
+
+Flattens the moves of every trial into columns of numpy arrays, so statistics
+over the whole dataset can be computed with array operations instead of loops
+over nested trial documents.
+
+Each column holds one entry per move, with the moves of each trial together
+and in order:
+
+trial - the index of the move's trial
+move - the index of the move within its trial
+image - the index of the moved image in image_ids
+old_group, new_group, old_x, new_x, old_y, new_y, time_elapsed - as in the move
+
+and the trials are described by:
+
+trial_ids, trial_testers, trial_image_sets - the _id, tester and image set id
+of each trial
+trial_offsets - the moves of trial i are at trial_offsets[i]:trial_offsets[i+1]
+image_ids - the image id for each image index
+
+Strings are saved as utf-8 byte strings. The arrays are saved either as one
+compressed .npz file or as a directory of .npy files that can be memory-mapped.
+"""
+import argparse
+import os
+# read from a mongodump instead of Mongo if GIBBS_DUMP_DIR is set
+if os.environ.get('GIBBS_DUMP_DIR'):
+    import dumpDb as db
+else:
+    import db
+from numpy import array, zeros, cumsum, minimum, unique, load, save, savez_compressed, int8, int32, int64, float64
+
+# the positions are kept as floats, as the browser reports fractional pixels
+MOVE_COLUMNS = [('old_group', int8), ('new_group', int8), ('old_x', float64), ('new_x', float64),
+                ('old_y', float64), ('new_y', float64), ('time_elapsed', int64)]
+
+"""
+Function: trials_to_arrays
+Flattens trials into columns.
+
+Parameters:
+trials - an iterable of trial documents, e.g. db.iter_trials()
+
+Returns:
+A dict of column name to numpy array, as described above
+"""
+def trials_to_arrays(trials):
+    image_index = {}
+    trial_ids = []
+    trial_testers = []
+    trial_image_sets = []
+    trial_offsets = [0]
+    columns = dict((name, []) for name, dtype in MOVE_COLUMNS)
+    trial_column = []
+    move_column = []
+    image_column = []
+
+    for trial in trials:
+        trial_num = len(trial_ids)
+        trial_ids.append(str(trial['_id']))
+        trial_testers.append(trial.get('tester', '').encode('utf-8'))
+        image_set = trial.get('image_set')
+        trial_image_sets.append(str(image_set.id) if image_set != None else '')
+
+        for move_num, move in enumerate(trial['moves']):
+            image_id = str(move['image_id'])
+            if image_id not in image_index:
+                image_index[image_id] = len(image_index)
+            trial_column.append(trial_num)
+            move_column.append(move_num)
+            image_column.append(image_index[image_id])
+            for name, dtype in MOVE_COLUMNS:
+                columns[name].append(move[name])
+        trial_offsets.append(len(trial_column))
+
+    image_ids = [''] * len(image_index)
+    for image_id, index in image_index.iteritems():
+        image_ids[index] = image_id
+
+    arrays = {'trial': array(trial_column, dtype=int32),
+              'move': array(move_column, dtype=int32),
+              'image': array(image_column, dtype=int32),
+              'trial_ids': array(trial_ids, dtype='S24'),
+              'trial_testers': array(trial_testers, dtype=str),
+              'trial_image_sets': array(trial_image_sets, dtype='S24'),
+              'trial_offsets': array(trial_offsets, dtype=int64),
+              'image_ids': array(image_ids, dtype='S24')}
+    for name, dtype in MOVE_COLUMNS:
+        arrays[name] = array(columns[name], dtype=dtype)
+    return arrays
+
+"""
+Function: save_arrays
+Saves the arrays from trials_to_arrays.
+
+Parameters:
+arrays - the dict of arrays
+path - a .npz file to write, or a directory to write one .npy file per array to
+"""
+def save_arrays(arrays, path):
+    if path.endswith('.npz'):
+        savez_compressed(path, **arrays)
+    else:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name, values in arrays.iteritems():
+            save(os.path.join(path, name + '.npy'), values)
+
+"""
+Function: load_arrays
+Loads arrays saved by save_arrays.
+
+Parameters:
+path - the .npz file or directory they were saved to
+mmap - if True, memory-map the arrays in a directory rather than reading them
+
+Returns:
+A dict of column name to numpy array
+"""
+def load_arrays(path, mmap=False):
+    if path.endswith('.npz'):
+        saved = load(path)
+        arrays = dict((name, saved[name]) for name in saved.files)
+        saved.close()
+        return arrays
+
+    arrays = {}
+    for name in os.listdir(path):
+        if name.endswith('.npy'):
+            arrays[name[:-4]] = load(os.path.join(path, name), mmap_mode='r' if mmap else None)
+    return arrays
+
+"""
+Function: group_nums
+The number of groups available to choose between for each move, as found by
+dataProcessing.findGroupNums: one more than the number of groups moved into
+earlier in the trial, at most 8.
+
+Parameters:
+arrays - the dict of arrays
+
+Returns:
+A numpy array with an entry per move
+"""
+def group_nums(arrays):
+    trial = arrays['trial'].astype(int64)
+    new_group = arrays['new_group'].astype(int64)
+    if len(trial) == 0:
+        return zeros(0, dtype=int64)
+
+    # mark the first move into each group of each trial
+    keys = trial * 256 + (new_group + 128)
+    first = zeros(len(keys), dtype=int64)
+    first[unique(keys, return_index=True)[1]] = 1
+
+    # count the marks before each move, less those before its trial started
+    before = cumsum(first) - first
+    seen = before - before[arrays['trial_offsets'][:-1][trial]]
+    return minimum(seen + 1, 8)
+
+"""
+Function: export_trials
+Flattens all the trials in the database into arrays and saves them.
+
+Parameters:
+path - a .npz file, or a directory for memory-mappable .npy files
+turk - if True, only export the mechanical turk trials with 40 moves
+
+Returns:
+The dict of arrays
+"""
+def export_trials(path, turk=False):
+    fields = {'init_state': 0}
+    if turk:
+        trials = db.iter_turk_trials(fields=fields)
+    else:
+        trials = db.iter_trials(fields=fields)
+    arrays = trials_to_arrays(trials)
+    save_arrays(arrays, path)
+    print "Exported", len(arrays['trial_ids']), "trials with", len(arrays['trial']), "moves to", path
+    return arrays
+
+parser = argparse.ArgumentParser(description='Flatten the moves of every trial into numpy arrays')
+parser.add_argument('path', help='a .npz file, or a directory to save memory-mappable .npy files in')
+parser.add_argument('--turk', action='store_true', help='only export the mechanical turk trials with 40 moves')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    export_trials(args.path, args.turk)
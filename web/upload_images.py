@@ -1,10 +1,13 @@
 import argparse
 import db
 
-parser = argparse.ArgumentParser(description='Upload a directory of image files as an image set')
-parser.add_argument('dir', help='The directory to upload')
+parser = argparse.ArgumentParser(description='Upload directories of image files as image sets')
+parser.add_argument('dirs', nargs='+', help='The directories to upload, one image set each')
+parser.add_argument('--workers', type=int, default=db.UPLOAD_WORKERS, help='The number of files to upload at once')
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
-    db.add_image_set(args.dir)
+    for dir_path in args.dirs:
+        set_id = db.add_image_set(dir_path, workers=args.workers)
+        print "Uploaded", dir_path, "as", set_id